@@ -0,0 +1,198 @@
+"""
+This script benchmarks the speed and accuracy of the nnUNetV2 spinal cord segmentation for different inference settings:
+tile step size, subset of folds, gaussian weighting of the patches and test time mirroring.
+
+The model is loaded once with all its folds and every setting is applied to the same predictor. For each setting and
+each reference image, the script records the inference time, the peak memory (RSS) of the process and the Dice
+between the prediction and the reference segmentation. It saves:
+- benchmark.csv: one row per setting and image
+- benchmark_summary.csv: mean over the images for each setting
+- benchmark_pareto.png: mean inference time vs mean Dice, with the Pareto front of the settings
+
+Note: the same conda environment as run_inference_single_subject.py is required to run this script.
+
+Example usage:
+    python benchmark_inference.py
+        -manifest reference_images.csv
+        -path-model <PATH_TO_MODEL_FOLDER>
+        -tile-step-sizes 0.5 0.7 0.9
+        -fold-subsets all 0 0,1
+        -o benchmark_results
+
+The manifest contains one image per line, followed by a comma and its reference segmentation:
+    sub-001_T1w.nii.gz,sub-001_T1w_seg-manual.nii.gz
+"""
+
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from inference_profiling import get_peak_rss, reset_peak_rss
+from run_inference_single_subject import compute_dice, get_folds, load_predictor, segment_image_in_memory
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Benchmark the speed and accuracy of the nnUNetV2 segmentation for '
+                                                 'different inference settings.')
+    parser.add_argument('-manifest', required=True, type=str,
+                        help='File with one image per line, followed by a comma and its reference segmentation.')
+    parser.add_argument('-path-model', required=True, type=str,
+                        help='Path to the model folder. This folder should contain individual folders like fold_0, '
+                             'fold_1, etc. and dataset.json, dataset_fingerprint.json and plans.json files.')
+    parser.add_argument('-o', required=True, type=str, help='Output folder for the tables and the figure.')
+    parser.add_argument('-use-gpu', action='store_true', default=False,
+                        help='Use GPU for inference. Default: False')
+    parser.add_argument('-use-best-checkpoint', action='store_true', default=False,
+                        help='Use the best checkpoint (instead of the final checkpoint) for prediction. Default: False')
+    parser.add_argument('-tile-step-sizes', nargs='+', default=[0.5, 0.7, 0.9], type=float,
+                        help='Tile step sizes to benchmark. Default: 0.5 0.7 0.9')
+    parser.add_argument('-fold-subsets', nargs='+', default=['all', '0'], type=str,
+                        help='Subsets of folds to benchmark, as comma-separated fold numbers or "all". '
+                             'Default: all 0')
+    parser.add_argument('-use-gaussian', nargs='+', default=[1, 0], type=int, choices=[0, 1],
+                        help='Gaussian weighting of the patches to benchmark (1: on, 0: off). Default: 1 0')
+    parser.add_argument('-use-mirroring', nargs='+', default=[0, 1], type=int, choices=[0, 1],
+                        help='Test time mirroring to benchmark (1: on, 0: off). Default: 0 1')
+
+    return parser
+
+
+def read_manifest(fname_manifest):
+    """
+    Read the images and reference segmentations of the benchmark
+    :param fname_manifest: path to the manifest, one "image,reference" pair per line
+    :return: pairs: list of (image, reference) absolute paths
+    """
+    pairs = []
+    with open(fname_manifest, 'r') as f:
+        for line in f:
+            fields = [field.strip() for field in line.split(',')]
+            if not fields[0] or fields[0].startswith('#'):
+                continue
+            if len(fields) < 2 or not fields[1]:
+                raise ValueError(f'No reference segmentation given for {fields[0]} in {fname_manifest}')
+            pairs.append((os.path.abspath(fields[0]), os.path.abspath(fields[1])))
+    return pairs
+
+
+def get_pareto_front(df_summary):
+    """
+    Find the settings that no other setting beats on both inference time and Dice
+    :param df_summary: DataFrame with the columns time_s and dice
+    :return: is_pareto: boolean array, True for the settings of the Pareto front
+    """
+    times = df_summary['time_s'].to_numpy()
+    dices = df_summary['dice'].to_numpy()
+    is_pareto = np.ones(len(df_summary), dtype=bool)
+    for i in range(len(df_summary)):
+        dominated_by = (times <= times[i]) & (dices >= dices[i]) & ((times < times[i]) | (dices > dices[i]))
+        is_pareto[i] = not np.any(dominated_by)
+    return is_pareto
+
+
+def plot_pareto(df_summary, fname_output):
+    """
+    Plot the mean inference time vs the mean Dice of each setting and highlight the Pareto front
+    :param df_summary: DataFrame with one row per setting (see main)
+    :param fname_output: path of the figure
+    """
+    fig, ax = plt.subplots(figsize=(10, 7))
+    is_pareto = df_summary['pareto'].to_numpy()
+    ax.scatter(df_summary['time_s'][~is_pareto], df_summary['dice'][~is_pareto], color='gray', label='Setting')
+    df_front = df_summary[is_pareto].sort_values('time_s')
+    ax.plot(df_front['time_s'], df_front['dice'], 'o-', color='red', label='Pareto front')
+    for _, row in df_summary.iterrows():
+        ax.annotate(row['setting'], (row['time_s'], row['dice']), xytext=(4, 4), textcoords='offset points',
+                    fontsize=7)
+    ax.set_xlabel('Mean inference time [s]')
+    ax.set_ylabel('Mean Dice with the reference segmentation')
+    ax.set_title('Speed and accuracy of the segmentation for each inference setting')
+    ax.grid(True)
+    ax.legend()
+    fig.savefig(fname_output, dpi=300, bbox_inches='tight')
+    plt.close(fig)
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    pairs = read_manifest(args.manifest)
+    os.makedirs(args.o, exist_ok=True)
+
+    # Load every fold once, the subsets are then taken from the loaded parameters
+    predictor = load_predictor(args.path_model, use_gpu=args.use_gpu, use_best_checkpoint=args.use_best_checkpoint)
+    folds_avail = get_folds(args.path_model)
+    parameters_per_fold = dict(zip(folds_avail, predictor.list_of_parameters))
+
+    fold_subsets = []
+    for fold_subset in args.fold_subsets:
+        folds = folds_avail if fold_subset == 'all' else [int(fold) for fold in fold_subset.split(',')]
+        missing_folds = set(folds) - set(folds_avail)
+        if missing_folds:
+            parser.error(f'Fold(s) {sorted(missing_folds)} not found in {args.path_model}')
+        fold_subsets.append(folds)
+
+    tmpdir = tempfile.mkdtemp(prefix='sciseg_benchmark_')
+    fname_pred = os.path.join(tmpdir, 'pred.nii.gz')
+
+    # Warm up the predictor so that the first setting does not pay for the lazy initializations
+    print('Warming up the predictor...')
+    segment_image_in_memory(predictor, pairs[0][0], fname_pred)
+
+    rows = []
+    settings = itertools.product(args.tile_step_sizes, fold_subsets, args.use_gaussian, args.use_mirroring)
+    for tile_step_size, folds, use_gaussian, use_mirroring in settings:
+        predictor.tile_step_size = tile_step_size
+        predictor.list_of_parameters = [parameters_per_fold[fold] for fold in folds]
+        predictor.use_gaussian = bool(use_gaussian)
+        predictor.use_mirroring = bool(use_mirroring)
+        setting = (f"step={tile_step_size} folds={','.join(map(str, folds))} "
+                   f"gauss={use_gaussian} mirror={use_mirroring}")
+        print(f'\nBenchmarking {setting}...')
+
+        for fname_image, fname_ref in pairs:
+            rss_reset = reset_peak_rss()
+            start = time.time()
+            segment_image_in_memory(predictor, fname_image, fname_pred)
+            total_time = time.time() - start
+            rows.append({
+                'setting': setting,
+                'tile_step_size': tile_step_size,
+                'folds': ','.join(map(str, folds)),
+                'use_gaussian': use_gaussian,
+                'use_mirroring': use_mirroring,
+                'image': fname_image,
+                'time_s': total_time,
+                'peak_rss_mb': get_peak_rss(),
+                'peak_rss_since_start': not rss_reset,
+                'dice': compute_dice(fname_pred, fname_ref),
+            })
+
+    shutil.rmtree(tmpdir)
+
+    # Save the results
+    df = pd.DataFrame(rows)
+    df.to_csv(os.path.join(args.o, 'benchmark.csv'), index=False)
+    df_summary = df.groupby(['setting', 'tile_step_size', 'folds', 'use_gaussian', 'use_mirroring'],
+                            as_index=False, sort=False)[['time_s', 'peak_rss_mb', 'dice']].mean()
+    df_summary['pareto'] = get_pareto_front(df_summary)
+    df_summary.to_csv(os.path.join(args.o, 'benchmark_summary.csv'), index=False)
+    plot_pareto(df_summary, os.path.join(args.o, 'benchmark_pareto.png'))
+
+    print('-' * 50)
+    print(df_summary.sort_values('time_s').to_string(index=False))
+    print('-' * 50)
+    print(f'Benchmark saved in {args.o}')
+
+
+if __name__ == '__main__':
+    main()
@@ -26,7 +26,8 @@
 # 2. The name / tag of the subject
 # 3. The diameter of the binary mask
 # 4. The width of the blur zone. Must be a multiple of 3.
-# 5. Skip the creation/verification of masks and fieldmap if they already exist (0 for no, 1 for yes)
+# 5. Skip the stages (conversion, masks, fieldmap, shims) whose inputs and parameters did not change since their last run
+#    (0 for no, 1 for yes)
 
 # Outputs:
 # - Directory with the nifti files (sub-<subject_name>)
@@ -57,17 +58,22 @@ echo Name of the chosen coil : $COIL_NAME
 OUTPUT_PATH="${DICOMS_PATH%/*}/sub-$SUBJECT_NAME/"
 SORTED_DICOMS_PATH="${DICOMS_PATH%/*}/sorted_dicoms_opt/"
 
-# Check if the sorted dicoms and nifti conversion have already been done
-if [ $VERIFICATION == 1 ] && [ -d "$OUTPUT_PATH" ]; then
-    echo -e "\nDicoms already sorted and converted to nifti. Skipping these steps..."
-else
-    # Sorting dicoms
-    echo -e "\nSorting dicoms..."
-    st_sort_dicoms -i $DICOMS_PATH -o $SORTED_DICOMS_PATH -r
-    # Dicoms to nifti
-    echo -e "\nConverting dicoms to nifti..."
-    st_dicom_to_nifti -i $SORTED_DICOMS_PATH --subject $SUBJECT_NAME -o $OUTPUT_PATH
+# Each stage is only run again if its inputs or its parameters changed since its last run (see stage_manifest.py).
+# Without verification, all the stages are run.
+MANIFEST_DIR="${OUTPUT_PATH}derivatives/manifests"
+FORCE=""
+if [ $VERIFICATION != 1 ]; then
+    FORCE="-force"
 fi
+run_stage() {
+    python "${SCRIPT_DIR}/stage_manifest.py" -manifest-dir "$MANIFEST_DIR" $FORCE "$@"
+}
+
+# Sorting dicoms and converting them to nifti
+echo -e "\nSorting dicoms and converting them to nifti..."
+run_stage -name dicom_to_nifti -inputs "$DICOMS_PATH" -outputs "${OUTPUT_PATH}sub-${SUBJECT_NAME}" \
+    -- bash -c 'st_sort_dicoms -i "$1" -o "$2" -r && st_dicom_to_nifti -i "$2" --subject "$3" -o "$4"' \
+    _ "$DICOMS_PATH" "$SORTED_DICOMS_PATH" "$SUBJECT_NAME" "$OUTPUT_PATH" || exit
 
 # Set ohter file paths
 MAGNITUDE_PATH=$(find "${OUTPUT_PATH}sub-${SUBJECT_NAME}" -name "*magnitude1.nii.gz")
@@ -96,79 +102,35 @@ FNAME_SOFT_MASK_2LVLS_ST="${MASK_DIR}/st_soft_mask_2lvls.nii.gz"
 FNAME_SOFT_MASK_LINEAR_ST="${MASK_DIR}/st_soft_mask_linear.nii.gz"
 FNAME_SOFT_MASK_GAUSS_ST="${MASK_DIR}/st_soft_mask_gauss.nii.gz"
 
-# Check if paths exist and skipping the creation of the masks if they do
-if [ $VERIFICATION == 1 ] && [ -f "$FNAME_SEGMENTATION" ]; then
-    echo -e "\nSegmentation mask already exists. Skipping creation..."
-else
-    echo -e "\nCreating segmentation from magnitude image..."
-    start_time=$(gdate +%s%3N)
-    sct_deepseg_sc -i "${MPRAGE_PATH}" -o "${FNAME_SEGMENTATION}" -c 't1'|| exit
-    # python run_inference_single_subject.py \
-    #     -i "${MPRAGE_PATH}" \
-    #     -path-model /Users/antoineguenette/Desktop/Scolaire/NeuroPoly/Stage_E25/Experiences/sct_7.0/data/deepseg_models/model_seg_sc_contrast_agnostic_nnunet/nnUNetTrainer__nnUNetPlans__3d_fullres \
-    #     -use-best-checkpoint -use-gpu \
-    #     -o "${FNAME_SEGMENTATION}"
-    end_time=$(gdate +%s%3N)
-    elapsed_time_ms=$((end_time - start_time))
-    elapsed_time_sec=$(echo "scale=3; $elapsed_time_ms / 1000" | bc)
-    echo -e "\nSegmentation mask created in $elapsed_time_sec seconds."
-fi
-
-if [ $VERIFICATION == 1 ] && [ -f "$FNAME_BIN_MASK_SCT" ]; then
-    echo -e "\nBinary mask already exists. Skipping creation..."
-else
-    echo -e "\nCreating binary mask from segmentation..."
-    start_time=$(gdate +%s%3N)
-    sct_create_mask -i "${MPRAGE_PATH}" -p centerline,"${FNAME_SEGMENTATION}" -size "${DIAMETER}mm" -f cylinder -o "${FNAME_BIN_MASK_SCT}" || exit
-    end_time=$(gdate +%s%3N)
-    elapsed_time_ms=$((end_time - start_time))
-    elapsed_time_sec=$(echo "scale=3; $elapsed_time_ms / 1000" | bc)
-    echo -e "\nBinary mask created in $elapsed_time_sec seconds."
-fi
-
-if [ $VERIFICATION == 1 ] && [ -f "$FNAME_BIN_MASK_SCT_FM" ]; then
-    echo -e "\nBinary mask for fieldmap already exists. Skipping creation..."
-else
-    echo -e "\nCreating binary mask for fieldmap from segmentation ..."
-    MASK_SIZE=$((DIAMETER + 2 * BLUR_WIDTH + 5))
-    sct_create_mask -i "${MPRAGE_PATH}" -p centerline,"${FNAME_SEGMENTATION}" -size "${MASK_SIZE}mm" -f cylinder -o "${FNAME_BIN_MASK_SCT_FM}" || exit
-fi
-
-if [ $VERIFICATION == 1 ] && [ -f "$FNAME_SOFT_MASK_2LVLS_ST" ]; then
-    echo -e "\n2 levels soft mask already exists. Skipping creation..."
-else
-    echo -e "\nCreating 2 levels soft mask from segmentation..."
-    start_time=$(gdate +%s%3N)
-    st_mask softmask -i "${FNAME_SEGMENTATION}" -o "${FNAME_SOFT_MASK_2LVLS_ST}" -t '2levels' -w $BLUR_WIDTH -u 'mm' -b 0.5 || exit
-    end_time=$(gdate +%s%3N)
-    elapsed_time_ms=$((end_time - start_time))
-    elapsed_time_sec=$(echo "scale=3; $elapsed_time_ms / 1000" | bc)
-    echo -e "2 levels soft mask created in $elapsed_time_sec seconds."
-fi
-
-if [ $VERIFICATION == 1 ] && [ -f "$FNAME_SOFT_MASK_LINEAR_ST" ]; then
-    echo -e "\nLinear soft mask already exists. Skipping creation..."
-else
-    echo -e "\nCreating linear soft mask from segmentation..."
-    start_time=$(gdate +%s%3N)
-    st_mask softmask -i "${FNAME_SEGMENTATION}" -o "${FNAME_SOFT_MASK_LINEAR_ST}" -t 'linear' -w $BLUR_WIDTH -u 'mm' || exit
-    end_time=$(gdate +%s%3N)
-    elapsed_time_ms=$((end_time - start_time))
-    elapsed_time_sec=$(echo "scale=3; $elapsed_time_ms / 1000" | bc)
-    echo -e "Linear soft mask created in $elapsed_time_sec seconds."
-fi
-
-if [ $VERIFICATION == 1 ] && [ -f "$FNAME_SOFT_MASK_GAUSS_ST" ]; then
-    echo -e "\nGaussian soft mask already exists. Skipping creation..."
-else
-    echo -e "\nCreating gaussian soft mask from segmentation..."
-    start_time=$(gdate +%s%3N)
-    st_mask softmask -i "${FNAME_SEGMENTATION}" -o "${FNAME_SOFT_MASK_GAUSS_ST}" -t 'gaussian' -w $BLUR_WIDTH -u 'mm' || exit
-    end_time=$(gdate +%s%3N)
-    elapsed_time_ms=$((end_time - start_time))
-    elapsed_time_sec=$(echo "scale=3; $elapsed_time_ms / 1000" | bc)
-    echo -e "Gaussian soft mask created in $elapsed_time_sec seconds."
-fi
+# Create the masks, each one only if the segmentation or its parameters changed
+echo -e "\nCreating segmentation from magnitude image..."
+run_stage -name segmentation -inputs "${MPRAGE_PATH}" -outputs "${FNAME_SEGMENTATION}" \
+    -- python "${SCRIPT_DIR}/segmentation_cache.py" -i "${MPRAGE_PATH}" -o "${FNAME_SEGMENTATION}" -model sct_deepseg_sc -settings 'c=t1' \
+    -- sct_deepseg_sc -i "${MPRAGE_PATH}" -o "${FNAME_SEGMENTATION}" -c 't1' || exit
+# python run_inference_single_subject.py \
+#     -i "${MPRAGE_PATH}" \
+#     -path-model /Users/antoineguenette/Desktop/Scolaire/NeuroPoly/Stage_E25/Experiences/sct_7.0/data/deepseg_models/model_seg_sc_contrast_agnostic_nnunet/nnUNetTrainer__nnUNetPlans__3d_fullres \
+#     -use-best-checkpoint -use-gpu \
+#     -cache-dir ~/.cache/sciseg_segmentations \
+#     -o "${FNAME_SEGMENTATION}"
+
+echo -e "\nCreating binary mask from segmentation..."
+run_stage -name bin_mask_sct -inputs "${MPRAGE_PATH}" "${FNAME_SEGMENTATION}" -outputs "${FNAME_BIN_MASK_SCT}" \
+    -- sct_create_mask -i "${MPRAGE_PATH}" -p centerline,"${FNAME_SEGMENTATION}" -size "${DIAMETER}mm" -f cylinder -o "${FNAME_BIN_MASK_SCT}" || exit
+
+echo -e "\nCreating binary mask for fieldmap from segmentation ..."
+MASK_SIZE=$((DIAMETER + 2 * BLUR_WIDTH + 5))
+run_stage -name bin_mask_sct_fm -inputs "${MPRAGE_PATH}" "${FNAME_SEGMENTATION}" -outputs "${FNAME_BIN_MASK_SCT_FM}" \
+    -- sct_create_mask -i "${MPRAGE_PATH}" -p centerline,"${FNAME_SEGMENTATION}" -size "${MASK_SIZE}mm" -f cylinder -o "${FNAME_BIN_MASK_SCT_FM}" || exit
+
+# The three soft masks are created by st_mask softmask in a single process (see softmask_batch.py)
+echo -e "\nCreating 2 levels, linear and gaussian soft masks from segmentation..."
+run_stage -name soft_masks -inputs "${FNAME_SEGMENTATION}" \
+    -outputs "${FNAME_SOFT_MASK_2LVLS_ST}" "${FNAME_SOFT_MASK_LINEAR_ST}" "${FNAME_SOFT_MASK_GAUSS_ST}" \
+    -- python "${SCRIPT_DIR}/softmask_batch.py" -i "${FNAME_SEGMENTATION}" -w $BLUR_WIDTH -u 'mm' \
+        -o 2levels:0.5 "${FNAME_SOFT_MASK_2LVLS_ST}" \
+        -o linear "${FNAME_SOFT_MASK_LINEAR_ST}" \
+        -o gaussian "${FNAME_SOFT_MASK_GAUSS_ST}" || exit
 
 echo -e "\nAll masks checked and created successfully."
 
@@ -205,20 +167,17 @@ esac
 FIELDMAP_PATH="${OUTPUT_PATH}derivatives/fmap/fieldmap.nii.gz"
 FIELDMAP_JSON_PATH="${OUTPUT_PATH}derivatives/fmap/fieldmap.json"
 
-# Check if the fieldmap already exists and skip the creation if it does
-if [ $VERIFICATION == 1 ] && [ -f "$FIELDMAP_PATH" ] && [ -f "$FIELDMAP_JSON_PATH" ]; then
-    echo -e "\nFieldmap already exists. Skipping fieldmap creation..."
-else
-    # Create fieldmap
-    echo -e "\nCreating fieldmap..."
-    st_prepare_fieldmap $PHASE1_PATH $PHASE2_PATH \
+# Create fieldmap
+echo -e "\nCreating fieldmap..."
+run_stage -name fieldmap -inputs "$PHASE1_PATH" "$PHASE2_PATH" "$MAGNITUDE_PATH" "$FNAME_BIN_MASK_SCT_FM" \
+    -outputs "$FIELDMAP_PATH" "$FIELDMAP_JSON_PATH" \
+    -- st_prepare_fieldmap $PHASE1_PATH $PHASE2_PATH \
      --mag $MAGNITUDE_PATH \
      --unwrapper prelude \
      --gaussian-filter true \
      --mask $FNAME_BIN_MASK_SCT_FM \
      --sigma 1 \
-     -o $FIELDMAP_PATH
-fi
+     -o $FIELDMAP_PATH || exit
 
 # Show fieldmap with magnitude
 echo -e "\nDisplaying fieldmap with magnitude image..."
@@ -267,7 +226,12 @@ do
     MASK_NAME=$(basename "$mask" .nii.gz)
     OUTPUT_DIR="${OPTI_OUTPUT_DIR}/dynamic_shim_${MASK_NAME}"
     echo -e "\nShimming the fieldmap with $MASK_NAME..."
-    st_b0shim dynamic \
+    # Options to add to weight the signal loss:
+    #     --weighting-signal-loss 0.01 \
+    #     --weighting-signal-loss-xy 0.01 \
+    run_stage -name "shim_${MASK_NAME}" \
+        -inputs "$COIL_PATH" "$COIL_CONFIG_PATH" "$FIELDMAP_PATH" "$EPI_PATH" "$mask" -outputs "$OUTPUT_DIR" \
+        -- st_b0shim dynamic \
         --coil $COIL_PATH $COIL_CONFIG_PATH \
         --fmap $FIELDMAP_PATH \
         --target $EPI_PATH \
@@ -275,15 +239,13 @@ do
         --mask-dilation-kernel-size 3 \
         --optimizer-criteria 'rmse' \
         --optimizer-method "least_squares" \
-        # --weighting-signal-loss 0.01 \
-        # --weighting-signal-loss-xy 0.01 \
         --slices "auto" \
         --output-file-format-coil "chronological-coil" \
         --output-value-format "absolute" \
         --fatsat "yes" \
         --regularization-factor 0.3 \
         --output "$OUTPUT_DIR" \
-        --verbose 'info'
+        --verbose 'info' || exit
 
     # Create two files with the same currents, with and without fatsat
     DYN_CURRENTS_DIR="${OUTPUT_DIR}/coefs_coil0_${COIL_NAME}_no_fatsat.txt"
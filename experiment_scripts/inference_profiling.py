@@ -0,0 +1,166 @@
+"""
+Per-stage timing and resource instrumentation of the spinal cord segmentation.
+
+The segmentation is split in consecutive stages (temporary copy, orientation query, reorientation, model
+initialization, preprocessing, prediction, export, reorientation back...). For each stage, the profiler records the
+wall time, the CPU time of the process and its peak memory (RSS). The prediction stages also record the number of
+sliding window patches. A run is appended to a JSON lines file as a single line, so that the runs of different
+machines and versions can be compared.
+
+Note: the CPU time only covers the main process, the preprocessing and export workers of nnUNet are not included.
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import resource
+import sys
+import time
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the process so that the next measure only covers what comes after (Linux only)
+    :return: reset: True if the peak was reset, False if get_peak_rss will return the peak since the process started
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    """
+    Get the peak RSS of the process
+    :return: peak_rss: peak RSS in MB
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in bytes on macOS and in kB on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+class InferenceProfiler:
+    """
+    Record consecutive stages of a segmentation. Starting a stage ends the current one.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._current = None
+
+    def start(self, stage, **info):
+        """
+        End the current stage and start a new one
+        :param stage: name of the stage, e.g. prediction
+        :param info: additional information saved with the stage, e.g. the number of patches
+        """
+        self.stop()
+        self._current = {'stage': stage, 'info': info, 'wall': time.perf_counter(), 'cpu': time.process_time(),
+                         'peak_rss_reset': reset_peak_rss()}
+
+    def stop(self, stage=None):
+        """
+        End the current stage, if any
+        :param stage: new name of the stage, when it is only known at the end
+        """
+        if self._current is None:
+            return
+        current, self._current = self._current, None
+        span = {
+            'stage': stage or current['stage'],
+            'wall_s': time.perf_counter() - current['wall'],
+            'cpu_s': time.process_time() - current['cpu'],
+            'peak_rss_mb': get_peak_rss(),
+            # False on systems where the peak RSS can not be reset: the peak is then the one of the whole process
+            'peak_rss_of_stage': current['peak_rss_reset'],
+        }
+        span.update(current['info'])
+        self.spans.append(span)
+
+    @contextlib.contextmanager
+    def stage(self, stage, **info):
+        """
+        Context manager recording a single stage
+        :param stage: name of the stage
+        :param info: additional information saved with the stage
+        """
+        self.start(stage, **info)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def attach(self, predictor):
+        """
+        Record the preprocessing, prediction and export stages that happen inside the nnUNet predictor. The prediction
+        of each image is a stage, the time before it is preprocessing and the time after the last one is export.
+        :param predictor: initialized nnUNetPredictor
+        """
+        profiler = self
+        predict_logits = predictor.predict_logits_from_preprocessed_data
+
+        def profiled_predict_logits(data):
+            profiler.start('prediction', device=str(predictor.device), **count_patches(predictor, data.shape[1:]))
+            logits = predict_logits(data)
+            # Until the next image is predicted, nnUNet waits for its preprocessing
+            profiler.start('preprocessing')
+            return logits
+
+        predictor.predict_logits_from_preprocessed_data = profiled_predict_logits
+        self.start('preprocessing')
+
+    def detach(self, predictor):
+        """
+        Stop recording the stages of the predictor (see attach)
+        :param predictor: nnUNetPredictor given to attach
+        """
+        # The stage left open after the last prediction is the export of the segmentations
+        self.stop('export')
+        del predictor.predict_logits_from_preprocessed_data
+
+    def write(self, fname_output, **run_info):
+        """
+        Append the recorded stages to a JSON lines file
+        :param fname_output: path to the JSON lines file
+        :param run_info: information about the run saved with the stages, e.g. the images and the device
+        """
+        self.stop()
+        run = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), **run_info,
+               'total_wall_s': sum(span['wall_s'] for span in self.spans), 'spans': self.spans}
+        os.makedirs(os.path.dirname(os.path.abspath(fname_output)), exist_ok=True)
+        with open(fname_output, 'a') as f:
+            f.write(json.dumps(run) + '\n')
+
+
+def count_patches(predictor, image_size):
+    """
+    Count the sliding window patches evaluated by the predictor for a preprocessed image
+    :param predictor: initialized nnUNetPredictor
+    :param image_size: spatial shape of the preprocessed image
+    :return: counts: dict with the number of patches per fold, the number of folds and the number of mirrorings
+    """
+    from nnunetv2.inference.sliding_window_prediction import compute_steps_for_sliding_window
+
+    patch_size = predictor.configuration_manager.patch_size
+    # nnUNet pads the images smaller than the patch
+    image_size = [max(size, patch) for size, patch in zip(image_size, patch_size)]
+    steps = compute_steps_for_sliding_window(image_size, patch_size, predictor.tile_step_size)
+    num_patches = 1
+    for steps_axis in steps:
+        num_patches *= len(steps_axis)
+    mirror_axes = predictor.allowed_mirroring_axes if predictor.use_mirroring else None
+    return {
+        'patches_per_fold': num_patches,
+        'folds': len(predictor.list_of_parameters),
+        'mirrorings': 2 ** len(mirror_axes) if mirror_axes else 1,
+    }
@@ -36,6 +36,37 @@ Example usage:
         -o sub-001_T2w_seg.nii.gz
         -path-model <PATH_TO_MODEL_FOLDER>
         -tile-step-size 0.5
+
+To segment several subjects in a row without reloading the model each time, start a persistent inference server once
+(it keeps the predictor loaded in memory) and send requests to it from the same script in client mode:
+    python run_inference_single_subject.py
+        -serve
+        -path-model <PATH_TO_MODEL_FOLDER>
+        -use-best-checkpoint -use-gpu
+    python run_inference_single_subject.py
+        -client
+        -i sub-001_T2w.nii.gz
+        -o sub-001_T2w_seg.nii.gz
+
+On machines without GPU, the CPU inference can be accelerated with -num-threads, -bf16, -compile and -channels-last.
+Add -report-speedup to also run the default CPU path on the same image and print the speedup:
+    python run_inference_single_subject.py
+        -i sub-001_T2w.nii.gz
+        -o sub-001_T2w_seg.nii.gz
+        -path-model <PATH_TO_MODEL_FOLDER>
+        -num-threads 8 -bf16 -channels-last -report-speedup
+
+Use -in-memory to reorient the image with nibabel and run the prediction on NumPy arrays instead of calling sct_image
+and writing temporary files. With -in-memory, -roi restricts the sliding window to a padded box around the spinal cord,
+found from a previous segmentation or centerline of the subject, or from a coarse prediction:
+    python run_inference_single_subject.py
+        -i sub-001_T2w.nii.gz
+        -o sub-001_T2w_seg.nii.gz
+        -path-model <PATH_TO_MODEL_FOLDER>
+        -in-memory -roi previous_session_seg.nii.gz -roi-padding 25
+
+Use -profile to append the wall time, CPU time and peak memory of each stage of the segmentation (copy, orientation,
+model initialization, preprocessing, prediction, export...) to a JSON lines file.
 """
 
 
@@ -45,24 +76,40 @@ import subprocess
 import argparse
 import datetime
 
-import torch
 import glob
+import json
+import socket
+import socketserver
 import time
 import tempfile
 
-from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
-from batchgenerators.utilities.file_and_folder_operations import join
+import nibabel as nib
+import numpy as np
+
+from inference_profiling import InferenceProfiler
+from segmentation_cache import DEFAULT_CACHE_SIZE_MB, cache_get, cache_put, get_cache_key, hash_image
+
+# NOTE: torch and nnunetv2 are imported lazily (see load_predictor) so that the client mode does not pay for them
+
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'sciseg_nnunet.sock')
 
+# SCT names orientations after the side each axis comes from (RPI = x from right to left) while nibabel names them
+# after the side each axis points to (RPI in SCT = LAS in nibabel)
+OPPOSITE_AXCODES = {'R': 'L', 'L': 'R', 'A': 'P', 'P': 'A', 'S': 'I', 'I': 'S'}
 
 
 def get_parser():
     # parse command line arguments
     parser = argparse.ArgumentParser(description='Segment an image using nnUNetV2 model.')
-    parser.add_argument('-i', help='Input image to segment. Example: sub-001_T2w.nii.gz', required=True)
-    parser.add_argument('-o', help='Output filename. Example: sub-001_T2w_seg.nii.gz', required=True)
+    parser.add_argument('-i', help='Input image to segment. Example: sub-001_T2w.nii.gz. '
+                                   'Required unless -serve or -batch is used.')
+    parser.add_argument('-o', help='Output filename. Example: sub-001_T2w_seg.nii.gz. '
+                                   'With -batch, output folder for the segmentations. '
+                                   'Required unless -serve is used.')
     parser.add_argument('-path-model', help='Path to the model folder. This folder should contain individual '
                                             'folders like fold_0, fold_1, etc. and dataset.json, '
-                                            'dataset_fingerprint.json and plans.json files.', required=True, type=str)
+                                            'dataset_fingerprint.json and plans.json files. '
+                                            'Required unless -client is used.', type=str)
     parser.add_argument('-use-gpu', action='store_true', default=False,
                         help='Use GPU for inference. Default: False')
     parser.add_argument('-use-best-checkpoint', action='store_true', default=False,
@@ -73,6 +120,66 @@ def get_parser():
                              'Default: 0.5 '
                              'NOTE: changing it from 0.5 to 0.9 makes inference faster but there is a small drop in '
                              'performance.')
+    parser.add_argument('-in-memory', action='store_true', default=False,
+                        help='Reorient the image with nibabel and predict on NumPy arrays instead of calling '
+                             'sct_image and nnUNet on temporary files. Default: False')
+    parser.add_argument('-num-threads', type=int,
+                        help='Number of threads used by torch inside each operation (intra-op) on CPU. '
+                             'Default: torch default (number of physical cores)')
+    parser.add_argument('-num-interop-threads', type=int,
+                        help='Number of threads used by torch to run independent operations in parallel (inter-op) '
+                             'on CPU. Default: torch default')
+    parser.add_argument('-bf16', action='store_true', default=False,
+                        help='Run the network in bfloat16 autocast on CPU. Fast on CPUs with AVX512-BF16/AMX, the '
+                             'segmentation can differ slightly from float32. Default: False')
+    parser.add_argument('-compile', action='store_true', default=False,
+                        help='Compile the network with torch.compile. The first prediction is slower because of the '
+                             'compilation. Default: False')
+    parser.add_argument('-channels-last', action='store_true', default=False,
+                        help='Use the channels-last memory layout for the network and its inputs. Default: False')
+    parser.add_argument('-report-speedup', action='store_true', default=False,
+                        help='Also segment the image with the default settings (float32, default threads, no '
+                             'compilation) and report the speedup and the Dice between both segmentations. '
+                             'Default: False')
+    parser.add_argument('-cache-dir', type=str,
+                        help='Segmentation cache folder. Images already segmented with the same model and settings '
+                             'are copied from the cache instead of being segmented again, new segmentations are added '
+                             'to it. Default: no cache')
+    parser.add_argument('-cache-size-mb', default=DEFAULT_CACHE_SIZE_MB, type=float,
+                        help=f'Maximum size of the segmentation cache in MB, the least recently used segmentations are '
+                             f'removed first. Default: {DEFAULT_CACHE_SIZE_MB}')
+    parser.add_argument('-batch', type=str,
+                        help='Segment several images with a single predictor instead of -i. Either a folder containing '
+                             'the images, a glob pattern (e.g. "data/sub-*/anat/*_T1w.nii.gz") or a manifest file with '
+                             'one image per line, optionally followed by a comma and the output filename. '
+                             'Segmentations without an output filename are saved in -o as <image>_seg.nii.gz.')
+    parser.add_argument('-num-parts', default=1, type=int,
+                        help='Split the batch in this many parts to run them in separate processes or machines. '
+                             'Default: 1')
+    parser.add_argument('-part-id', default=0, type=int,
+                        help='Part of the batch segmented by this process, from 0 to -num-parts - 1. Default: 0')
+    parser.add_argument('-num-processes', default=8, type=int,
+                        help='Number of processes used by nnUNet for preprocessing and for exporting the '
+                             'segmentations. Default: 8')
+    parser.add_argument('-roi', type=str,
+                        help='Only segment a box around the spinal cord (requires -in-memory). Either a previous '
+                             'segmentation or centerline of the subject (any space, the box is computed in world '
+                             'coordinates) or "coarse" to find the spinal cord with a fast prediction (tile step size '
+                             'of 1 and a single fold). Default: segment the whole image')
+    parser.add_argument('-roi-padding', default=25, type=float,
+                        help='Padding added around the spinal cord on each side of the box, in mm. Default: 25')
+    parser.add_argument('-profile', type=str,
+                        help='JSON lines file where the wall time, CPU time and peak memory of each stage of the '
+                             'segmentation are appended, one line per run. Default: no profiling')
+    parser.add_argument('-serve', action='store_true', default=False,
+                        help='Start a persistent inference server that loads the model once and keeps it in memory. '
+                             'Requests are sent with -client. Stop the server with Ctrl+C. Default: False')
+    parser.add_argument('-client', action='store_true', default=False,
+                        help='Send the segmentation request (-i/-o) to a running inference server instead of loading '
+                             'the model. Default: False')
+    parser.add_argument('-socket', default=DEFAULT_SOCKET_PATH, type=str,
+                        help=f'Unix socket used to communicate with the inference server. '
+                             f'Default: {DEFAULT_SOCKET_PATH}')
 
     return parser
 
@@ -91,6 +198,27 @@ def get_orientation(file):
     return orig_orientation
 
 
+def get_orientation_from_header(nii):
+    """
+    Get the orientation of an image from its nibabel header, using the SCT convention
+    :param nii: nibabel image
+    :return: orientation: orientation of the image, e.g. RPI
+    """
+    return ''.join(OPPOSITE_AXCODES[axcode] for axcode in nib.aff2axcodes(nii.affine))
+
+
+def get_orientation_transform(orig_orientation, target_orientation):
+    """
+    Get the nibabel orientation transform between two orientations given with the SCT convention
+    :param orig_orientation: orientation of the image, e.g. LPI
+    :param target_orientation: orientation to reorient to, e.g. RPI
+    :return: transform: nibabel orientation transform to use with nii.as_reoriented()
+    """
+    orig_ornt = nib.orientations.axcodes2ornt([OPPOSITE_AXCODES[c] for c in orig_orientation])
+    target_ornt = nib.orientations.axcodes2ornt([OPPOSITE_AXCODES[c] for c in target_orientation])
+    return nib.orientations.ornt_transform(orig_ornt, target_ornt)
+
+
 def tmp_create():
     """
     Create temporary folder and return its path
@@ -133,67 +261,120 @@ def add_suffix(fname, suffix):
     return os.path.join(stem + suffix + ext)
 
 
-def main():
-    parser = get_parser()
-    args = parser.parse_args()
+def get_device(use_gpu):
+    """
+    Get the device to use for inference
+    :param use_gpu: whether to look for a GPU (CUDA or MPS)
+    :return: device: torch device, CPU if no GPU is requested or found
+    """
+    import torch
 
-    # Note: we use os.path.abspath to resolve relative paths
-    fname_file = os.path.abspath(args.i)
-    fname_file_out = os.path.abspath(args.o)
-    print(f'\nFound {fname_file} file.')
+    if not use_gpu:
+        print('Using CPU for inference.')
+        return torch.device('cpu')
 
-    # Create temporary directory in the temp to store the reoriented images
-    tmpdir = tmp_create()
-    # Copy the file to the temporary directory using shutil.copyfile
-    fname_file_tmp = os.path.join(tmpdir, os.path.basename(fname_file))
-    shutil.copyfile(fname_file, fname_file_tmp)
-    print(f'Copied {fname_file} to {fname_file_tmp}')
+    if not torch.cuda.is_available():
+        print('CUDA-enabled GPU not found. Checking if Apple GPU (MPS) is available...')
+        if torch.backends.mps.is_available():
+            print('Using MPS for inference.')
+            return torch.device('mps')
+        print('No CUDA-enabled GPU or Apple GPU (MPS) found. Using CPU for inference.')
+        return torch.device('cpu')
 
-    # Get the original orientation of the image, for example RPI
-    orig_orientation = get_orientation(fname_file_tmp)
+    print('Using CUDA-enabled GPU for inference.')
+    return torch.device('cuda')
 
-    # Reorient the image to RPI orientation if not already in RPI
-    if orig_orientation != 'RPI':
-        print('Reorienting to RPI orientation...')
-        # reorient the image to RPI using SCT
-        os.system('sct_image -i {} -setorient RPI -o {}'.format(fname_file_tmp, fname_file_tmp))
 
-    # NOTE: for individual images, the _0000 suffix is not needed.
-    # BUT, the images should be in a list of lists
-    fname_file_tmp_list = [[fname_file_tmp]]
+def set_cpu_threads(num_threads=None, num_interop_threads=None):
+    """
+    Set the number of threads used by torch on CPU
+    :param num_threads: number of intra-op threads, None to keep the torch default
+    :param num_interop_threads: number of inter-op threads, None to keep the torch default. Must be set before any
+                                inference since torch can not change it afterwards.
+    """
+    import torch
+
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    print(f'Using {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} inter-op thread(s).')
+
+
+def accelerate_network(predictor, bf16=False, compile_network=False, channels_last=False):
+    """
+    Speed up the network of an initialized predictor. The checkpoints of the folds are loaded in the same network
+    during the prediction, so the changes apply to every fold.
+    :param predictor: initialized nnUNetPredictor (see load_predictor)
+    :param bf16: run the network in bfloat16 autocast (CPU only)
+    :param compile_network: compile the network with torch.compile
+    :param channels_last: use the channels-last memory layout for the network and its inputs
+    """
+    import torch
+
+    if bf16 and predictor.device.type != 'cpu':
+        raise ValueError('bfloat16 autocast is only available for CPU inference, nnUNet already uses mixed precision '
+                         'on CUDA.')
+
+    network = predictor.network
+    if channels_last:
+        network.to(memory_format=torch.channels_last_3d)
+
+    if bf16 or channels_last:
+        forward = network.forward
+
+        def accelerated_forward(x):
+            if channels_last:
+                x = x.contiguous(memory_format=torch.channels_last_3d)
+            if not bf16:
+                return forward(x)
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                # nnUNet accumulates the patch predictions in float32
+                return forward(x).float()
+
+        network.forward = accelerated_forward
+
+    if compile_network:
+        # nnUNet loads the fold checkpoints in the original module of a compiled network
+        predictor.network = torch.compile(network)
+
+    print(f'Network acceleration: bf16={bf16}, compile={compile_network}, channels_last={channels_last}')
+
+
+def get_folds(path_model):
+    """
+    Get the folds available in a model folder
+    :param path_model: path to the model folder containing the fold_* folders
+    :return: folds: sorted list of fold numbers
+    """
+    return sorted(int(f.split('_')[-1]) for f in os.listdir(path_model) if f.startswith('fold_'))
+
+
+def load_predictor(path_model, use_gpu=False, use_best_checkpoint=False, tile_step_size=0.5):
+    """
+    Instantiate the nnUNetPredictor, build the network and load the checkpoint of every fold
+    :param path_model: path to the model folder containing the fold_* folders
+    :param use_gpu: whether to use the GPU for inference
+    :param use_best_checkpoint: use checkpoint_best.pth instead of checkpoint_final.pth
+    :param tile_step_size: tile step size defining the overlap between patches
+    :return: predictor: initialized nnUNetPredictor
+    """
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+    from batchgenerators.utilities.file_and_folder_operations import join
 
     # Use all the folds available in the model folder by default
-    folds_avail = [int(f.split('_')[-1]) for f in os.listdir(args.path_model) if f.startswith('fold_')]
+    folds_avail = get_folds(path_model)
     print(f'Using fold(s) {folds_avail}')
 
-    # Create directory for nnUNet prediction
-    tmpdir_nnunet = os.path.join(tmpdir, 'nnUNet_prediction')
-    fname_prediction = os.path.join(tmpdir_nnunet, os.path.basename(add_suffix(fname_file_tmp, '_pred')))
-    os.mkdir(tmpdir_nnunet)
-
     # set device for nnUNet
-    if args.use_gpu:
-        if not torch.cuda.is_available():
-            print('CUDA-enabled GPU not found. Checking if Apple GPU (MPS) is available...')
-            if torch.backends.mps.is_available():
-                print('Using MPS for inference.')
-                device = torch.device('mps')
-            else:
-                print('No CUDA-enabled GPU or Apple GPU (MPS) found. Using CPU for inference.')
-                device = torch.device('cpu')
-        else:
-            print('Using CUDA-enabled GPU for inference.')
-            device = torch.device('cuda')
+    device = get_device(use_gpu)
 
-    # Run nnUNet prediction
-    print('Starting inference...it may take a few minutes...')
-    start = time.time()
     # instantiate the nnUNetPredictor
     predictor = nnUNetPredictor(
-        tile_step_size=args.tile_step_size,     # changing it from 0.5 to 0.9 makes inference faster
+        tile_step_size=tile_step_size,          # changing it from 0.5 to 0.9 makes inference faster
         use_gaussian=True,                      # applies gaussian noise and gaussian blur
         use_mirroring=False,                    # test time augmentation by mirroring on all axes
-        perform_everything_on_device=True if args.use_gpu else False,
+        perform_everything_on_device=True if use_gpu else False,
         device=device,  # use GPU if available, otherwise CPU
         verbose=False,
         verbose_preprocessing=False,
@@ -203,56 +384,578 @@ def main():
 
     # initializes the network architecture, loads the checkpoint
     predictor.initialize_from_trained_model_folder(
-        join(args.path_model),
+        join(path_model),
         use_folds=folds_avail,
-        checkpoint_name='checkpoint_final.pth' if not args.use_best_checkpoint else 'checkpoint_best.pth',
+        checkpoint_name='checkpoint_final.pth' if not use_best_checkpoint else 'checkpoint_best.pth',
     )
-    print('Model loaded successfully. Fetching test data...')
+    print('Model loaded successfully.')
+
+    return predictor
+
+
+def prepare_image(fname_file, tmpdir, profiler):
+    """
+    Copy an image to a temporary folder and reorient it to RPI for nnUNet
+    :param fname_file: absolute path to the image to segment
+    :param tmpdir: temporary folder to copy the image to
+    :param profiler: InferenceProfiler recording the stages
+    :return: fname_file_tmp: path of the reoriented copy
+    :return: orig_orientation: original orientation of the image, e.g. LPI
+    """
+    # Copy the file to the temporary directory using shutil.copyfile
+    fname_file_tmp = os.path.join(tmpdir, os.path.basename(fname_file))
+    with profiler.stage('temp_copy'):
+        shutil.copyfile(fname_file, fname_file_tmp)
+    print(f'Copied {fname_file} to {fname_file_tmp}')
+
+    # Get the original orientation of the image, for example RPI
+    with profiler.stage('orientation_query'):
+        orig_orientation = get_orientation(fname_file_tmp)
+
+    # Reorient the image to RPI orientation if not already in RPI
+    if orig_orientation != 'RPI':
+        print('Reorienting to RPI orientation...')
+        # reorient the image to RPI using SCT
+        with profiler.stage('reorient'):
+            os.system('sct_image -i {} -setorient RPI -o {}'.format(fname_file_tmp, fname_file_tmp))
+
+    return fname_file_tmp, orig_orientation
+
+
+def restore_orientation(fname_prediction, orig_orientation):
+    """
+    Reorient a prediction made in RPI back to the original orientation of the image, in place
+    :param fname_prediction: path to the prediction
+    :param orig_orientation: original orientation of the image, e.g. LPI
+    """
+    # skip if already in RPI
+    if orig_orientation != 'RPI':
+        print(f'Reorienting to original orientation {orig_orientation}...')
+        # reorient the image to the original orientation using SCT
+        os.system('sct_image -i {} -setorient {} -o {}'.format(fname_prediction, orig_orientation, fname_prediction))
+
+
+def segment_images(predictor, fnames_file, fnames_file_out, num_processes=8, profiler=None):
+    """
+    Segment several images with an already initialized predictor. All the images go through a single call to
+    predict_from_files so that nnUNet's preprocessing and export worker pools run in parallel with the prediction.
+    :param predictor: initialized nnUNetPredictor (see load_predictor)
+    :param fnames_file: list of absolute paths to the images to segment
+    :param fnames_file_out: list of absolute paths of the output segmentations
+    :param num_processes: number of processes used by nnUNet for preprocessing and for exporting
+    :param profiler: InferenceProfiler recording the stages, None to not record them
+    :return: total_time: time spent in preprocessing and prediction, in seconds
+    """
+    profiler = profiler if profiler is not None else InferenceProfiler()
 
-    # NOTE: for individual files, the image should be in a list of lists
+    # Create temporary directory in the temp to store the reoriented images
+    tmpdir = tmp_create()
+
+    # Each image gets its own subfolder so that images with the same name do not overwrite each other
+    fnames_file_tmp, orig_orientations = [], []
+    for i_file, fname_file in enumerate(fnames_file):
+        print(f'\nFound {fname_file} file.')
+        tmpdir_file = os.path.join(tmpdir, f'{i_file:04d}')
+        os.mkdir(tmpdir_file)
+        fname_file_tmp, orig_orientation = prepare_image(fname_file, tmpdir_file, profiler)
+        fnames_file_tmp.append(fname_file_tmp)
+        orig_orientations.append(orig_orientation)
+
+    # Create directory for nnUNet prediction
+    tmpdir_nnunet = os.path.join(tmpdir, 'nnUNet_prediction')
+    os.mkdir(tmpdir_nnunet)
+    fnames_prediction_truncated = [os.path.join(tmpdir_nnunet, f'{i_file:04d}_pred') for i_file in range(len(fnames_file))]
+
+    # Run nnUNet prediction
+    print('Starting inference...it may take a few minutes...')
+    start = time.time()
+    profiler.attach(predictor)
+    # NOTE: for individual images, the _0000 suffix is not needed.
+    # BUT, the images should be in a list of lists
     predictor.predict_from_files(
-        list_of_lists_or_source_folder=fname_file_tmp_list,
-        output_folder_or_list_of_truncated_output_files=tmpdir_nnunet,
+        list_of_lists_or_source_folder=[[fname_file_tmp] for fname_file_tmp in fnames_file_tmp],
+        output_folder_or_list_of_truncated_output_files=fnames_prediction_truncated,
         save_probabilities=False,
         overwrite=True,
-        num_processes_preprocessing=8,
-        num_processes_segmentation_export=8,
+        num_processes_preprocessing=num_processes,
+        num_processes_segmentation_export=num_processes,
         folder_with_segs_from_prev_stage=None,
         num_parts=1,
         part_id=0
     )
+    profiler.detach(predictor)
     end = time.time()
 
     print('Inference done.')
     total_time = end - start
     print('Total inference time: {} minute(s) {} seconds'.format(int(total_time // 60), int(round(total_time % 60))))
 
-    # Check if the prediction file exists
-    if not glob.glob(os.path.join(tmpdir_nnunet, '*.nii.gz')):
-        raise FileNotFoundError(f'Prediction file not found in {tmpdir_nnunet}')
-    # Copy .nii.gz file from tmpdir_nnunet to tmpdir
-    pred_file = glob.glob(os.path.join(tmpdir_nnunet, '*.nii.gz'))[0]
-    shutil.copyfile(pred_file, fname_prediction)
+    print('Re-orienting the predictions back to original orientation...')
+    for fname_prediction_truncated, orig_orientation, fname_file_out in zip(fnames_prediction_truncated,
+                                                                           orig_orientations, fnames_file_out):
+        # Check if the prediction file exists
+        fname_prediction = fname_prediction_truncated + predictor.dataset_json['file_ending']
+        if not os.path.isfile(fname_prediction):
+            raise FileNotFoundError(f'Prediction file {fname_prediction} not found in {tmpdir_nnunet}')
 
-    print('Re-orienting the prediction back to original orientation...')
-    # Reorient the image back to original orientation
-    # skip if already in RPI
-    if orig_orientation != 'RPI':
-        print(f'Reorienting to original orientation {orig_orientation}...')
-        # reorient the image to the original orientation using SCT
-        os.system('sct_image -i {} -setorient {} -o {}'.format(fname_prediction, orig_orientation, fname_prediction))
+        # Reorient the image back to original orientation
+        with profiler.stage('reorient_back'):
+            restore_orientation(fname_prediction, orig_orientation)
 
-    # Copy fname_prediction to fname_file_out
-    shutil.copyfile(fname_prediction, fname_file_out)
+        # Copy fname_prediction to fname_file_out
+        with profiler.stage('copy_output'):
+            shutil.copyfile(fname_prediction, fname_file_out)
+        print(f"Created {fname_file_out}")
 
     print('Deleting the temporary folder...')
     # Delete the temporary folder
     shutil.rmtree(tmpdir)
 
+    print('-' * 50)
+    print(f"Created {len(fnames_file_out)} segmentation(s)")
+    print('-' * 50)
+
+    return total_time
+
+
+def segment_image(predictor, fname_file, fname_file_out, profiler=None):
+    """
+    Segment a single image with an already initialized predictor
+    :param predictor: initialized nnUNetPredictor (see load_predictor)
+    :param fname_file: absolute path to the image to segment
+    :param fname_file_out: absolute path of the output segmentation
+    :param profiler: InferenceProfiler recording the stages, None to not record them
+    :return: total_time: time spent in preprocessing and prediction, in seconds
+    """
+    return segment_images(predictor, [fname_file], [fname_file_out], profiler=profiler)
+
+
+def compute_dice(fname_seg1, fname_seg2):
+    """
+    Compute the Dice coefficient between two binary segmentations
+    :param fname_seg1: path to the first segmentation
+    :param fname_seg2: path to the second segmentation
+    :return: dice: Dice coefficient, 1 if both segmentations are empty
+    """
+    seg1 = np.asanyarray(nib.load(fname_seg1).dataobj) > 0
+    seg2 = np.asanyarray(nib.load(fname_seg2).dataobj) > 0
+    total = seg1.sum() + seg2.sum()
+    if total == 0:
+        return 1.0
+    return 2 * np.logical_and(seg1, seg2).sum() / total
+
+
+def report_speedup(args, fname_file, fname_file_out, accelerated_time):
+    """
+    Segment an image with the default CPU settings and compare it to the accelerated segmentation
+    :param args: parsed arguments of the script
+    :param fname_file: absolute path to the segmented image
+    :param fname_file_out: absolute path of the accelerated segmentation
+    :param accelerated_time: inference time of the accelerated segmentation, in seconds
+    """
+    import torch
+
+    print('\nSegmenting the image with the default settings to report the speedup...')
+    # Only the intra-op threads can be changed back, torch does not allow changing the inter-op threads twice
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(args.default_num_threads)
+    predictor = load_predictor(args.path_model, use_gpu=args.use_gpu, use_best_checkpoint=args.use_best_checkpoint,
+                               tile_step_size=args.tile_step_size)
+    fname_file_out_default = add_suffix(fname_file_out, '_default')
+    segment = segment_image_in_memory if args.in_memory else segment_image
+    default_time = segment(predictor, fname_file, fname_file_out_default)
+    torch.set_num_threads(num_threads)
+
+    dice = compute_dice(fname_file_out, fname_file_out_default)
+    os.remove(fname_file_out_default)
+
+    print('-' * 50)
+    print(f'Default inference time: {default_time:.1f} seconds ({args.default_num_threads} intra-op thread(s))')
+    print(f'Accelerated inference time: {accelerated_time:.1f} seconds ({num_threads} intra-op thread(s))')
+    print(f'Speedup: {default_time / accelerated_time:.2f}x')
+    print(f'Dice between the default and accelerated segmentations: {dice:.4f}')
+    print('-' * 50)
+
+
+def get_batch_files(batch, output_folder):
+    """
+    List the images to segment in batch mode and their output filenames
+    :param batch: folder containing the images, glob pattern (e.g. 'sub-*/anat/*_T1w.nii.gz') or manifest (.txt/.csv)
+                  with one image per line, optionally followed by a comma and the output filename
+    :param output_folder: folder where the segmentations are saved when no output filename is given
+    :return: fnames_file: sorted list of absolute paths to the images to segment
+    :return: fnames_file_out: list of absolute paths of the output segmentations
+    """
+    pairs = []
+    if os.path.isdir(batch):
+        fnames = sorted(glob.glob(os.path.join(batch, '*.nii.gz')) + glob.glob(os.path.join(batch, '*.nii')))
+        pairs = [(fname, None) for fname in fnames]
+    elif os.path.isfile(batch):
+        with open(batch, 'r') as f:
+            for line in f:
+                fields = [field.strip() for field in line.split(',')]
+                if not fields[0] or fields[0].startswith('#'):
+                    continue
+                pairs.append((fields[0], fields[1] if len(fields) > 1 and fields[1] else None))
+    else:
+        pairs = [(fname, None) for fname in sorted(glob.glob(batch, recursive=True))]
+
+    if not pairs:
+        raise FileNotFoundError(f'No image to segment found with {batch}')
+
+    fnames_file, fnames_file_out = [], []
+    for fname, fname_out in pairs:
+        fnames_file.append(os.path.abspath(fname))
+        if fname_out is None:
+            fname_out = os.path.join(output_folder, splitext(os.path.basename(fname))[0] + '_seg.nii.gz')
+        fnames_file_out.append(os.path.abspath(fname_out))
+
+    return fnames_file, fnames_file_out
+
+
+def predict_nii(predictor, nii):
+    """
+    Predict the segmentation of an image already in memory
+    :param predictor: initialized nnUNetPredictor (see load_predictor)
+    :param nii: nibabel image in RPI orientation
+    :return: segmentation: uint8 array on the grid of the image
+    """
+    # nnUNet works on (channel, z, y, x) arrays with the spacing in the same order
+    data = np.asanyarray(nii.dataobj, dtype=np.float32).transpose((2, 1, 0))[None]
+    properties = {'spacing': [float(zoom) for zoom in nii.header.get_zooms()[:3][::-1]]}
+    segmentation = predictor.predict_single_npy_array(data, properties, None, None, False)
+    return segmentation.transpose((2, 1, 0)).astype(np.uint8)
+
+
+def predict_coarse(predictor, nii):
+    """
+    Predict a fast, coarse segmentation of an image with a single fold and no overlap between the patches
+    :param predictor: initialized nnUNetPredictor (see load_predictor)
+    :param nii: nibabel image in RPI orientation
+    :return: segmentation: uint8 array on the grid of the image
+    """
+    tile_step_size, list_of_parameters = predictor.tile_step_size, predictor.list_of_parameters
+    predictor.tile_step_size, predictor.list_of_parameters = 1, list_of_parameters[:1]
+    try:
+        return predict_nii(predictor, nii)
+    finally:
+        predictor.tile_step_size, predictor.list_of_parameters = tile_step_size, list_of_parameters
+
+
+def get_roi_slices(nii, roi_data, roi_affine, padding):
+    """
+    Get the box of an image containing the non-zero voxels of a ROI, which can be on another grid
+    :param nii: nibabel image to crop
+    :param roi_data: ROI array, e.g. a segmentation or a centerline
+    :param roi_affine: affine of the ROI
+    :param padding: padding added on each side of the box, in mm
+    :return: slices: tuple of 3 slices of the image, None if the ROI is empty
+    """
+    roi_voxels = np.argwhere(roi_data > 0)
+    if roi_voxels.size == 0:
+        return None
+
+    # Go through the world coordinates so that the ROI can come from another session or contrast
+    roi_to_image = np.linalg.inv(nii.affine) @ roi_affine
+    image_voxels = nib.affines.apply_affine(roi_to_image, roi_voxels)
+    padding_voxels = padding / np.asarray(nii.header.get_zooms()[:3])
+    lower = np.floor(image_voxels.min(axis=0) - padding_voxels).astype(int)
+    upper = np.ceil(image_voxels.max(axis=0) + padding_voxels).astype(int) + 1
+    lower = np.clip(lower, 0, nii.shape[:3])
+    upper = np.clip(upper, 0, nii.shape[:3])
+    if np.any(upper <= lower):
+        return None
+    return tuple(slice(start, stop) for start, stop in zip(lower, upper))
+
+
+def segment_image_in_memory(predictor, fname_file, fname_file_out, roi=None, roi_padding=25, profiler=None):
+    """
+    Segment a single image with an already initialized predictor, without temporary files or sct_image calls. The
+    image is reoriented to RPI in memory, predicted as a NumPy array and the prediction is reoriented back to the
+    original orientation before being written once.
+    :param predictor: initialized nnUNetPredictor (see load_predictor)
+    :param fname_file: absolute path to the image to segment
+    :param fname_file_out: absolute path of the output segmentation
+    :param roi: only segment a box around the spinal cord found in this segmentation or centerline, or with a coarse
+                prediction if 'coarse'. None to segment the whole image.
+    :param roi_padding: padding added around the spinal cord on each side of the box, in mm
+    :param profiler: InferenceProfiler recording the stages, None to not record them
+    :return: total_time: time spent in preprocessing and prediction, in seconds
+    """
+    profiler = profiler if profiler is not None else InferenceProfiler()
+    print(f'\nFound {fname_file} file.')
+
+    # The arrays are given to the predictor as NibabelIO/SimpleITKIO would read them. Readers that reorient the image
+    # themselves can not be reproduced here.
+    reader_name = predictor.plans_manager.image_reader_writer_class.__name__
+    if reader_name.endswith('WithReorient'):
+        raise ValueError(f'The model uses the {reader_name} reader, which is not supported with -in-memory.')
+
+    with profiler.stage('load'):
+        nii_file = nib.load(fname_file)
+        # Read the data once, in this stage, and work on the array in memory: the next stages (reorientation,
+        # prediction) would otherwise read the file again, decompressing a .nii.gz a second time
+        nii = nib.Nifti1Image(nii_file.get_fdata(dtype=np.float32), nii_file.affine, nii_file.header)
+    with profiler.stage('orientation_query'):
+        orig_orientation = get_orientation_from_header(nii)
+
+    # Reorient the image to RPI orientation if not already in RPI
+    if orig_orientation != 'RPI':
+        print(f'Reorienting from {orig_orientation} to RPI orientation...')
+        with profiler.stage('reorient'):
+            nii = nii.as_reoriented(get_orientation_transform(orig_orientation, 'RPI'))
+
+    # Run nnUNet prediction
+    print('Starting inference...it may take a few minutes...')
+    start = time.time()
+    profiler.attach(predictor)
+    roi_slices = None
+    if roi == 'coarse':
+        print('Locating the spinal cord with a coarse prediction...')
+        roi_slices = get_roi_slices(nii, predict_coarse(predictor, nii), nii.affine, roi_padding)
+    elif roi is not None:
+        nii_roi = nib.load(roi)
+        roi_slices = get_roi_slices(nii, np.asanyarray(nii_roi.dataobj), nii_roi.affine, roi_padding)
+
+    if roi is not None and roi_slices is None:
+        print('The spinal cord was not found in the ROI, segmenting the whole image.')
+    if roi_slices is None:
+        segmentation = predict_nii(predictor, nii)
+    else:
+        nii_crop = nii.slicer[roi_slices]
+        print(f'Segmenting a {nii_crop.shape[:3]} box around the spinal cord '
+              f'({np.prod(nii_crop.shape[:3]) / np.prod(nii.shape[:3]):.0%} of the image)...')
+        # Paste the prediction of the box back into the grid of the image
+        segmentation = np.zeros(nii.shape[:3], dtype=np.uint8)
+        segmentation[roi_slices] = predict_nii(predictor, nii_crop)
+    profiler.detach(predictor)
+    end = time.time()
+
+    print('Inference done.')
+    total_time = end - start
+    print('Total inference time: {} minute(s) {} seconds'.format(int(total_time // 60), int(round(total_time % 60))))
+
+    nii_pred = nib.Nifti1Image(segmentation, nii.affine, nii.header)
+    nii_pred.set_data_dtype(np.uint8)
+
+    # Reorient the prediction back to original orientation, skip if already in RPI
+    if orig_orientation != 'RPI':
+        print(f'Reorienting the prediction back to original orientation {orig_orientation}...')
+        with profiler.stage('reorient_back'):
+            nii_pred = nii_pred.as_reoriented(get_orientation_transform('RPI', orig_orientation))
+
+    with profiler.stage('write'):
+        nib.save(nii_pred, fname_file_out)
+
     print('-' * 50)
     print(f"Created {fname_file_out}")
     print('-' * 50)
 
+    return total_time
+
+
+class SegmentationRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handle one segmentation request sent to the inference server.
+    Requests and responses are single JSON lines, e.g. {"i": "/abs/in.nii.gz", "o": "/abs/out.nii.gz"}
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            segment = segment_image_in_memory if self.server.in_memory else segment_image
+            total_time = segment(self.server.predictor, request['i'], request['o'])
+            response = {'status': 'ok', 'output': request['o'], 'time': total_time}
+        except Exception as e:
+            # Keep the server alive, the error is reported to the client
+            print(f'Request failed: {e}')
+            response = {'status': 'error', 'message': f'{type(e).__name__}: {e}'}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class SegmentationServer(socketserver.UnixStreamServer):
+    """
+    Unix socket server holding an initialized nnUNetPredictor. Requests are handled one at a time since the predictor
+    (and the GPU) is shared.
+    """
+
+    def __init__(self, socket_path, predictor, in_memory=False):
+        self.predictor = predictor
+        self.in_memory = in_memory
+        super().__init__(socket_path, SegmentationRequestHandler)
+
+
+def serve(predictor, socket_path, in_memory=False):
+    """
+    Serve segmentation requests on a Unix socket until interrupted
+    :param predictor: initialized nnUNetPredictor
+    :param socket_path: path of the Unix socket
+    :param in_memory: segment the requests with segment_image_in_memory instead of segment_image
+    """
+    if os.path.exists(socket_path):
+        # A leftover socket from a server that was not shut down cleanly
+        os.remove(socket_path)
+
+    with SegmentationServer(socket_path, predictor, in_memory=in_memory) as server:
+        print(f'Inference server listening on {socket_path}. Press Ctrl+C to stop.')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print('\nStopping the inference server...')
+        finally:
+            os.remove(socket_path)
+
+
+def request_segmentation(socket_path, fname_file, fname_file_out):
+    """
+    Send a segmentation request to a running inference server and wait for the result
+    :param socket_path: path of the Unix socket of the server
+    :param fname_file: absolute path to the image to segment
+    :param fname_file_out: absolute path of the output segmentation
+    :return: response: dict sent back by the server
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise ConnectionError(f'No inference server found on {socket_path}. Start one with -serve.')
+        sock.sendall((json.dumps({'i': fname_file, 'o': fname_file_out}) + '\n').encode('utf-8'))
+        response = json.loads(sock.makefile('r', encoding='utf-8').readline())
+
+    if response['status'] != 'ok':
+        raise RuntimeError(f'Inference server failed to segment {fname_file}: {response["message"]}')
+    return response
+
+
+def get_cache_settings(args):
+    """
+    Describe the inference settings that can change the segmentation, for the segmentation cache key
+    :param args: parsed arguments of the script
+    :return: settings: string of the settings, e.g. "tile_step_size=0.5|in_memory=True|device=cuda|bf16=False|..."
+    """
+    # The inference path, the device and the acceleration options change the numerics of the prediction, and the
+    # ROI crop changes the input of the network, so segmentations obtained with different options are not shared
+    # The device actually used, since -use-gpu falls back to the CPU when no GPU is found
+    device = str(get_device(args.use_gpu))
+    settings = (f'tile_step_size={args.tile_step_size}|in_memory={args.in_memory}|device={device}'
+                f'|bf16={args.bf16}|compile={args.compile}|channels_last={args.channels_last}')
+    if args.roi is not None:
+        settings += f'|roi={args.roi if args.roi == "coarse" else hash_image(args.roi)}|roi_padding={args.roi_padding}'
+    return settings
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    if args.serve and args.client:
+        parser.error('-serve and -client cannot be used together.')
+    if args.serve and args.batch is not None:
+        parser.error('-serve and -batch cannot be used together.')
+    if not args.serve and ((args.i is None and args.batch is None) or args.o is None):
+        parser.error('-i (or -batch) and -o are required unless -serve is used.')
+    if not args.client and args.path_model is None:
+        parser.error('-path-model is required unless -client is used.')
+    if args.i is not None and args.batch is not None:
+        parser.error('-i and -batch cannot be used together.')
+    if not 0 <= args.part_id < args.num_parts:
+        parser.error('-part-id must be between 0 and -num-parts - 1.')
+
+    if args.report_speedup and (args.serve or args.client or args.batch is not None):
+        parser.error('-report-speedup can only be used with -i.')
+    if args.roi is not None and not args.in_memory:
+        parser.error('-roi requires -in-memory.')
+    if args.roi is not None and (args.serve or args.client):
+        parser.error('-roi can not be used with -serve or -client.')
+    if args.roi not in (None, 'coarse') and args.batch is not None:
+        parser.error('A ROI file can only be used with -i, use "-roi coarse" with -batch.')
+    if args.cache_dir is not None and (args.serve or args.client):
+        parser.error('-cache-dir can not be used with -serve or -client.')
+    if args.profile is not None and (args.serve or args.client):
+        parser.error('-profile can not be used with -serve or -client.')
+
+    if not args.client:
+        import torch
+        # Keep the torch default to compare against it with -report-speedup
+        args.default_num_threads = torch.get_num_threads()
+        set_cpu_threads(args.num_threads, args.num_interop_threads)
+
+    if args.serve:
+        predictor = load_predictor(args.path_model, use_gpu=args.use_gpu,
+                                   use_best_checkpoint=args.use_best_checkpoint, tile_step_size=args.tile_step_size)
+        accelerate_network(predictor, bf16=args.bf16, compile_network=args.compile, channels_last=args.channels_last)
+        serve(predictor, args.socket, in_memory=args.in_memory)
+        return
+
+    if args.batch is not None:
+        fnames_file, fnames_file_out = get_batch_files(args.batch, os.path.abspath(args.o))
+        # Same split as nnUNet's num_parts/part_id, done here so that each part only prepares its own images
+        fnames_file = fnames_file[args.part_id::args.num_parts]
+        fnames_file_out = fnames_file_out[args.part_id::args.num_parts]
+        print(f'Segmenting {len(fnames_file)} image(s) (part {args.part_id + 1}/{args.num_parts}).')
+        if not fnames_file:
+            print('No image to segment in this part.')
+            return
+        os.makedirs(os.path.abspath(args.o), exist_ok=True)
+    else:
+        # Note: we use os.path.abspath to resolve relative paths
+        fnames_file, fnames_file_out = [os.path.abspath(args.i)], [os.path.abspath(args.o)]
+
+    if args.client:
+        # The server does not share our working directory, hence the absolute paths
+        for fname_file, fname_file_out in zip(fnames_file, fnames_file_out):
+            start = time.time()
+            request_segmentation(args.socket, fname_file, fname_file_out)
+            total_time = time.time() - start
+            print(f"Created {fname_file_out} in {total_time:.1f} seconds.")
+        return
+
+    if args.cache_dir is not None:
+        checkpoint_name = 'checkpoint_final.pth' if not args.use_best_checkpoint else 'checkpoint_best.pth'
+        settings = get_cache_settings(args)
+        keys = [get_cache_key(fname_file, args.path_model, checkpoint_name, settings) for fname_file in fnames_file]
+        misses = [(fname_file, fname_file_out, key) for fname_file, fname_file_out, key
+                  in zip(fnames_file, fnames_file_out, keys) if not cache_get(args.cache_dir, key, fname_file_out)]
+        print(f'{len(fnames_file) - len(misses)} segmentation(s) found in the cache {args.cache_dir}')
+        if not misses:
+            if args.report_speedup:
+                print('No inference was run since the segmentation was found in the cache, the speedup is not '
+                      'reported. Run without -cache-dir to report it.')
+            return
+        fnames_file, fnames_file_out, keys = map(list, zip(*misses))
+
+    profiler = InferenceProfiler()
+    with profiler.stage('model_init'):
+        predictor = load_predictor(args.path_model, use_gpu=args.use_gpu, use_best_checkpoint=args.use_best_checkpoint,
+                                   tile_step_size=args.tile_step_size)
+        accelerate_network(predictor, bf16=args.bf16, compile_network=args.compile, channels_last=args.channels_last)
+
+    if args.in_memory:
+        # The arrays are predicted one after the other to keep a single image in memory
+        total_time = 0
+        for fname_file, fname_file_out in zip(fnames_file, fnames_file_out):
+            total_time += segment_image_in_memory(predictor, fname_file, fname_file_out, roi=args.roi,
+                                                  roi_padding=args.roi_padding, profiler=profiler)
+    else:
+        total_time = segment_images(predictor, fnames_file, fnames_file_out, num_processes=args.num_processes,
+                                    profiler=profiler)
+
+    if args.profile is not None:
+        import torch
+        profiler.write(args.profile, images=fnames_file, device=str(predictor.device),
+                       num_threads=torch.get_num_threads(), in_memory=args.in_memory,
+                       num_processes=None if args.in_memory else args.num_processes,
+                       tile_step_size=args.tile_step_size, bf16=args.bf16, compile=args.compile,
+                       channels_last=args.channels_last, roi=args.roi)
+        print(f'Profile of the stages appended to {args.profile}')
+
+    if args.cache_dir is not None:
+        for fname_file_out, key in zip(fnames_file_out, keys):
+            cache_put(args.cache_dir, key, fname_file_out, args.cache_size_mb)
+
+    if args.report_speedup:
+        report_speedup(args, fnames_file[0], fnames_file_out[0], total_time)
+
 
 if __name__ == '__main__':
     main()
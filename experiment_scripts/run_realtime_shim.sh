@@ -23,7 +23,8 @@
 # 3. The size of the binary mask
 # 3. The center of the binary mask
 # 4. The width of the blur zone. Must be a multiple of 3.
-# 5. Skip the creation/verification of masks and fieldmap if they already exist (0 for no, 1 for yes)
+# 5. Skip the stages (conversion, masks, fieldmap, shims) whose inputs and parameters did not change since their last run
+#    (0 for no, 1 for yes)
 
 # Outputs:
 # - Directory with the nifti files (sub-<subject_name>)
@@ -57,17 +58,22 @@ SCRIPT_DIR=$(dirname "$(realpath "$0")")
 OUTPUT_PATH="${DICOMS_PATH%/*}/sub-$SUBJECT_NAME/"
 SORTED_DICOMS_PATH="${DICOMS_PATH%/*}/sorted_dicoms_opt/"
 
-# Check if the sorted dicoms and nifti conversion have already been done
-if [ $VERIFICATION == 1 ] && [ -d "$OUTPUT_PATH" ]; then
-    echo -e "\nDicoms already sorted and converted to nifti. Skipping these steps..."
-else
-    # Sorting dicoms
-    echo -e "\nSorting dicoms..."
-    st_sort_dicoms -i $DICOMS_PATH -o $SORTED_DICOMS_PATH -r
-    # Dicoms to nifti
-    echo -e "\nConverting dicoms to nifti..."
-    st_dicom_to_nifti -i $SORTED_DICOMS_PATH --subject $SUBJECT_NAME -o $OUTPUT_PATH
+# Each stage is only run again if its inputs or its parameters changed since its last run (see stage_manifest.py).
+# Without verification, all the stages are run.
+MANIFEST_DIR="${OUTPUT_PATH}derivatives/manifests"
+FORCE=""
+if [ $VERIFICATION != 1 ]; then
+    FORCE="-force"
 fi
+run_stage() {
+    python "${SCRIPT_DIR}/stage_manifest.py" -manifest-dir "$MANIFEST_DIR" $FORCE "$@"
+}
+
+# Sorting dicoms and converting them to nifti. The respiratory trace is in the sourcedata folder of the conversion.
+echo -e "\nSorting dicoms and converting them to nifti..."
+run_stage -name dicom_to_nifti -inputs "$DICOMS_PATH" -outputs "${OUTPUT_PATH}sub-${SUBJECT_NAME}" "${OUTPUT_PATH}sourcedata" \
+    -- bash -c 'st_sort_dicoms -i "$1" -o "$2" -r && st_dicom_to_nifti -i "$2" --subject "$3" -o "$4"' \
+    _ "$DICOMS_PATH" "$SORTED_DICOMS_PATH" "$SUBJECT_NAME" "$OUTPUT_PATH" || exit
 
 # Set ohter file paths
 RESP_PATH=$(find "${OUTPUT_PATH}sourcedata" -name "*.resp")
@@ -94,38 +100,24 @@ FNAME_BIN_MASK="${MASK_DIR}/bin_mask.nii.gz"
 FNAME_SOFT_MASK="${MASK_DIR}/soft_mask.nii.gz"
 FNAME_BIN_MASK_FM="${MASK_DIR}/bin_mask_fm.nii.gz"
 
-# Check if paths exist and skipping the creation of the masks if they do
-if [ $VERIFICATION == 1 ] && [ -f "$FNAME_SEGMENTATION" ]; then
-    echo -e "\nSegmentation mask already exists. Skipping creation..."
-else
-    echo -e "\nCreating segmentation from magnitude image..."
-    st_mask box -i "${ANAT_PATH}" \
+# Create the masks, each one only if the image, the mask it is created from or its parameters changed
+echo -e "\nCreating segmentation from magnitude image..."
+run_stage -name segmentation -inputs "${ANAT_PATH}" -outputs "${FNAME_SEGMENTATION}" \
+    -- st_mask box -i "${ANAT_PATH}" \
         --size ${SIZE_ARR[0]} ${SIZE_ARR[1]} ${SIZE_ARR[2]} \
         --center ${CENTER_ARR[0]} ${CENTER_ARR[1]} ${CENTER_ARR[2]} \
         -o "${FNAME_SEGMENTATION}" || exit
-fi
-
-if [ $VERIFICATION == 1 ] && [ -f "$FNAME_BIN_MASK" ]; then
-    echo -e "\nBinary mask already exists. Skipping creation..."
-else
-    echo -e "\nCreating binary mask from segmentation..."
-    st_mask softmask -i "${FNAME_SEGMENTATION}" -o "${FNAME_BIN_MASK}" -t '2levels' -w "$BLUR_WIDTH" -u 'mm' -b 1 || exit
-fi
 
-if [ $VERIFICATION == 1 ] && [ -f "$FNAME_SOFT_MASK" ]; then
-    echo -e "\nsoft mask already exists. Skipping creation..."
-else
-    echo -e "\nCreating soft mask from segmentation..."
-    st_mask softmask -i "${FNAME_SEGMENTATION}" -o "${FNAME_SOFT_MASK}" -t '2levels' -w $BLUR_WIDTH -u 'mm' -b 0.1 || exit
-fi
-
-if [ $VERIFICATION == 1 ] && [ -f "$FNAME_BIN_MASK_FM" ]; then
-    echo -e "\nBinary mask for fieldmap already exists. Skipping creation..."
-else
-    echo -e "\nCreating binary mask for fieldmap from binary mask..."
-    st_mask softmask -i "${FNAME_BIN_MASK}" -o "${FNAME_BIN_MASK_FM}" -t '2levels' -w "$BLUR_WIDTH" -u 'mm' -b 1 || exit
+# The binary mask and the soft mask are created by st_mask softmask in a single process (see softmask_batch.py)
+echo -e "\nCreating binary mask and soft mask from segmentation..."
+run_stage -name masks -inputs "${FNAME_SEGMENTATION}" -outputs "${FNAME_BIN_MASK}" "${FNAME_SOFT_MASK}" \
+    -- python "${SCRIPT_DIR}/softmask_batch.py" -i "${FNAME_SEGMENTATION}" -w "$BLUR_WIDTH" -u 'mm' \
+        -o 2levels:1 "${FNAME_BIN_MASK}" \
+        -o 2levels:0.1 "${FNAME_SOFT_MASK}" || exit
 
-fi
+echo -e "\nCreating binary mask for fieldmap from binary mask..."
+run_stage -name bin_mask_fm -inputs "${FNAME_BIN_MASK}" -outputs "${FNAME_BIN_MASK_FM}" \
+    -- st_mask softmask -i "${FNAME_BIN_MASK}" -o "${FNAME_BIN_MASK_FM}" -t '2levels' -w "$BLUR_WIDTH" -u 'mm' -b 1 || exit
 
 echo -e "\nAll masks checked and created successfully."
 
@@ -160,20 +152,17 @@ esac
 FIELDMAP_PATH="${OUTPUT_PATH}derivatives/fmap/fieldmap.nii.gz"
 FIELDMAP_JSON_PATH="${OUTPUT_PATH}derivatives/fmap/fieldmap.json"
 
-# Check if the fieldmap already exists and skip the creation if it does
-if [ $VERIFICATION == 1 ] && [ -f "$FIELDMAP_PATH" ] && [ -f "$FIELDMAP_JSON_PATH" ]; then
-    echo -e "\nFieldmap already exists. Skipping fieldmap creation..."
-else
-    # Create fieldmap
-    echo -e "\nCreating fieldmap..."
-    st_prepare_fieldmap $PHASE1_PATH $PHASE2_PATH \
+# Create fieldmap
+echo -e "\nCreating fieldmap..."
+run_stage -name fieldmap -inputs "$PHASE1_PATH" "$PHASE2_PATH" "$MAGNITUDE_PATH" "$FNAME_BIN_MASK_FM" \
+    -outputs "$FIELDMAP_PATH" "$FIELDMAP_JSON_PATH" \
+    -- st_prepare_fieldmap $PHASE1_PATH $PHASE2_PATH \
      --mag $MAGNITUDE_PATH \
      --unwrapper prelude \
      --gaussian-filter true \
      --mask $FNAME_BIN_MASK_FM \
      --sigma 1 \
-     -o $FIELDMAP_PATH
-fi
+     -o $FIELDMAP_PATH || exit
 
 # Show fieldmap with magnitude
 echo -e "\nDisplaying fieldmap with magnitude image..."
@@ -210,7 +199,8 @@ fi
 # Run the shim for the binary masks
 OUTPUT_DIR="${OPTI_OUTPUT_DIR}/dynamic_shim_binary_masks"
 echo -e "\nShimming the fieldmap with binary masks..."
-st_b0shim realtime-dynamic \
+run_stage -name shim_binary_masks -inputs "$FIELDMAP_PATH" "$ANAT_PATH" "$FNAME_BIN_MASK" "$RESP_PATH" -outputs "$OUTPUT_DIR" \
+    -- st_b0shim realtime-dynamic \
     --scanner-coil-order 0,1 \
     --scanner-coil-order-riro 0,1 \
     --fmap $FIELDMAP_PATH \
@@ -227,12 +217,13 @@ st_b0shim realtime-dynamic \
     --fatsat "yes" \
     --regularization-factor 0.3 \
     --output "$OUTPUT_DIR" \
-    --verbose 'debug'
+    --verbose 'debug' || exit
 
 # Run the shim for the soft masks
 OUTPUT_DIR="${OPTI_OUTPUT_DIR}/dynamic_shim_soft_masks"
 echo -e "\nShimming the fieldmap with soft masks..."
-st_b0shim realtime-dynamic \
+run_stage -name shim_soft_masks -inputs "$FIELDMAP_PATH" "$ANAT_PATH" "$FNAME_SOFT_MASK" "$RESP_PATH" -outputs "$OUTPUT_DIR" \
+    -- st_b0shim realtime-dynamic \
     --scanner-coil-order 0,1 \
     --scanner-coil-order-riro 0,1 \
     --fmap $FIELDMAP_PATH \
@@ -249,7 +240,7 @@ st_b0shim realtime-dynamic \
     --fatsat "yes" \
     --regularization-factor 0.3 \
     --output "$OUTPUT_DIR" \
-    --verbose 'debug'
+    --verbose 'debug' || exit
 
 # Remove the sorted dicoms folder if necessary
 if [ -d "$SORTED_DICOMS_PATH" ]; then
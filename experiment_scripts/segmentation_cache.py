@@ -0,0 +1,205 @@
+"""
+Content-addressed cache for spinal cord segmentations.
+
+A segmentation is stored under a key computed from the voxel data and the affine of the segmented image, the model
+(folder and checkpoint, or name of the SCT model) and the inference settings. A new session on the same image with the
+same model and settings returns the stored segmentation without running the inference, and a modified image can never
+reuse an old segmentation. The cache is bounded in size: the least recently used segmentations are removed first.
+
+The script wraps the segmentation command of the experiment scripts. The command after "--" is only run if the
+segmentation is not in the cache, and its output (-o) is then added to the cache.
+
+Example usage:
+    python segmentation_cache.py
+        -i sub-001_T1w.nii.gz
+        -o segmentation.nii.gz
+        -model sct_deepseg_sc
+        -settings c=t1
+        -- sct_deepseg_sc -i sub-001_T1w.nii.gz -o segmentation.nii.gz -c t1
+"""
+
+import argparse
+import glob
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'sciseg_segmentations')
+DEFAULT_CACHE_SIZE_MB = 2048
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Run a segmentation command only if its result is not already in '
+                                                 'the segmentation cache.')
+    parser.add_argument('-i', required=True, type=str, help='Image to segment.')
+    parser.add_argument('-o', required=True, type=str, help='Output segmentation written by the command.')
+    parser.add_argument('-model', required=True, type=str,
+                        help='Model used by the command: a nnUNet model folder (see -checkpoint) or the name of the '
+                             'model, e.g. sct_deepseg_sc.')
+    parser.add_argument('-checkpoint', default='checkpoint_final.pth', type=str,
+                        help='Checkpoint name when -model is a nnUNet model folder. Default: checkpoint_final.pth')
+    parser.add_argument('-settings', default='', type=str,
+                        help='Inference settings that change the segmentation, e.g. "c=t1". Default: ""')
+    parser.add_argument('-cache-dir', default=DEFAULT_CACHE_DIR, type=str,
+                        help=f'Cache folder. Default: {DEFAULT_CACHE_DIR}')
+    parser.add_argument('-cache-size-mb', default=DEFAULT_CACHE_SIZE_MB, type=float,
+                        help=f'Maximum size of the cache in MB. Default: {DEFAULT_CACHE_SIZE_MB}')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='Segmentation command to run on a cache miss, after "--".')
+
+    return parser
+
+
+def hash_image(fname_image):
+    """
+    Hash the voxel data and the geometry of an image. The file itself is not hashed since the same image can be
+    written with different headers or gzip timestamps.
+    :param fname_image: path to the image
+    :return: digest: hexadecimal SHA-256 digest
+    """
+    nii = nib.load(fname_image)
+    data = np.ascontiguousarray(np.asanyarray(nii.dataobj))
+    sha = hashlib.sha256()
+    sha.update(str((data.dtype.str, data.shape)).encode('utf-8'))
+    sha.update(data.tobytes())
+    sha.update(np.asarray(nii.affine, dtype=np.float64).tobytes())
+    return sha.hexdigest()
+
+
+def hash_model(model, checkpoint_name='checkpoint_final.pth'):
+    """
+    Identify a model. For a nnUNet model folder, the size and modification time of the checkpoint of every fold are
+    included so that a retrained model does not reuse the old segmentations.
+    :param model: nnUNet model folder or name of the model
+    :param checkpoint_name: checkpoint used in each fold_* folder
+    :return: model_id: string identifying the model
+    """
+    if not os.path.isdir(model):
+        return model
+
+    model_id = [os.path.abspath(model), checkpoint_name]
+    for fname_checkpoint in sorted(glob.glob(os.path.join(model, 'fold_*', checkpoint_name))):
+        stat = os.stat(fname_checkpoint)
+        model_id.append(f'{os.path.relpath(fname_checkpoint, model)}:{stat.st_size}:{stat.st_mtime_ns}')
+    return '|'.join(model_id)
+
+
+def get_cache_key(fname_image, model, checkpoint_name='checkpoint_final.pth', settings=''):
+    """
+    Compute the cache key of a segmentation
+    :param fname_image: path to the segmented image
+    :param model: nnUNet model folder or name of the model
+    :param checkpoint_name: checkpoint used in each fold_* folder
+    :param settings: inference settings that change the segmentation
+    :return: key: hexadecimal SHA-256 digest
+    """
+    sha = hashlib.sha256()
+    for part in (hash_image(fname_image), hash_model(model, checkpoint_name), settings):
+        sha.update(part.encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def get_extension(fname):
+    """
+    Get the extension of a NIfTI file, .nii.gz included
+    :param fname: path to the file
+    :return: extension: e.g. .nii.gz or .nii
+    """
+    return '.nii.gz' if fname.endswith('.nii.gz') else os.path.splitext(fname)[1]
+
+
+def cache_get(cache_dir, key, fname_out):
+    """
+    Copy a cached segmentation to the output file
+    :param cache_dir: cache folder
+    :param key: cache key (see get_cache_key)
+    :param fname_out: path of the output segmentation
+    :return: hit: True if the segmentation was in the cache
+    """
+    fname_cached = os.path.join(cache_dir, key + get_extension(fname_out))
+    if not os.path.isfile(fname_cached):
+        return False
+    shutil.copyfile(fname_cached, fname_out)
+    # The modification time of the cached file is its last use for the LRU eviction
+    os.utime(fname_cached)
+    return True
+
+
+def cache_put(cache_dir, key, fname_seg, max_size_mb=DEFAULT_CACHE_SIZE_MB):
+    """
+    Add a segmentation to the cache and evict the least recently used segmentations if the cache is too large
+    :param cache_dir: cache folder
+    :param key: cache key (see get_cache_key)
+    :param fname_seg: path to the segmentation
+    :param max_size_mb: maximum size of the cache in MB
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Copy then rename so that a concurrent session never reads a partially written file
+    fd, fname_tmp = tempfile.mkstemp(prefix='tmp', dir=cache_dir)
+    os.close(fd)
+    shutil.copyfile(fname_seg, fname_tmp)
+    os.replace(fname_tmp, os.path.join(cache_dir, key + get_extension(fname_seg)))
+
+    evict(cache_dir, max_size_mb)
+
+
+def evict(cache_dir, max_size_mb):
+    """
+    Remove the least recently used segmentations until the cache fits in its maximum size
+    :param cache_dir: cache folder
+    :param max_size_mb: maximum size of the cache in MB
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        # Files being added by another session start with tmp
+        if entry.is_file() and not entry.name.startswith('tmp'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size_mb * 1024 ** 2:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Already evicted by another session
+            pass
+        total_size -= size
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command and args.command[0] == '--' else args.command
+    if not command:
+        parser.error('A segmentation command must be given after "--".')
+
+    key = get_cache_key(args.i, args.model, args.checkpoint, args.settings)
+    if cache_get(args.cache_dir, key, args.o):
+        print(f'Segmentation found in the cache ({key[:12]}). Copied to {args.o}')
+        return
+
+    print(f'Segmentation not in the cache ({key[:12]}). Running: {" ".join(command)}')
+    returncode = subprocess.run(command).returncode
+    if returncode != 0:
+        sys.exit(returncode)
+    if not os.path.isfile(args.o):
+        raise FileNotFoundError(f'The segmentation command did not create {args.o}')
+
+    cache_put(args.cache_dir, key, args.o, args.cache_size_mb)
+    print(f'Segmentation added to the cache ({key[:12]}).')
+
+
+if __name__ == '__main__':
+    main()
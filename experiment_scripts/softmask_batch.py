@@ -0,0 +1,99 @@
+"""
+This script creates several softmasks of the same mask with st_mask softmask, in a single process.
+
+The experiment scripts used to call st_mask softmask once per softmask type and per weight, and each call started a new
+Python process that imported shimmingtoolbox again. Here, the st_mask command of shimmingtoolbox is loaded once and
+called for every variant in the same process, with the arguments of the experiment scripts (-t <type> -w <width>
+-u <unit>, and -b <weight>), so the masks are the ones of st_mask softmask. If the st_mask command can not be loaded in
+the process, each variant is created by a st_mask call, as before.
+
+A variant is the softmask type of st_mask softmask, followed by ":<weight>" for the weight of the blur region, e.g.
+2levels:0.1.
+
+Example usage:
+    python softmask_batch.py -i segmentation.nii.gz -w 6 -u mm
+        -o 2levels:0.5 st_soft_mask_2lvls.nii.gz
+        -o linear st_soft_mask_linear.nii.gz
+        -o gaussian st_soft_mask_gauss.nii.gz
+"""
+
+import argparse
+import subprocess
+import time
+from importlib.metadata import entry_points
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Create several softmasks of a mask with st_mask softmask, in a '
+                                                 'single process.')
+    parser.add_argument('-i', required=True, type=str, help='Binary mask, e.g. the spinal cord segmentation.')
+    parser.add_argument('-o', nargs=2, action='append', required=True, metavar=('VARIANT', 'OUTPUT'),
+                        help='Variant to create and its output file. The variant is a softmask type of st_mask '
+                             'softmask, followed by ":<weight>" for the weight of the blur region, e.g. '
+                             '"-o 2levels:0.1 st_soft_mask_pond_1e-1.nii.gz". Can be repeated.')
+    parser.add_argument('-w', required=True, type=str, help='Width of the blur region, given to st_mask softmask.')
+    parser.add_argument('-u', default='vox', choices=['mm', 'vox'], help='Unit of the blur width. Default: vox')
+
+    return parser
+
+
+def get_softmask_args(fname_mask, fname_output, variant, width, unit):
+    """
+    Build the arguments of st_mask for a variant
+    :param fname_mask: path to the binary mask
+    :param fname_output: path of the softmask
+    :param variant: softmask type, followed by ":<weight>" for the weight of the blur region, e.g. 2levels:0.1
+    :param width: width of the blur region, as given to st_mask
+    :param unit: unit of the width, mm or vox
+    :return: args: arguments of st_mask, starting with the softmask subcommand
+    """
+    softmask_type, _, weight = variant.partition(':')
+    args = ['softmask', '-i', fname_mask, '-o', fname_output, '-t', softmask_type, '-w', width, '-u', unit]
+    if weight:
+        args += ['-b', weight]
+    return args
+
+
+def load_st_mask():
+    """
+    Load the st_mask command of shimmingtoolbox in this process
+    :return: st_mask: click command of st_mask, None if it can not be loaded
+    """
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        eps = list(eps.select(group='console_scripts', name='st_mask'))
+    else:
+        eps = [ep for ep in eps.get('console_scripts', []) if ep.name == 'st_mask']
+    if not eps:
+        return None
+    try:
+        st_mask = eps[0].load()
+    except Exception as e:
+        print(f"Could not load st_mask in this process ({e})")
+        return None
+    return st_mask if hasattr(st_mask, 'main') else None
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    start = time.time()
+    st_mask = load_st_mask()
+    if st_mask is None:
+        print("Creating each softmask with a st_mask call")
+    for variant, fname_output in args.o:
+        st_args = get_softmask_args(args.i, fname_output, variant, args.w, args.u)
+        if st_mask is None:
+            subprocess.run(['st_mask'] + st_args, check=True)
+        else:
+            # standalone_mode=False: the errors are raised instead of exiting, and the next variants are not created
+            st_mask.main(args=st_args, prog_name='st_mask', standalone_mode=False)
+        print(f"{variant} softmask saved in {fname_output}")
+
+    print(f"{len(args.o)} softmask(s) created in {time.time() - start:.2f} seconds")
+
+
+if __name__ == '__main__':
+    main()
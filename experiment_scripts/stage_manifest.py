@@ -0,0 +1,216 @@
+"""
+Incremental execution of the stages of the experiment scripts, in the style of make.
+
+A stage is a command with input files or folders and output files or folders. When a stage is run, a manifest is saved
+with the command, the parameters and the hash of every input. The next time, the command is only run again if the
+command or the parameters changed, if the content of an input changed or if an output is missing. NIfTI files are
+hashed on their voxel data and affine (see segmentation_cache.py) so that a rewritten but identical image does not
+rebuild the stages that use it. The hash of a file is kept in the manifest with its size and modification time and is
+only computed again when these change, so checking a stage whose inputs did not change does not read them.
+
+Since the outputs of a stage are the inputs of the next ones, changing one parameter (e.g. the blur width of a
+softmask) only runs the stages that depend on it.
+
+Example usage:
+    python stage_manifest.py
+        -name softmask_linear
+        -manifest-dir sub-001/derivatives/manifests
+        -inputs segmentation.nii.gz
+        -outputs st_soft_mask_linear.nii.gz
+        -- st_mask softmask -i segmentation.nii.gz -o st_soft_mask_linear.nii.gz -t linear -w 6 -u mm
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from segmentation_cache import hash_image
+
+MANIFEST_VERSION = 1
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Run the command of a stage only if its inputs, its command or its '
+                                                 'parameters changed since its last run, or if an output is missing.')
+    parser.add_argument('-name', required=True, type=str, help='Name of the stage, unique in the manifest folder.')
+    parser.add_argument('-manifest-dir', required=True, type=str, help='Folder of the manifests of the stages.')
+    parser.add_argument('-inputs', nargs='+', default=[], type=str, help='Input files or folders of the stage.')
+    parser.add_argument('-outputs', nargs='+', required=True, type=str,
+                        help='Output files or folders created by the command.')
+    parser.add_argument('-params', default='', type=str,
+                        help='Parameters that change the outputs and are not in the command. Default: ""')
+    parser.add_argument('-force', action='store_true', help='Run the command even if the stage is up to date.')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='Command of the stage, after "--".')
+
+    return parser
+
+
+def is_nifti(fname):
+    return fname.endswith('.nii') or fname.endswith('.nii.gz')
+
+
+def hash_file(fname, file_hashes):
+    """
+    Hash the content of a file, reusing the previous hash if its size and modification time did not change
+    :param fname: path to the file
+    :param file_hashes: dict of the previous hashes {path: [size, mtime_ns, digest]}, updated with the new hash
+    :return: digest: hexadecimal SHA-256 digest
+    """
+    stat = os.stat(fname)
+    previous = file_hashes.get(fname)
+    if previous is not None and previous[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return previous[2]
+
+    if is_nifti(fname):
+        digest = hash_image(fname)
+    else:
+        sha = hashlib.sha256()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1024 ** 2), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+    file_hashes[fname] = [stat.st_size, stat.st_mtime_ns, digest]
+    return digest
+
+
+def hash_input(path, file_hashes):
+    """
+    Hash an input of a stage. A folder is hashed on the relative paths and the hashes of all its files.
+    :param path: path to the input file or folder
+    :param file_hashes: dict of the previous hashes of the files (see hash_file), updated with the new hashes
+    :return: digest: hexadecimal SHA-256 digest
+    """
+    if os.path.isfile(path):
+        return hash_file(path, file_hashes)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"The input {path} does not exist")
+
+    sha = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for fname in sorted(files):
+            fname = os.path.join(root, fname)
+            sha.update(os.path.relpath(fname, path).encode('utf-8'))
+            sha.update(b'\0')
+            sha.update(hash_file(fname, file_hashes).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def get_manifest_path(manifest_dir, name):
+    return os.path.join(manifest_dir, f"{name}.json")
+
+
+def load_manifest(fname_manifest):
+    """
+    Load the manifest of the last run of a stage
+    :param fname_manifest: path to the manifest
+    :return: manifest: dict, None if the stage was never run or the manifest is from another version
+    """
+    if not os.path.isfile(fname_manifest):
+        return None
+    with open(fname_manifest) as f:
+        manifest = json.load(f)
+    return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+
+def save_manifest(fname_manifest, manifest):
+    """
+    Save the manifest of a stage
+    :param fname_manifest: path to the manifest
+    :param manifest: dict
+    """
+    os.makedirs(os.path.dirname(fname_manifest), exist_ok=True)
+
+    # Write then rename so that an interrupted run never leaves a partial manifest
+    fd, fname_tmp = tempfile.mkstemp(prefix='tmp', suffix='.json', dir=os.path.dirname(fname_manifest))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(fname_tmp, fname_manifest)
+
+
+def get_rebuild_reason(manifest, command, params, inputs, outputs, file_hashes):
+    """
+    Check if a stage must be run
+    :param manifest: manifest of the last run of the stage, None if it was never run
+    :param command: list of arguments of the command
+    :param params: parameters that are not in the command
+    :param inputs: list of absolute paths of the inputs
+    :param outputs: list of absolute paths of the outputs
+    :param file_hashes: dict of the previous hashes of the files, updated with the new hashes
+    :return: reason: why the stage must be run, None if it is up to date
+             input_hashes: dict of the hash of each input
+    """
+    input_hashes = {path: hash_input(path, file_hashes) for path in inputs}
+
+    if manifest is None:
+        return "never run", input_hashes
+    if manifest['command'] != command:
+        return "command changed", input_hashes
+    if manifest['params'] != params:
+        return "parameters changed", input_hashes
+    for path, digest in input_hashes.items():
+        if manifest['inputs'].get(path) != digest:
+            return f"{path} changed", input_hashes
+    if set(manifest['inputs']) != set(input_hashes):
+        return "inputs changed", input_hashes
+    for path in outputs:
+        if not os.path.exists(path):
+            return f"{path} is missing", input_hashes
+    return None, input_hashes
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command and args.command[0] == '--' else args.command
+    if not command:
+        parser.error('The command of the stage must be given after "--".')
+    inputs = [os.path.abspath(path) for path in args.inputs]
+    outputs = [os.path.abspath(path) for path in args.outputs]
+
+    fname_manifest = get_manifest_path(args.manifest_dir, args.name)
+    manifest = load_manifest(fname_manifest)
+    file_hashes = manifest['files'] if manifest is not None else {}
+    reason, input_hashes = get_rebuild_reason(manifest, command, args.params, inputs, outputs, file_hashes)
+    if args.force:
+        reason = "forced"
+
+    if reason is None:
+        print(f"Stage {args.name} is up to date. Skipping...")
+        return
+
+    print(f"Running stage {args.name} ({reason}): {' '.join(command)}")
+    # A stage interrupted while running must not be considered up to date
+    if os.path.isfile(fname_manifest):
+        os.remove(fname_manifest)
+    start = time.time()
+    returncode = subprocess.run(command).returncode
+    if returncode != 0:
+        sys.exit(returncode)
+    for path in outputs:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"The stage {args.name} did not create {path}")
+
+    # Only keep the hashes of the files of the current inputs
+    files = {fname: file_hashes[fname] for fname in file_hashes
+             if any(fname == path or fname.startswith(path + os.sep) for path in inputs)}
+    save_manifest(fname_manifest, {
+        'version': MANIFEST_VERSION,
+        'command': command,
+        'params': args.params,
+        'inputs': input_hashes,
+        'outputs': outputs,
+        'files': files,
+    })
+    print(f"Stage {args.name} done in {time.time() - start:.3f} seconds.")
+
+
+if __name__ == '__main__':
+    main()
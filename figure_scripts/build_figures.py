@@ -0,0 +1,159 @@
+"""
+This script builds the figures of one or more sessions in a single command.
+
+The volumes of a session are loaded once in a VolumeCache (see volume_cache.py) shared by all the figures: the EPI
+mosaic, the fieldmap mosaic and the violin plot of the fieldmap RMSEs read the same EPIs, centerlines and fieldmaps.
+The arrays of the figures are computed in the main process, session after session, and the figures are rendered in
+parallel by a pool of workers with the non-interactive Agg backend while the next session is loaded.
+
+The figures of a session are saved in <data_dir>/<date>-acdc_<number>/figures. The tSNR plot of all the given sessions,
+read from the tsnr table of the results store (see save_all_tSNR.py), is saved in <data_dir>/figures.
+
+Example usage:
+    python build_figures.py -session 2025.05.12 274
+    python build_figures.py -manifest sessions.csv -num-workers 4 -figures epi_mosaic fmap_mosaic
+
+The manifest contains one session per line, as the date of the experiment followed by a comma and the ACDC number:
+    2025.05.12,274
+"""
+
+import os
+
+# The figures are rendered without display, in the main process and in the workers
+os.environ['MPLBACKEND'] = 'Agg'
+import matplotlib
+matplotlib.use('Agg')
+
+import argparse
+import concurrent.futures
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "post_processing_scripts"))
+from compute_shim_stats import read_manifest
+from volume_cache import VolumeCache
+from epi_mosaic import compute_epi_mosaic, get_epi_mosaic_paths, save_epi_mosaic
+from fmap_mosaic import compute_fmap_mosaic, get_fmap_mosaic_paths, save_fmap_mosaic
+from violin_plot import (compute_rmse_subject, get_subject_paths, load_subject_data, make_df_from_subject_data,
+                         violin_plot_rmses_subjects)
+from tsnr_plot import load_tsnr, plot_tsnr
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DATA_DIR = os.path.abspath(os.path.join(SCRIPT_DIR, "..", ".."))
+
+SESSION_FIGURES = ["epi_mosaic", "fmap_mosaic", "violin_plot"]
+FIGURES = SESSION_FIGURES + ["tsnr_plot"]
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Build the figures of one or more sessions.')
+    parser.add_argument('-session', nargs=2, action='append', metavar=('DATE', 'ACDC_NUMBER'),
+                        help='Session to process, e.g. "-session 2025.05.12 274". Can be repeated.')
+    parser.add_argument('-manifest', type=str,
+                        help='File with one session per line, as the date followed by a comma and the ACDC number.')
+    parser.add_argument('-data-dir', default=DEFAULT_DATA_DIR, type=str,
+                        help=f'Folder containing the <date>-acdc_<number> session folders. Default: {DEFAULT_DATA_DIR}')
+    parser.add_argument('-figures', nargs='+', default=FIGURES, choices=FIGURES,
+                        help='Figures to build. Default: all of them')
+    parser.add_argument('-num-workers', default=os.cpu_count(), type=int,
+                        help='Number of figures rendered in parallel. Default: number of CPUs')
+    parser.add_argument('-store', type=str,
+                        help='Results store folder with the tsnr table, for the tSNR plot. '
+                             'Default: <data_dir>/results_store')
+
+    return parser
+
+
+def compute_session_figures(session_path, subject_name, figures, cache):
+    """
+    Compute the data of the figures of a session
+    :param session_path: session folder
+    :param subject_name: name of the subject, e.g. acdc274
+    :param figures: names of the figures to compute, among SESSION_FIGURES
+    :param cache: VolumeCache shared by the figures
+    :return: renders: list of (figure name, render function, arguments of the render function)
+    """
+    output_path = os.path.join(session_path, "figures")
+    renders = []
+    if "epi_mosaic" in figures:
+        EPI_PATHS, MASK_PATHS = get_epi_mosaic_paths(session_path, subject_name)
+        mosaic = compute_epi_mosaic(EPI_PATHS, MASK_PATHS, cache)
+        renders.append(("epi_mosaic", save_epi_mosaic, (mosaic, os.path.join(output_path, "epi_mosaic.png"))))
+    if "fmap_mosaic" in figures:
+        FMAP_PATHS, EPI_PATHS, MASK_PATHS = get_fmap_mosaic_paths(session_path, subject_name)
+        mosaic = compute_fmap_mosaic(FMAP_PATHS, EPI_PATHS, MASK_PATHS, cache)
+        renders.append(("fmap_mosaic", save_fmap_mosaic, (mosaic, os.path.join(output_path, "fmap_mosaic.png"))))
+    if "violin_plot" in figures:
+        subject_data = load_subject_data(get_subject_paths(session_path, subject_name), subject_name, cache=cache)
+        compute_rmse_subject(subject_data)
+        df = make_df_from_subject_data([subject_data])
+        renders.append(("violin_plot", violin_plot_rmses_subjects, (df, output_path)))
+    return renders
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    sessions = [tuple(session) for session in args.session or []]
+    if args.manifest is not None:
+        sessions += read_manifest(args.manifest)
+    if not sessions:
+        parser.error('At least one session must be given with -session or -manifest.')
+    data_dir = os.path.abspath(args.data_dir)
+    store_dir = args.store if args.store is not None else os.path.join(data_dir, "results_store")
+    session_names = [f"{date}-acdc_{acdc_number}" for date, acdc_number in sessions]
+    session_figures = [figure for figure in SESSION_FIGURES if figure in args.figures]
+
+    start_time = time.time()
+    num_workers = max(1, args.num_workers)
+    print(f"Building the figures of {len(sessions)} session(s) with {num_workers} worker(s)...")
+    num_done = 0
+    failed = []
+    futures = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        # The figures of a session are rendered while the next session is loaded
+        for (date, acdc_number), session_name in zip(sessions, session_names):
+            session_path = os.path.join(data_dir, session_name)
+            print(f"Loading {session_name}...")
+            try:
+                renders = compute_session_figures(session_path, f"acdc{acdc_number}", session_figures, VolumeCache())
+                os.makedirs(os.path.join(session_path, "figures"), exist_ok=True)
+            except Exception as e:
+                print(f"Error while loading the session {session_name}: {e}")
+                failed.append(session_name)
+                continue
+            for figure, render, render_args in renders:
+                futures[executor.submit(render, *render_args)] = f"{session_name}/{figure}"
+
+        if "tsnr_plot" in args.figures:
+            try:
+                df_tsnr = load_tsnr(store_dir, sessions=session_names)
+                os.makedirs(os.path.join(data_dir, "figures"), exist_ok=True)
+                output_file = os.path.join(data_dir, "figures", "tSNR_plot.png")
+                futures[executor.submit(plot_tsnr, df_tsnr, output_file)] = "tsnr_plot"
+            except Exception as e:
+                print(f"Error while loading the tSNR: {e}")
+                failed.append("tsnr_plot")
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+                num_done += 1
+                print(f"{futures[future]} done")
+            except Exception as e:
+                print(f"Error while rendering {futures[future]}: {e}")
+                failed.append(futures[future])
+
+    print(f"\n{num_done} figure(s) built in {time.time() - start_time:.1f} seconds")
+
+    if failed:
+        print(f"{len(failed)} failure(s): {', '.join(failed)}")
+        sys.exit(1)
+
+    print("\nAll done!")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,69 +1,51 @@
-import nibabel as nib
-import numpy as np
 import matplotlib.pyplot as plt
 import os
+import sys
 
-from scipy.ndimage import center_of_mass
-from shimmingtoolbox.masking.mask_utils import resample_mask as st_resample_from_to
-
-def crop_center(data, center, size):
-    """
-    Crops a square region around the center of the data.
-
-    Args:
-        data (ndarray): 2D data to be cropped
-        center (tuple): (row, col) coordinates of the center
-        size (int): Size of the square region to crop
-        
-    Returns:
-        ndarray: Cropped 2D data
-    """
-    row, col = center
-    half_size = size // 2
-    row_start = max(0, row - half_size)
-    row_end = min(data.shape[0], row + half_size)
-    col_start = max(0, col - half_size)
-    col_end = min(data.shape[1], col + half_size)
-    return data[row_start:row_end, col_start:col_end]
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "post_processing_scripts"))
+from mosaic import get_roi_default_center, make_cord_mosaic
+from volume_cache import VolumeCache
 
 # Option names
 options = ['Baseline', 'DynShim_SCseg', 'DynShim_bin', 'DynShim_2levels', 'DynShim_linear', 'DynShim_gauss']
-
-# Load the data
-script_dir = os.path.dirname(os.path.abspath(__file__))
-EPI_PATHS = [os.path.join(script_dir, f"../../2025.05.12-acdc_274/tSNR-acdc274/{option}/EPIs/{option}_EPI_mc_mean.nii.gz") for option in options]
-MASK_PATHS = [os.path.join(script_dir, f"../../2025.05.12-acdc_274/tSNR-acdc274/{option}/seg/sc_centerline.nii.gz") for option in options]
-
-EPIs = [nib.load(EPI_PATH) for EPI_PATH in EPI_PATHS]
-masks = [nib.load(MASK_PATH) for MASK_PATH in MASK_PATHS]
-masks= [st_resample_from_to(mask, EPI) for mask, EPI in zip(masks, EPIs)]
-
-# Get mask
-masks_data = [mask.get_fdata().astype(bool) for mask in masks]
-    
-# Get the data
 crop_size = 20
-EPIs_data = [EPI.get_fdata() for EPI in EPIs]
-mosaics = []
-
-# Crop the center of the data
-for EPI_data, mask_data in zip(EPIs_data, masks_data):
-    data_crop = np.zeros((crop_size, crop_size, EPIs_data[0].shape[2]))
-
-    for slice in range(EPI_data.shape[-1]):
-        if not np.any(mask_data[:, :, slice]):
-            center = (EPI_data.shape[0] // 2, EPI_data.shape[1] // 2 - 10)
-        else:
-            center = center_of_mass(mask_data[:, :, slice])
-        if not np.isnan(center[0]) and not np.isnan(center[1]):
-            center = (int(center[0]), int(center[1]))
-            data_crop[:, :, slice] = crop_center(EPI_data[:, :, slice], center, crop_size) 
-    data = data_crop[:, :, ::-1]
-    mosaics.append(np.concatenate([np.rot90(data[:, :, i]) for i in range(data.shape[2])], axis=1))
-
-mosaic_repeated = np.concatenate(mosaics, axis=0)
 
-# Save the figure
-output_path = os.path.join(script_dir, "../../2025.05.12-acdc_274/figures")
-output_file = os.path.join(output_path, "epi_mosaic.png")
-plt.imsave(output_file, mosaic_repeated, cmap='gray', vmin=0, vmax=200)
\ No newline at end of file
+def get_epi_mosaic_paths(session_path, subject_name):
+    # Mean EPI and spinal cord centerline of each option
+    tsnr_path = os.path.join(session_path, f"tSNR-{subject_name}")
+    EPI_PATHS = [os.path.join(tsnr_path, option, "EPIs", f"{option}_EPI_mc_mean.nii.gz") for option in options]
+    MASK_PATHS = [os.path.join(tsnr_path, option, "seg", "sc_centerline.nii.gz") for option in options]
+    return EPI_PATHS, MASK_PATHS
+
+def compute_epi_mosaic(EPI_PATHS, MASK_PATHS, cache):
+    # Only load the region of the EPIs shown in the mosaic, and resample the masks in this region only
+    boxes = [cache.get_mosaic_box(MASK_PATH, EPI_PATH, crop_size) for MASK_PATH, EPI_PATH in zip(MASK_PATHS, EPI_PATHS)]
+    default_centers = [get_roi_default_center(cache.load(EPI_PATH).shape, box) for EPI_PATH, box in zip(EPI_PATHS, boxes)]
+
+    # Get mask
+    masks_data = [cache.resample_roi(MASK_PATH, EPI_PATH, box, order=1).astype(bool)
+                  for MASK_PATH, EPI_PATH, box in zip(MASK_PATHS, EPI_PATHS, boxes)]
+
+    # Get the data
+    EPIs_data = [cache.load_roi(EPI_PATH, box) for EPI_PATH, box in zip(EPI_PATHS, boxes)]
+
+    # Crop the center of the data and assemble the mosaic
+    return make_cord_mosaic(EPIs_data, masks_data, crop_size, default_centers=default_centers)
+
+def save_epi_mosaic(mosaic, output_file):
+    plt.imsave(output_file, mosaic, cmap='gray', vmin=0, vmax=200)
+
+def main():
+    # Load the data
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    session_path = os.path.join(script_dir, "../../2025.05.12-acdc_274")
+    EPI_PATHS, MASK_PATHS = get_epi_mosaic_paths(session_path, "acdc274")
+    mosaic_repeated = compute_epi_mosaic(EPI_PATHS, MASK_PATHS, VolumeCache())
+
+    # Save the figure
+    output_path = os.path.join(session_path, "figures")
+    output_file = os.path.join(output_path, "epi_mosaic.png")
+    save_epi_mosaic(mosaic_repeated, output_file)
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,52 @@
-import nibabel as nib
-import numpy as np
 import matplotlib.pyplot as plt
 import os
+import sys
 
-from scipy.ndimage import center_of_mass
-from shimmingtoolbox.masking.mask_utils import resample_mask as st_resample_from_to
-from epi_mosaic import crop_center
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "post_processing_scripts"))
+from mosaic import get_roi_default_center, make_cord_mosaic
+from volume_cache import VolumeCache
+from epi_mosaic import crop_size, get_epi_mosaic_paths
 
 # Option names
-options = ['Baseline', 'DynShim_SCseg', 'DynShim_bin', 'DynShim_2levels', 'DynShim_linear', 'DynShim_gauss']
 categories = ["baseline", "seg", "bin", "2lvl", "lin", "gaus"]
 
-# Load the data
-script_dir = os.path.dirname(os.path.abspath(__file__))
-FMAP_PATHS = [os.path.join(script_dir, f"../../2025.05.12-acdc_274/fmap-acdc274/sub-acdc274_fmap_{category}.nii.gz") for category in categories]
-EPI_PATHS = [os.path.join(script_dir, f"../../2025.05.12-acdc_274/tSNR-acdc274/{option}/EPIs/{option}_EPI_mc_mean.nii.gz") for option in options]
-MASK_PATHS = [os.path.join(script_dir, f"../../2025.05.12-acdc_274/tSNR-acdc274/{option}/seg/sc_centerline.nii.gz") for option in options]
-
-
-EPIs = [nib.load(EPI_PATH) for EPI_PATH in EPI_PATHS]
-masks = [nib.load(MASK_PATH) for MASK_PATH in MASK_PATHS]
-masks = [st_resample_from_to(mask, EPI) for mask, EPI in zip(masks, EPIs)]
-FMAPs = [nib.load(FMAP_PATH) for FMAP_PATH in FMAP_PATHS]
-FMAPs = [st_resample_from_to(FMAP, EPI) for FMAP, EPI in zip(FMAPs, EPIs)]
-
-# Get mask
-masks_data = [mask.get_fdata().astype(bool) for mask in masks]
-    
-# Get the data
-FMAPs_data = [FMAP.get_fdata() for FMAP in FMAPs]
-
-# Initialize crop size and mosaic list
-crop_size = 20
-mosaics = []
-
-# Crop the center of the data
-for FMAP_data, mask_data in zip(FMAPs_data, masks_data):
-    data_crop = np.zeros((crop_size, crop_size, FMAPs_data[0].shape[2]))
-    
-    for slice in range(FMAP_data.shape[-1]):
-        if not np.any(mask_data[:, :, slice]):
-            center = (FMAP_data.shape[0] // 2, FMAP_data.shape[1] // 2 - 10)
-        else:
-            center = center_of_mass(mask_data[:, :, slice])
-        if not np.isnan(center[0]) and not np.isnan(center[1]):
-            center = (int(center[0]), int(center[1]))
-            data_crop[:, :, slice] = crop_center(FMAP_data[:, :, slice], center, crop_size) 
-    data = data_crop[:, :, ::-1]
-    mosaics.append(np.concatenate([np.rot90(data[:, :, i]) for i in range(data.shape[2])], axis=1))
-
-mosaic_repeated = np.concatenate(mosaics, axis=0)
-
-# Save the figure
-output_path = os.path.join(script_dir, "../../2025.05.12-acdc_274/figures")
-output_file = os.path.join(output_path, "fmap_mosaic.png")
-plt.imsave(output_file, mosaic_repeated, cmap='bwr', vmin=-100, vmax=100)
\ No newline at end of file
+def get_fmap_mosaic_paths(session_path, subject_name):
+    # Fieldmap of each option, with the mean EPI and the centerline of the same option
+    FMAP_PATHS = [os.path.join(session_path, f"fmap-{subject_name}", f"sub-{subject_name}_fmap_{category}.nii.gz")
+                  for category in categories]
+    EPI_PATHS, MASK_PATHS = get_epi_mosaic_paths(session_path, subject_name)
+    return FMAP_PATHS, EPI_PATHS, MASK_PATHS
+
+def compute_fmap_mosaic(FMAP_PATHS, EPI_PATHS, MASK_PATHS, cache):
+    # Only resample the region of the fieldmaps shown in the mosaic to the EPI grid, and the masks in this region only
+    boxes = [cache.get_mosaic_box(MASK_PATH, EPI_PATH, crop_size) for MASK_PATH, EPI_PATH in zip(MASK_PATHS, EPI_PATHS)]
+    default_centers = [get_roi_default_center(cache.load(EPI_PATH).shape, box) for EPI_PATH, box in zip(EPI_PATHS, boxes)]
+
+    # Get mask
+    masks_data = [cache.resample_roi(MASK_PATH, EPI_PATH, box, order=1).astype(bool)
+                  for MASK_PATH, EPI_PATH, box in zip(MASK_PATHS, EPI_PATHS, boxes)]
+
+    # Get the data
+    FMAPs_data = [cache.resample_roi(FMAP_PATH, EPI_PATH, box, order=1)
+                  for FMAP_PATH, EPI_PATH, box in zip(FMAP_PATHS, EPI_PATHS, boxes)]
+
+    # Crop the center of the data and assemble the mosaic
+    return make_cord_mosaic(FMAPs_data, masks_data, crop_size, default_centers=default_centers)
+
+def save_fmap_mosaic(mosaic, output_file):
+    plt.imsave(output_file, mosaic, cmap='bwr', vmin=-100, vmax=100)
+
+def main():
+    # Load the data
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    session_path = os.path.join(script_dir, "../../2025.05.12-acdc_274")
+    FMAP_PATHS, EPI_PATHS, MASK_PATHS = get_fmap_mosaic_paths(session_path, "acdc274")
+    mosaic_repeated = compute_fmap_mosaic(FMAP_PATHS, EPI_PATHS, MASK_PATHS, VolumeCache())
+
+    # Save the figure
+    output_path = os.path.join(session_path, "figures")
+    output_file = os.path.join(output_path, "fmap_mosaic.png")
+    save_fmap_mosaic(mosaic_repeated, output_file)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Mosaics of square crops centered on the spinal cord, one row per volume and one column per slice.
+
+The center of the cord in every slice is computed with a single labelled center_of_mass call, every crop of a volume is
+extracted with a single gather from the volume padded by half a crop (so the crops near the edge of the field of view
+keep their size and are filled with fill_value outside of it), and the crops are written directly in a preallocated
+mosaic. The same functions are used for the EPIs, the fieldmaps and the tSNR maps, and for sheets with many volumes.
+
+Example usage:
+    from mosaic import make_cord_mosaic
+    mosaic = make_cord_mosaic([EPI_data, ...], [mask_data, ...], crop_size=20)
+    plt.imsave("epi_mosaic.png", mosaic, cmap='gray', vmin=0, vmax=200)
+
+Only the region of the volumes shown in the mosaic needs to be loaded: get_mosaic_box gives this region and the crops
+are made in it with the default centers given by get_roi_default_center (see roi_loading.py).
+"""
+
+import os
+import sys
+
+import numpy as np
+
+from scipy.ndimage import center_of_mass
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "post_processing_scripts"))
+from roi_loading import get_nonzero_box, transform_box
+
+
+def get_default_center(shape):
+    """
+    Center used in the slices without mask: the middle of the slice, slightly towards the posterior side.
+
+    Args:
+        shape (tuple): Shape of the volume
+
+    Returns:
+        tuple: (row, col) coordinates of the center
+    """
+    return shape[0] // 2, shape[1] // 2 - 10
+
+
+def get_mosaic_box(nii_mask, nii_target, crop_size):
+    """
+    Gets the region of the target grid that contains all the crops of the mosaic: the crops around the mask, the
+    crops around the default center of the slices without mask, and all the slices.
+
+    Args:
+        nii_mask (Nifti1Image): Mask of the spinal cord, e.g. the centerline
+        nii_target (Nifti1Image): Image defining the grid of the mosaic, e.g. the EPI
+        crop_size (int): Size of the square crops
+
+    Returns:
+        tuple: Box (tuple of slices) in the voxels of the target grid
+    """
+    shape = nii_target.shape[:3]
+    mask_box = transform_box(get_nonzero_box(np.asanyarray(nii_mask.dataobj)), nii_mask, nii_target)
+    default_center = get_default_center(shape)
+    box = []
+    for axis in range(2):
+        start, stop = default_center[axis], default_center[axis] + 1
+        if mask_box[axis].stop > mask_box[axis].start:
+            start, stop = min(start, mask_box[axis].start), max(stop, mask_box[axis].stop)
+        box.append(slice(max(start - crop_size // 2 - 1, 0), min(stop + crop_size // 2 + 1, shape[axis])))
+    return box[0], box[1], slice(0, shape[2])
+
+
+def get_roi_default_center(shape, box):
+    """
+    Default center of the slices without mask (see get_default_center) in the voxels of a box.
+
+    Args:
+        shape (tuple): Shape of the full volume
+        box (tuple): Box (tuple of slices) in the voxels of the full volume
+
+    Returns:
+        tuple: (row, col) coordinates of the center in the box
+    """
+    default_center = get_default_center(shape)
+    return default_center[0] - box[0].start, default_center[1] - box[1].start
+
+
+def get_slice_centers(mask_data, default_center=None):
+    """
+    Computes the center of mass of the mask in every slice (last axis).
+
+    Args:
+        mask_data (ndarray): 3D mask, e.g. the spinal cord centerline
+        default_center (tuple): (row, col) center of the slices without mask. Default: see get_default_center
+
+    Returns:
+        ndarray: (n_slices, 2) integer (row, col) centers
+    """
+    if default_center is None:
+        default_center = get_default_center(mask_data.shape)
+    num_slices = mask_data.shape[-1]
+
+    # The label of a voxel is its slice number, so that the centers of all the slices are computed in one call
+    mask_data = np.asarray(mask_data, dtype=bool)
+    labels = np.broadcast_to(np.arange(1, num_slices + 1), mask_data.shape)
+    with np.errstate(invalid='ignore'):
+        centers = np.array(center_of_mass(mask_data, labels=labels, index=np.arange(1, num_slices + 1)),
+                           dtype=np.float64).reshape(num_slices, -1)[:, :2]
+
+    centers[~mask_data.any(axis=(0, 1))] = default_center
+    return centers.astype(np.int64)
+
+
+def crop_slices(data, centers, crop_size, fill_value=0):
+    """
+    Crops a square region around the center of every slice (last axis) of the data.
+
+    Args:
+        data (ndarray): 3D data to be cropped
+        centers (ndarray): (n_slices, 2) integer (row, col) centers
+        crop_size (int): Size of the square region to crop
+        fill_value (float): Value of the crops outside of the data
+
+    Returns:
+        ndarray: (n_slices, crop_size, crop_size) cropped data
+    """
+    half_size = crop_size // 2
+    padded = np.pad(data, ((half_size, crop_size), (half_size, crop_size), (0, 0)), constant_values=fill_value)
+    # In the padded data, the crop of a slice starts at its center. The centers far outside of the data are clipped.
+    starts = np.clip(centers, 0, np.array(data.shape[:2]) + half_size)
+    offsets = np.arange(crop_size)
+    rows = starts[:, 0, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+    cols = starts[:, 1, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+    slices = np.arange(data.shape[-1])[:, np.newaxis, np.newaxis]
+    return padded[rows, cols, slices]
+
+
+def assemble_mosaic(crops_list, fill_value=0):
+    """
+    Assembles crops in a mosaic: one row per volume with its slices from the last to the first one, each crop being
+    rotated by 90 degrees.
+
+    Args:
+        crops_list (list): (n_slices, crop_size, crop_size) crops of each volume (see crop_slices). The volumes with
+                           less slices than the others are completed with fill_value.
+        fill_value (float): Value of the mosaic where there is no crop
+
+    Returns:
+        ndarray: (n_volumes * crop_size, n_slices * crop_size) mosaic
+    """
+    crop_size = crops_list[0].shape[-1]
+    num_slices = max(crops.shape[0] for crops in crops_list)
+    dtype = np.result_type(*crops_list, type(fill_value))
+    mosaic = np.full((len(crops_list) * crop_size, num_slices * crop_size), fill_value, dtype=dtype)
+
+    # View of the mosaic as (volume, row in the crop, slice, column in the crop)
+    tiles = mosaic.reshape(len(crops_list), crop_size, num_slices, crop_size)
+    for i, crops in enumerate(crops_list):
+        rotated = np.rot90(crops[::-1], axes=(1, 2))
+        tiles[i, :, :crops.shape[0], :] = rotated.transpose(1, 0, 2)
+    return mosaic
+
+
+def make_cord_mosaic(volumes_data, masks_data, crop_size=20, fill_value=0, default_centers=None):
+    """
+    Makes the mosaic of the crops centered on the spinal cord of several volumes.
+
+    Args:
+        volumes_data (list): 3D data of each volume, e.g. EPIs, fieldmaps or tSNR maps
+        masks_data (list): 3D mask of the spinal cord of each volume, on the grid of the volume
+        crop_size (int): Size of the square crops
+        fill_value (float): Value of the crops outside of the data
+        default_centers (list): (row, col) center of the slices without mask of each volume, e.g. when the volumes
+                                are regions of the full volumes (see get_roi_default_center). Default: see
+                                get_default_center
+
+    Returns:
+        ndarray: (n_volumes * crop_size, n_slices * crop_size) mosaic
+    """
+    if default_centers is None:
+        default_centers = [None] * len(volumes_data)
+    crops_list = []
+    for data, mask_data, default_center in zip(volumes_data, masks_data, default_centers):
+        centers = get_slice_centers(mask_data, default_center)
+        crops_list.append(crop_slices(data, centers, crop_size, fill_value=fill_value))
+    return assemble_mosaic(crops_list, fill_value=fill_value)
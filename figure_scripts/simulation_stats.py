@@ -1,85 +1,260 @@
-import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-import pytesseract
+"""
+This script computes the statistics (std, mean, MAE and RMSE) of the fieldmap before and after the simulated shimming of
+each option of compare_ponderations.sh, and plots the statistics after shimming.
+
+The statistics used to be read by OCR from the fig_shimmed_vs_unshimmed.png figure of each optimization. They are now
+computed from the unshimmed fieldmap given to st_b0shim, the shimmed fieldmap predicted by st_b0shim in the
+dynamic_shim_<option> folder and the mask of the option resampled to the fieldmap, with the weighted metrics of
+shim_metrics.py. The options are processed in parallel, one option per worker, and the table is written to the
+simulation_stats table of the results store (see results_store.py).
+
+The name of the shimmed fieldmap depends on the version and the verbosity of st_b0shim, it is given by -shimmed-fname.
+With -compare-figure, the statistics of fig_shimmed_vs_unshimmed.png are still read by OCR (pytesseract) and printed
+next to the computed ones, to validate the computed statistics against the values of the previous figures.
+
+Example usage:
+    python simulation_stats.py
+    python simulation_stats.py -subject-path <data_dir>/2025.05.12-acdc_274-TESTS -subject-name acdc274 -num-workers 5
+    python simulation_stats.py -options segmentation -compare-figure
+"""
+
+import argparse
+import concurrent.futures
 import os
 import re
+import sys
+
+import matplotlib.pyplot as plt
+import nibabel as nib
+import numpy as np
+import pandas as pd
 
-from PIL import Image, ImageEnhance, ImageOps
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "post_processing_scripts"))
+from resampling_cache import resample_mask
+from results_store import write_results
+from shim_metrics import compute_metrics_within_masks
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SUBJECT_PATH = os.path.abspath(os.path.join(SCRIPT_DIR, "..", "..", "2025.05.12-acdc_274-TESTS"))
 
 # Option names
-options = ['segmentation', 'st_bin_mask_pond_1e0',
+OPTIONS = ['segmentation', 'st_bin_mask_pond_1e0',
            'st_soft_mask_pond_1e-1', 'st_soft_mask_pond_1e-2', 'st_soft_mask_pond_1e-4']
+OPTION_LABELS = ['Segmenation', 'Binaire (pondération de 1)', 'Pondération de 0.1',
+                 'Pondération de 0.01', 'Pondération de 0.0001']
+METRICS = ['std', 'mean', 'mae', 'rmse']
+PLOTTED_METRICS = ['std', 'mae', 'rmse']
+# Region of the statistics in the title and the name of the figure
+REGION_TITLES = {'masked_region': 'dans le masque', 'segmentation': 'dans la moelle'}
+REGION_SUFFIXES = {'masked_region': 'mask', 'segmentation': 'SC'}
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Compute the statistics of the simulated shimming of each option and '
+                                                 'plot them.')
+    parser.add_argument('-subject-path', default=DEFAULT_SUBJECT_PATH, type=str,
+                        help=f'Session folder of compare_ponderations.sh. Default: {DEFAULT_SUBJECT_PATH}')
+    parser.add_argument('-subject-name', default='acdc274', type=str, help='Name of the subject. Default: acdc274')
+    parser.add_argument('-options', nargs='+', default=OPTIONS, type=str,
+                        help='Names of the masks of the dynamic_shim_<option> folders. Default: the masks of '
+                             'compare_ponderations.sh')
+    parser.add_argument('-shimmed-fname', default='fieldmap_calculated_shim.nii.gz', type=str,
+                        help='Name of the predicted shimmed fieldmap in the dynamic_shim_<option> folders. '
+                             'Default: fieldmap_calculated_shim.nii.gz')
+    parser.add_argument('-region', default='masked_region', choices=['masked_region', 'segmentation'],
+                        help='Region of the plotted statistics: the mask of the option or the spinal cord '
+                             'segmentation. Default: masked_region')
+    parser.add_argument('-compare-figure', action='store_true', default=False,
+                        help='Print the statistics read by OCR in the fig_shimmed_vs_unshimmed.png figure of each '
+                             'option next to the computed ones. Requires pytesseract.')
+    parser.add_argument('-num-workers', default=os.cpu_count(), type=int,
+                        help='Number of options processed in parallel. Default: number of CPUs')
+    parser.add_argument('-store', type=str,
+                        help='Results store folder where the table is written. Default: <subject_path>/../results_store')
+
+    return parser
+
+
+def compute_option_stats(subject_path, subject_name, option, shimmed_fname):
+    """
+    Compute the statistics of the fieldmap before and after the simulated shimming of an option
+    :param subject_path: session folder of compare_ponderations.sh
+    :param subject_name: name of the subject, e.g. acdc274
+    :param option: name of the mask used for the shimming, e.g. segmentation
+    :param shimmed_fname: name of the predicted shimmed fieldmap in the dynamic_shim_<option> folder
+    :return: df: DataFrame with the Option, Region, Metric, Unshimmed, Shimmed and Improvement columns
+    """
+    derivatives_path = os.path.join(subject_path, f"sub-{subject_name}", "derivatives")
+    nii_unshimmed = nib.load(os.path.join(derivatives_path, "fmap", "fieldmap.nii.gz"))
+    optimization_path = os.path.join(derivatives_path, "optimizations", f"dynamic_shim_{option}")
+    fname_shimmed = os.path.join(optimization_path, shimmed_fname)
+    if not os.path.isfile(fname_shimmed):
+        candidates = sorted(fname for fname in os.listdir(optimization_path) if fname.endswith(('.nii', '.nii.gz')))
+        raise FileNotFoundError(f"No shimmed fieldmap {shimmed_fname} in {optimization_path}, use -shimmed-fname "
+                                f"with one of: {', '.join(candidates) if candidates else 'no NIfTI file found'}")
+    nii_shimmed = nib.load(fname_shimmed)
+    if nii_shimmed.shape[:3] != nii_unshimmed.shape[:3]:
+        raise ValueError(f"The shimmed fieldmap of {option} is not on the grid of the unshimmed fieldmap")
+
+    # Mask of the option and spinal cord segmentation, in the fieldmap space
+    masks_path = os.path.join(derivatives_path, "masks")
+    regions = [("masked_region", option), ("segmentation", "segmentation")]
+    masks_data = [resample_mask(nib.load(os.path.join(masks_path, f"{mask_name}.nii.gz")), nii_unshimmed).get_fdata()
+                  for _, mask_name in regions]
+
+    # Row 0 is the unshimmed fieldmap and row 1 the shimmed one, column j is the mask of regions[j]
+    metrics = compute_metrics_within_masks([nii_unshimmed, nii_shimmed], masks_data)
+
+    rows = []
+    for i_region, (region, _) in enumerate(regions):
+        for metric in METRICS:
+            unshimmed = metrics[metric][0, i_region]
+            shimmed = metrics[metric][1, i_region]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                improvement = (unshimmed - shimmed) / unshimmed
+            rows.append([option, region, metric, unshimmed, shimmed, improvement])
+
+    print(f"{option} done")
+    return pd.DataFrame(rows, columns=["Option", "Region", "Metric", "Unshimmed", "Shimmed", "Improvement"])
+
+
+def read_figure_stats(fname_figure):
+    """
+    Read by OCR the statistics before and after shimming of a fig_shimmed_vs_unshimmed.png figure of st_b0shim
+    :param fname_figure: path to the figure
+    :return: stats: dict of {"Unshimmed" or "Shimmed": {metric: value}}, with None for the values not read
+    """
+    import pytesseract
+    from PIL import Image, ImageEnhance, ImageOps
+
+    image = ImageEnhance.Contrast(ImageOps.grayscale(Image.open(fname_figure))).enhance(2.0)
+    pattern = (r"std[:=]?\s*([-+]?\d*\.?\d+)[,\s]+mean[:=]?\s*([-+]?\d*\.?\d+)[,\s]+mae[:=]?\s*([-+]?\d*\.?\d+)"
+               r"[,\s]+rmse[:=]?\s*([-+]?\d*\.?\d+)")
+    # Boxes of the statistics above the unshimmed and the shimmed fieldmaps
+    boxes = {"Unshimmed": (80, 100, 520, 220), "Shimmed": (680, 100, 1120, 220)}
+    stats = {}
+    for name, box in boxes.items():
+        match = re.search(pattern, pytesseract.image_to_string(image.crop(box)), re.IGNORECASE)
+        stats[name] = dict(zip(METRICS, map(float, match.groups()) if match else [None] * len(METRICS)))
+    return stats
+
+
+def compare_with_figures(df, subject_path, subject_name, region='masked_region'):
+    """
+    Print the computed statistics next to the ones read by OCR in the fig_shimmed_vs_unshimmed.png figures
+    :param df: DataFrame from compute_option_stats
+    :param subject_path: session folder of compare_ponderations.sh
+    :param subject_name: name of the subject, e.g. acdc274
+    :param region: region of the computed statistics, masked_region or segmentation
+    :return: df_comparison: DataFrame with the Option, Fieldmap, Metric, Computed and Figure columns
+    """
+    optimizations_path = os.path.join(subject_path, f"sub-{subject_name}", "derivatives", "optimizations")
+    rows = []
+    for option, df_option in df[df["Region"] == region].groupby("Option", sort=False):
+        fname_figure = os.path.join(optimizations_path, f"dynamic_shim_{option}", "fig_shimmed_vs_unshimmed.png")
+        if not os.path.isfile(fname_figure):
+            print(f"No figure to compare with for {option}: {fname_figure} not found")
+            continue
+        figure_stats = read_figure_stats(fname_figure)
+        for fieldmap in ["Unshimmed", "Shimmed"]:
+            for metric, computed in zip(df_option["Metric"], df_option[fieldmap]):
+                rows.append([option, fieldmap, metric, computed, figure_stats[fieldmap][metric]])
+
+    df_comparison = pd.DataFrame(rows, columns=["Option", "Fieldmap", "Metric", "Computed", "Figure"])
+    df_comparison["Difference"] = df_comparison["Computed"] - df_comparison["Figure"].astype(float)
+    print(f"\nComputed statistics ({region}) and statistics of the figures:")
+    print(df_comparison.to_string(index=False))
+    return df_comparison
+
+
+def plot_simulation_stats(df, options, option_labels, output_file, region='masked_region'):
+    """
+    Plot the statistics after shimming of each option
+    :param df: DataFrame from compute_option_stats
+    :param options: options to plot, in order
+    :param option_labels: labels of the options
+    :param output_file: path of the figure
+    :param region: region of the plotted statistics, masked_region or segmentation
+    """
+    df = df[df["Region"] == region].pivot(index="Option", columns="Metric", values="Shimmed").reindex(options)
+    x = np.arange(len(df))
+
+    bar_width = 0.2
+    fig, ax = plt.subplots(figsize=(10, 6))
+
+    for i, metric in enumerate(PLOTTED_METRICS):
+        values = df[metric].values
+        positions = x + i * bar_width
+        bars = ax.bar(positions, values, width=bar_width, label=metric)
+        for bar in bars:
+            height = bar.get_height()
+            ax.annotate(f'{height:.1f}',
+                        xy=(bar.get_x() + bar.get_width() / 2, height),
+                        xytext=(0, 3),
+                        textcoords="offset points",
+                        ha='center', va='bottom')
+
+    ax.set_xticks(x + bar_width * (len(PLOTTED_METRICS) - 1) / 2)
+    ax.set_xticklabels(option_labels, rotation=45)
+    ax.set_ylabel("Valeur")
+    ax.set_title(f"Comparaison des statistiques ({REGION_TITLES[region]}) de simulation après shimming pour chaque "
+                 "méthode")
+    ax.legend()
+
+    # Save the figure
+    fig.savefig(output_file, dpi=300, bbox_inches='tight')
+    plt.close(fig)
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    subject_path = os.path.abspath(args.subject_path)
+    store_dir = args.store if args.store is not None else os.path.join(os.path.dirname(subject_path), "results_store")
+
+    # Each option is processed by a single worker
+    num_workers = max(1, min(args.num_workers, len(args.options)))
+    print(f"Computing the simulation stats of {len(args.options)} option(s) with {num_workers} worker(s)...")
+    dfs = {}
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(compute_option_stats, subject_path, args.subject_name, option, args.shimmed_fname):
+                   option for option in args.options}
+        for future in concurrent.futures.as_completed(futures):
+            option = futures[future]
+            try:
+                dfs[option] = future.result()
+            except Exception as e:
+                print(f"Error while processing the option {option}: {e}")
+                failed.append(option)
+
+    if dfs:
+        options = [option for option in args.options if option in dfs]
+        df = pd.concat([dfs[option] for option in options], ignore_index=True)
+        fname_partition = write_results(store_dir, "simulation_stats", args.subject_name,
+                                        os.path.basename(subject_path), df)
+        print(f"\nSimulation stats saved in {fname_partition}")
+
+        # Labels of the default options, the names of the others
+        labels = dict(zip(OPTIONS, OPTION_LABELS))
+        output_path = os.path.join(subject_path, "figures_ponderations")
+        os.makedirs(output_path, exist_ok=True)
+        output_file = os.path.join(output_path, f"simulation_stats_{REGION_SUFFIXES[args.region]}.png")
+        plot_simulation_stats(df, options, [labels.get(option, option) for option in options], output_file,
+                              region=args.region)
+        print(f"Figure saved in {output_file}")
+
+        if args.compare_figure:
+            compare_with_figures(df, subject_path, args.subject_name, region=args.region)
+
+    if failed:
+        print(f"{len(failed)} option(s) failed: {', '.join(failed)}")
+        sys.exit(1)
+
+    print("\nAll done!")
+
 
-# Define the paths to the images
-script_path = os.path.dirname(os.path.abspath(__file__))
-subject_path = os.path.join(script_path, "../../2025.05.12-acdc_274-TESTS")
-optimization_path = os.path.join(subject_path, 'sub-acdc274', 'derivatives', 'optimizations')
-image_paths = [os.path.join(optimization_path, f'dynamic_shim_{option}', 'fig_shimmed_vs_unshimmed.png') for option in options]
-
-all_before_stats = []
-all_after_stats = []
-
-for image_path, option in zip(image_paths, options):
-    # Open the image and convert it to grayscale
-    image = Image.open(image_path)
-    gray_image = ImageOps.grayscale(image)
-    enhanced_image = ImageEnhance.Contrast(gray_image).enhance(2.0)
-
-    # Define the boxes for cropping
-    before_box = (80, 100, 520, 220)
-    after_box = (680, 100, 1120, 220)
-    before_crop = enhanced_image.crop(before_box)
-    after_crop = enhanced_image.crop(after_box)
-
-    # Exctract text from the cropped images
-    before_text = pytesseract.image_to_string(before_crop)
-    after_text = pytesseract.image_to_string(after_crop)
-
-    # Get the data from the text
-    def extract_stats(text, option):
-        stats = {"option": option, "std": None, "mean": None, "mae": None, "rmse": None}
-        pattern = r"std[:=]?\s*([-+]?\d*\.?\d+)[,\s]+mean[:=]?\s*([-+]?\d*\.?\d+)[,\s]+mae[:=]?\s*([-+]?\d*\.?\d+)[,\s]+rmse[:=]?\s*([-+]?\d*\.?\d+)"
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            stats["std"], stats["mean"], stats["mae"], stats["rmse"] = map(float, match.groups())
-        return stats
-    before_stats = extract_stats(before_text, option)
-    after_stats = extract_stats(after_text, option)
-
-    # Append the stats to the lists
-    all_before_stats.append(before_stats)
-    all_after_stats.append(after_stats)
-
-# Convert the lists to DataFrames
-df = pd.DataFrame(all_after_stats)
-metrics = ["std", "mae", "rmse"]
-x = np.arange(len(df))
-
-bar_width = 0.2
-fig, ax = plt.subplots(figsize=(10, 6))
-
-for i, metric in enumerate(metrics):
-    values = df[metric].values
-    positions = x + i * bar_width
-    bars = ax.bar(positions, values, width=bar_width, label=metric)
-    for bar in bars:
-        height = bar.get_height()
-        ax.annotate(f'{height:.1f}',
-                    xy=(bar.get_x() + bar.get_width() / 2, height),
-                    xytext=(0, 3),
-                    textcoords="offset points",
-                    ha='center', va='bottom')
-
-ax.set_xticks(x + bar_width * (len(metrics) - 1) / 2)
-masks = ['Segmenation', 'Binaire (pondération de 1)', 'Pondération de 0.1',
-         'Pondération de 0.01', 'Pondération de 0.0001']
-ax.set_xticklabels(masks, rotation=45)
-ax.set_ylabel("Valeur")
-ax.set_title("Comparaison des statistiques (dans la moelle) de simulation après shimming pour chaque méthode")
-ax.legend()
-
-# Save the figure
-output_path = os.path.join(subject_path, "figures_ponderations")
-output_file = os.path.join(output_path, "simulation_stats_SC.png")
-plt.savefig(output_file, dpi=300, bbox_inches='tight')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
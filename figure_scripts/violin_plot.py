@@ -2,49 +2,92 @@ import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 import nibabel as nib
-from nibabel.processing import resample_from_to
 import pandas as pd
 import os
+import sys
 
-def load_subject_data(subject_paths, name):
-    mask_img = nib.load(subject_paths["mask_path"])
-    fm_imgs = [nib.load(fm_path) for fm_path in subject_paths["fm_paths"]]
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "post_processing_scripts"))
+from masked_volume import MaskedVolume
+from roi_loading import get_nonzero_box, paste_roi, resample_roi, transform_box
+
+def load_subject_data(subject_paths, name, cache=None):
+    # The images are shared with the other figures when a VolumeCache is given (see build_figures.py)
+    load = nib.load if cache is None else cache.load
+    mask_img = load(subject_paths["mask_path"])
+    fm_imgs = [load(fm_path) for fm_path in subject_paths["fm_paths"]]
     fm_ref_img = fm_imgs[1]  # Use the second fieldmap (DynSHim_SCseg) as reference for resampling
     
-    # resample mask to fm resolution
-    mask_img = resample_from_to(mask_img, fm_ref_img, order=0, mode='grid-constant', cval=0)
-    
-    # Replace 0 with NaN in mask
-    mask_img_data = mask_img.get_fdata()
-    mask_img_data[mask_img_data == 0] = np.nan
-    
-    # apply binary mask to fm images
-    fm_imgs_data = [fm_img.get_fdata() * mask_img_data for fm_img in fm_imgs]
+    # resample mask to fm resolution, only in the region of the fm grid covering the mask
+    fm_shape = fm_ref_img.shape[:3]
+    box = transform_box(get_nonzero_box(mask_img.get_fdata()), mask_img, fm_ref_img, padding=1)
+    mask_data = paste_roi(resample_roi(mask_img, fm_ref_img, box, order=0).get_fdata(), box, fm_shape)
+
+    # Only keep the voxels of the mask, the fm images are not loaded as full volumes (see MaskedVolume)
+    masked = MaskedVolume.from_masks([mask_data])
     
-    return {'name': name, 'mask':mask_img_data, 'fms': fm_imgs_data}
+    # apply mask to fm images
+    masked.add_volumes(fm_imgs)
+    masked.values *= masked.weights
+
+    subject_data = {'name': name, 'masked': masked}
+
+    # Optional vertebral levels (integer labels, 0 outside of the levels) to compute the RMSE per level
+    if subject_paths.get("levels_path") is not None:
+        levels_img = resample_roi(load(subject_paths["levels_path"]), fm_ref_img, box, order=0)
+        subject_data['levels'] = np.rint(masked.gather(paste_roi(levels_img.get_fdata(), box, fm_shape))).astype(int)
+
+    return subject_data
+
+def compute_grouped_weighted_rmse(values, weights, groups, num_groups):
+    # Weighted RMSE of each fieldmap in each group of voxels (slice, vertebral level...). values is (n_fieldmaps,
+    # n_voxels), weights and groups are (n_voxels,). groups gives the group of each voxel, from 0 to num_groups - 1, or
+    # -1 to ignore the voxel. The weight of a voxel is the square root of the mask and the voxels where the fieldmap or
+    # the weight is NaN are ignored. Returns a (n_fieldmaps, num_groups) array, NaN for the groups without valid voxel.
+    num_fms = len(values)
+    voxels = groups >= 0
+    with np.errstate(invalid='ignore'):
+        weights = np.sqrt(weights[voxels].astype(np.float64))
+    values = values[:, voxels].astype(np.float64)
+    valid = ~np.isnan(values) & ~np.isnan(weights)
+    weights = np.where(valid, weights, 0)
+    values = np.where(valid, values, 0)
+
+    # A single reduction for all the fieldmaps and groups: the bin of a voxel of fieldmap i is i * num_groups + group
+    bins = (np.arange(num_fms)[:, np.newaxis] * num_groups + groups[voxels]).ravel()
+    num_bins = num_fms * num_groups
+    weighted_sum = np.bincount(bins, weights=(weights * values ** 2).ravel(), minlength=num_bins)
+    sum_weights = np.bincount(bins, weights=weights.ravel(), minlength=num_bins)
+    num_valid = np.bincount(bins, weights=valid.ravel(), minlength=num_bins)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rmses = np.sqrt(weighted_sum / sum_weights)
+    rmses[num_valid == 0] = np.nan
+    return rmses.reshape(num_fms, num_groups)
 
 def compute_slice_wise_weighted_rmse(fm_data, mask):
-    rmses = []
-    for slice_idx in range(fm_data.shape[-1]):
-        fm_slice = fm_data[..., slice_idx]
-        weight_slice = np.sqrt(mask[..., slice_idx])
-        # Ignore NaNs in both fm_slice and weight_slice
-        valid = ~np.isnan(fm_slice) & ~np.isnan(weight_slice)
-        if np.any(valid):
-            weighted_mse = np.nansum(weight_slice[valid] * (fm_slice[valid] ** 2)) / np.nansum(weight_slice[valid])
-            rmses.append(np.sqrt(weighted_mse))
-        else:
-            rmses.append(np.nan)
-    return rmses
+    # Weighted RMSE of a fieldmap in each slice of the mask (NaN outside of the mask)
+    masked = MaskedVolume.from_masks([mask])
+    masked.add_volumes([fm_data])
+    return list(compute_grouped_weighted_rmse(masked.values, masked.weights[0], masked.slices, fm_data.shape[-1])[0])
+
+def compute_level_wise_weighted_rmse(values, weights, levels):
+    # Weighted RMSE of each fieldmap in each vertebral level, levels being the level of each voxel (0 for none)
+    # Returns the levels present in the mask and a (n_fieldmaps, n_levels) array
+    level_values = np.unique(levels[levels > 0])
+    groups = np.where(levels > 0, np.searchsorted(level_values, levels), -1)
+    return level_values, compute_grouped_weighted_rmse(values, weights, groups, len(level_values))
 
 def compute_rmse_subject(subject_data):
-    if 'rmses' not in subject_data:
-        subject_data['rmses'] = []
-    for fm_img in subject_data['fms']:
-        rmses = compute_slice_wise_weighted_rmse(fm_img, subject_data['mask'])
-        subject_data['rmses'].append(rmses)
+    # Slice-wise RMSE of all the fieldmaps at once
+    masked = subject_data['masked']
+    rmses = compute_grouped_weighted_rmse(masked.values, masked.weights[0], masked.slices, masked.shape[-1])
+    subject_data['rmses'] = [list(rmses_fm) for rmses_fm in rmses]
     subject_data['rmses_mean'] = [np.nanmean(rmses) for rmses in subject_data['rmses']]
     subject_data['rmses_std'] = [np.nanstd(rmses) for rmses in subject_data['rmses']]
+
+    if 'levels' in subject_data:
+        subject_data['level_values'], subject_data['rmses_per_level'] = compute_level_wise_weighted_rmse(
+            masked.values, masked.weights[0], subject_data['levels'])
     
 def make_df_from_subject_data(subject_data_list):
     all_data = {
@@ -72,6 +115,19 @@ def make_df_from_subject_data(subject_data_list):
     
     return df
 
+def make_level_df_from_subject_data(subject_data_list):
+    # One row per subject, shim and vertebral level, for the subjects with vertebral levels
+    shims = ['Baseline', 'seg', 'bin', '2lvl', 'lin', 'gaus']
+    dfs = []
+    for subject_data in subject_data_list:
+        if 'rmses_per_level' not in subject_data:
+            continue
+        df = pd.DataFrame(subject_data['rmses_per_level'], index=shims, columns=subject_data['level_values'])
+        df = df.rename_axis(index='Shim', columns='Level').stack().rename('RMSE').reset_index()
+        df['Subject'] = subject_data['name']
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=['Shim', 'Level', 'RMSE', 'Subject'])
+
 def violin_plot_rmses_subjects(df, output_path):
     # Create the violin plot with hue based on the subject
     plt.figure(figsize=(15, 8))
@@ -83,8 +139,10 @@ def violin_plot_rmses_subjects(df, output_path):
     plt.xlabel("Masque utilisé pour le shimming")
     plt.ylabel('RMSE dans la moelle épinière')
     plt.title('Distribution tranche par tranche de la RMSE dans la moelle épinière')
-    means = subject_data['rmses_mean']
-    stds = subject_data['rmses_std']
+    # Mean and standard deviation of the slice-wise RMSEs of each shim, over all the subjects of the df
+    rmses = df.groupby('Shim', sort=False)['RMSE']
+    means = rmses.mean()
+    stds = rmses.std(ddof=0)
     for i, (mean, std) in enumerate(zip(means, stds)):
         text = f"$\\mu$ : {mean:.1f} | $\\sigma$ : {std:.1f}"
         plt.text(i, -5, text, ha='center', va='center', fontsize=10, fontweight='bold')
@@ -97,23 +155,35 @@ def violin_plot_rmses_subjects(df, output_path):
     # Save the figure
     output_file = os.path.join(output_path, "violin_plot.png")
     plt.savefig(output_file, dpi=300, bbox_inches='tight')
+    plt.close()
 
-if __name__ == "__main__":
-
-    script_dir = os.path.dirname(os.path.abspath(__file__))
+def get_subject_paths(session_path, subject_name):
     options = ['baseline', 'seg', 'bin', '2lvl', 'lin', 'gaus']
-    subject_paths = {
-        "mask_path": os.path.join(script_dir, "../../2025.05.12-acdc_274/sub-acdc274/derivatives/masks/segmentation.nii.gz"),
-        "fm_paths": [os.path.join(script_dir, f"../../2025.05.12-acdc_274/fmap-acdc274/sub-acdc274_fmap_{option}.nii.gz")
-                    for option in options]
+    return {
+        "mask_path": os.path.join(session_path, f"sub-{subject_name}/derivatives/masks/segmentation.nii.gz"),
+        "fm_paths": [os.path.join(session_path, f"fmap-{subject_name}/sub-{subject_name}_fmap_{option}.nii.gz")
+                    for option in options],
+        # Vertebral levels (e.g. from sct_label_vertebrae) to also compute the RMSE per level, None to skip
+        "levels_path": None
     }
 
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    session_path = os.path.join(script_dir, "../../2025.05.12-acdc_274")
+    subject_paths = get_subject_paths(session_path, 'acdc274')
+
     subject_data = load_subject_data(subject_paths, 'acdc274')
     compute_rmse_subject(subject_data)
 
     # create a DataFrame from the subject data
     df = make_df_from_subject_data([subject_data])
+    if 'rmses_per_level' in subject_data:
+        df_levels = make_level_df_from_subject_data([subject_data])
+        print(df_levels.pivot(index='Level', columns='Shim', values='RMSE').to_string())
 
     # Plot violin plot with hue based on subject
-    output_path = os.path.join(script_dir, "../../2025.05.12-acdc_274/figures")
-    violin_plot_rmses_subjects(df, output_path)
\ No newline at end of file
+    output_path = os.path.join(session_path, "figures")
+    violin_plot_rmses_subjects(df, output_path)
+
+if __name__ == "__main__":
+    main()
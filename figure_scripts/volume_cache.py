@@ -0,0 +1,107 @@
+"""
+In-process cache of the volumes used by the figures.
+
+The figures of a session use the same EPIs, masks and fieldmaps: the EPI mosaic and the fieldmap mosaic both crop
+around the centerlines in the EPI grid, the violin plot and the fieldmap mosaic read the same fieldmaps. A VolumeCache
+loads each image once (nib.load), and keeps the data read or resampled in a box (see roi_loading.py) so that the
+figures built in the same process never read nor resample the same region twice.
+
+The cached arrays are read-only. Copy them before modifying them in place.
+
+Example usage:
+    from volume_cache import VolumeCache
+    cache = VolumeCache()
+    box = cache.get_mosaic_box(mask_path, epi_path, crop_size=20)
+    epi_data = cache.load_roi(epi_path, box)
+    fmap_data = cache.resample_roi(fmap_path, epi_path, box, order=1)
+"""
+
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "post_processing_scripts"))
+from roi_loading import load_roi, resample_roi
+from mosaic import get_mosaic_box
+
+
+def get_box_key(box):
+    return tuple((s.start, s.stop) for s in box)
+
+
+class VolumeCache:
+    """
+    Images and regions of images loaded by the figures, each one loaded once
+    """
+
+    def __init__(self):
+        self._images = {}
+        self._arrays = {}
+
+    def load(self, path):
+        """
+        :param path: path to a NIfTI file
+        :return: nii: nibabel image, the same object for every call with the same file
+        """
+        path = os.path.abspath(path)
+        if path not in self._images:
+            self._images[path] = nib.load(path)
+        return self._images[path]
+
+    def _get_array(self, key, compute):
+        if key not in self._arrays:
+            data = compute()
+            data.flags.writeable = False
+            self._arrays[key] = data
+        return self._arrays[key]
+
+    def get_data(self, path):
+        """
+        :param path: path to a NIfTI file
+        :return: data: full volume as float64 (get_fdata)
+        """
+        path = os.path.abspath(path)
+        return self._get_array(('data', path), lambda: self.load(path).get_fdata())
+
+    def get_mosaic_box(self, mask_path, target_path, crop_size):
+        """
+        :param mask_path: path to the mask of the spinal cord, e.g. the centerline
+        :param target_path: path to the image defining the grid of the mosaic, e.g. the EPI
+        :param crop_size: size of the square crops
+        :return: box: region of the target grid containing the crops of the mosaic (see mosaic.get_mosaic_box)
+        """
+        key = ('mosaic_box', os.path.abspath(mask_path), os.path.abspath(target_path), crop_size)
+        if key not in self._arrays:
+            self._arrays[key] = get_mosaic_box(self.load(mask_path), self.load(target_path), crop_size)
+        return self._arrays[key]
+
+    def load_roi(self, path, box):
+        """
+        :param path: path to a NIfTI file
+        :param box: tuple of slices in the voxels of the image
+        :return: data: box of the volume as float64, only the box is read
+        """
+        path = os.path.abspath(path)
+        return self._get_array(('roi', path, get_box_key(box)), lambda: load_roi(self.load(path), box).get_fdata())
+
+    def resample_roi(self, source_path, target_path, box, order=1):
+        """
+        :param source_path: path to the image to resample
+        :param target_path: path to the image defining the target grid
+        :param box: tuple of slices in the voxels of the target image
+        :param order: order of the spline interpolation
+        :return: data: source resampled into the box of the target grid, as float64 (see roi_loading.resample_roi)
+        """
+        source_path, target_path = os.path.abspath(source_path), os.path.abspath(target_path)
+        key = ('resampled_roi', source_path, target_path, get_box_key(box), order)
+        return self._get_array(key, lambda: np.asarray(
+            resample_roi(self.load(source_path), self.load(target_path), box, order=order).get_fdata()))
+
+    def clear(self):
+        """
+        Remove all the cached images and arrays
+        """
+        self._images.clear()
+        self._arrays.clear()
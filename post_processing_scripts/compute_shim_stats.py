@@ -1,120 +1,170 @@
-import nibabel as nib
+"""
+This script computes the shimming statistics (Std, MAE and RMSE of the fieldmap before and after shimming) of one or
+more sessions. The sessions are processed in parallel, one session per worker.
+
+The results of each session are written to the shim_stats table of the results store (see results_store.py), which
+holds the results of the whole cohort.
+
+Example usage:
+    python compute_shim_stats.py -session 2025.05.12 274
+    python compute_shim_stats.py -manifest sessions.csv -num-workers 4 -store <data_dir>/results_store
+
+The manifest contains one session per line, as the date of the experiment followed by a comma and the ACDC number:
+    2025.05.12,274
+"""
+
+import argparse
+import concurrent.futures
 import os
+import sys
+
+import nibabel as nib
+import pandas as pd
+
+from resampling_cache import resample_mask
+from results_store import write_results
+from shim_metrics import compute_metrics_within_masks
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DATA_DIR = os.path.abspath(os.path.join(SCRIPT_DIR, "..", ".."))
+
+CATEGORIES = ["seg", "bin", "2lvl", "lin", "gaus"]
+MASK_NAMES = ["segmentation", "sct_bin_mask", "st_soft_mask_2lvls", "st_soft_mask_linear", "st_soft_mask_gauss"]
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Compute the shimming statistics of one or more sessions.')
+    parser.add_argument('-session', nargs=2, action='append', metavar=('DATE', 'ACDC_NUMBER'),
+                        help='Session to process, e.g. "-session 2025.05.12 274". Can be repeated.')
+    parser.add_argument('-manifest', type=str,
+                        help='File with one session per line, as the date followed by a comma and the ACDC number.')
+    parser.add_argument('-data-dir', default=DEFAULT_DATA_DIR, type=str,
+                        help=f'Folder containing the <date>-acdc_<number> session folders. Default: {DEFAULT_DATA_DIR}')
+    parser.add_argument('-num-workers', default=os.cpu_count(), type=int,
+                        help='Number of sessions processed in parallel. Default: number of CPUs')
+    parser.add_argument('-store', type=str,
+                        help='Results store folder where the results of each session are written. '
+                             'Default: <data_dir>/results_store')
+
+    return parser
+
+
+def read_manifest(fname_manifest):
+    """
+    Read the sessions to process
+    :param fname_manifest: path to the manifest, one "date,acdc_number" pair per line
+    :return: sessions: list of (date, acdc_number) pairs
+    """
+    sessions = []
+    with open(fname_manifest, "r") as f:
+        for line in f:
+            fields = [field.strip() for field in line.split(",")]
+            if not fields[0] or fields[0].startswith("#"):
+                continue
+            if len(fields) < 2 or not fields[1]:
+                raise ValueError(f"No ACDC number given for the session {fields[0]} in {fname_manifest}")
+            sessions.append((fields[0], fields[1]))
+    return sessions
+
+
+def compute_session_stats(data_dir, store_dir, date, acdc_number):
+    """
+    Compute the shimming statistics of a session and write them to the results store
+    :param data_dir: folder containing the session folders
+    :param store_dir: results store folder
+    :param date: date of the experiment, e.g. 2025.05.12
+    :param acdc_number: ACDC number of the session, e.g. 274
+    :return: df: DataFrame with the Category, Region, Metric, Unshimmed, Shimmed and Improvement columns
+    """
+    subject_name = f"acdc{acdc_number}"
+    session_name = f"{date}-acdc_{acdc_number}"
+
+    # Paths
+    experience_path = os.path.join(data_dir, session_name)
+    print(f"Experience path: {experience_path}")
+    FMAPs_path = os.path.join(experience_path, f"fmap-{subject_name}")
+    masks_path = os.path.join(experience_path, f"sub-{subject_name}", 'derivatives', 'masks')
+
+    # Load the baseline data
+    baseline_FMAP_path = os.path.join(FMAPs_path, f"sub-{subject_name}_fmap_baseline.nii.gz")
+    nii_baseline_FMAP = nib.load(baseline_FMAP_path)
+
+    # Load each fieldmap once and resample the masks to the fieldmap space
+    nii_FMAPs = []
+    resampled_masks_data = []
+    for category, mask_name in zip(CATEGORIES, MASK_NAMES):
+        FMAP_path = os.path.join(FMAPs_path, f"sub-{subject_name}_fmap_{category}.nii.gz")
+        nii_FMAP = nib.load(FMAP_path)
+        nii_FMAPs.append(nii_FMAP)
+
+        print(f"[{subject_name}] Resampling {category} mask to fieldmap space...")
+        nii_mask = nib.load(os.path.join(masks_path, f"{mask_name}.nii.gz"))
+        resampled_masks_data.append(resample_mask(nii_mask, nii_FMAP).get_fdata())
+
+    # Calculate the metrics of every fieldmap in every mask at once, only the bounding box of the masks is read from the
+    # fieldmaps (see MaskedVolume). Row 0 is the baseline, row i + 1 the fieldmap shimmed with the mask of
+    # CATEGORIES[i]. Column j is the mask of CATEGORIES[j], column 0 being the segmentation.
+    print(f"[{subject_name}] Calculating metrics in all the masked regions...")
+    metrics = compute_metrics_within_masks([nii_baseline_FMAP] + nii_FMAPs, resampled_masks_data)
 
-from shimmingtoolbox.masking.mask_utils import resample_mask
-from shimmingtoolbox.shim.shim_utils import calculate_metric_within_mask
-
-# Arguments
-exp_year = '2025'
-exp_month = '05'
-exp_day = '12'
-acdc_number = '274'
-subject_name = f"acdc{acdc_number}"
-
-# Paths
-script_dir = os.path.dirname(os.path.abspath(__file__))
-experience_path = os.path.abspath(os.path.join(script_dir, "..", "..", f"{exp_year}.{exp_month}.{exp_day}-acdc_{acdc_number}"))
-print(f"Experience path: {experience_path}")
-FMAPs_path = os.path.join(experience_path, f"fmap-{subject_name}")
-masks_path = os.path.join(experience_path, f"sub-{subject_name}", 'derivatives', 'masks')
-output_path = os.path.join(experience_path, f"shim_stats-{subject_name}")
-os.makedirs(output_path, exist_ok=True)
-
-# Load the masks
-seg_mask_path = os.path.join(masks_path, "segmentation.nii.gz")
-nii_seg_mask = nib.load(seg_mask_path)
-bin_mask_path = os.path.join(masks_path, "sct_bin_mask.nii.gz")
-nii_bin_mask = nib.load(bin_mask_path)
-twolvl_mask_path = os.path.join(masks_path, "st_soft_mask_2lvls.nii.gz")
-nii_twolvl_mask = nib.load(twolvl_mask_path)
-lin_mask_path = os.path.join(masks_path, "st_soft_mask_linear.nii.gz")
-nii_lin_mask = nib.load(lin_mask_path)
-gaus_mask_path = os.path.join(masks_path, "st_soft_mask_gauss.nii.gz")
-nii_gaus_mask = nib.load(gaus_mask_path)
-
-# Load the baseline data
-baseline_FMAP_path = os.path.join(FMAPs_path, f"sub-{subject_name}_fmap_baseline.nii.gz")
-nii_baseline_FMAP = nib.load(baseline_FMAP_path)
-baseline_FMAP_data = nii_baseline_FMAP.get_fdata()
-
-categories = ["seg", "bin", "2lvl", "lin", "gaus"]
-masks = [nii_seg_mask, nii_bin_mask, nii_twolvl_mask, nii_lin_mask, nii_gaus_mask]
-for category, mask in zip(categories, masks):
-    
-    # Load the fieldmap
-    FMAP_path = os.path.join(FMAPs_path, f"sub-{subject_name}_fmap_{category}.nii.gz")
-    nii_FMAP = nib.load(FMAP_path)
-    FMAP_data = nii_FMAP.get_fdata()
-
-    # Resample the masks to the EPI space
-    print(f"\nResampling {category} mask to fieldmap space...")
-    nii_resampled_mask = resample_mask(mask, nii_FMAP)
-    resampled_mask_data = nii_resampled_mask.get_fdata()
-
-    # Calculate the metrics in all the masked region
-    print(f"Calculating metrics in all the {category} region...")
-    unshimmed_std = calculate_metric_within_mask(baseline_FMAP_data, resampled_mask_data, metric="std")
-    unshimmed_mae = calculate_metric_within_mask(baseline_FMAP_data, resampled_mask_data, metric="mae")
-    unshimmed_rmse = calculate_metric_within_mask(baseline_FMAP_data, resampled_mask_data, metric="rmse")
-
-    shimmed_std = calculate_metric_within_mask(FMAP_data, resampled_mask_data, metric="std")
-    shimmed_mae = calculate_metric_within_mask(FMAP_data, resampled_mask_data, metric="mae")
-    shimmed_rmse = calculate_metric_within_mask(FMAP_data, resampled_mask_data, metric="rmse")
-
-    improvement_std = (unshimmed_std - shimmed_std) / unshimmed_std
-    improvement_mae = (unshimmed_mae - shimmed_mae) / unshimmed_mae
-    improvement_rmse = (unshimmed_rmse - shimmed_rmse) / unshimmed_rmse
-
-    if category != "seg" :
-        
-        # Resample the segmentation mask to the EPI space
-        print("\nResampling segmentation mask to EPI space...")
-        nii_resampled_seg_mask = resample_mask(nii_seg_mask, nii_FMAP)
-        resampled_seg_mask_data = nii_resampled_seg_mask.get_fdata()
-        
-        # Calculate the metrics onlyt in the spinal cord region
-        print("Calculating metrics in the spinal cord region...")
-        unshimmed_std_sc = calculate_metric_within_mask(baseline_FMAP_data, resampled_seg_mask_data, metric="std")
-        unshimmed_mae_sc = calculate_metric_within_mask(baseline_FMAP_data, resampled_seg_mask_data, metric="mae")
-        unshimmed_rmse_sc = calculate_metric_within_mask(baseline_FMAP_data, resampled_seg_mask_data, metric="rmse")
-
-        shimmed_std_sc = calculate_metric_within_mask(FMAP_data, resampled_seg_mask_data, metric="std")
-        shimmed_mae_sc = calculate_metric_within_mask(FMAP_data, resampled_seg_mask_data, metric="mae")
-        shimmed_rmse_sc = calculate_metric_within_mask(FMAP_data, resampled_seg_mask_data, metric="rmse")
-
-        improvement_std_sc = (unshimmed_std_sc - shimmed_std_sc) / unshimmed_std_sc
-        improvement_mae_sc = (unshimmed_mae_sc - shimmed_mae_sc) / unshimmed_mae_sc
-        improvement_rmse_sc = (unshimmed_rmse_sc - shimmed_rmse_sc) / unshimmed_rmse_sc
-
-    # Prepare results for CSV
     rows = []
-    # Metrics for the whole masked region
-    rows.append(["masked_region", "Std", unshimmed_std, shimmed_std, improvement_std])
-    rows.append(["masked_region", "MAE", unshimmed_mae, shimmed_mae, improvement_mae])
-    rows.append(["masked_region", "RMSE", unshimmed_rmse, shimmed_rmse, improvement_rmse])
-    # Metrics for the segmentation (SC) region, if available
-    if category != "seg":
-        rows.append(["segmentation", "Std", unshimmed_std_sc, shimmed_std_sc, improvement_std_sc])
-        rows.append(["segmentation", "MAE", unshimmed_mae_sc, shimmed_mae_sc, improvement_mae_sc])
-        rows.append(["segmentation", "RMSE", unshimmed_rmse_sc, shimmed_rmse_sc, improvement_rmse_sc])
-
-    # Save results to CSV
-    print(f"Saving results for {category}...")
-    with open(os.path.join(output_path, f"shim_stats_{category}.csv"), "w") as f:
-        f.write("Region,Metric,Unshimmed,Shimmed,Improvement\n")
-        for row in rows:
-            f.write(",".join(map(str, row)) + "\n")
-    print(f"Shim stats for {category} saved in {output_path}/shim_stats_{category}.csv")
-
-# Assemble all the results in a single CSV file
-print("\nAssembling all results in a single CSV file...")
-with open(os.path.join(output_path, "all_shim_stats.csv"), "w") as f:
-    f.write("Category,Region,Metric,Unshimmed,Shimmed,Improvement\n")
-    for category in categories:
-        with open(os.path.join(output_path, f"shim_stats_{category}.csv"), "r") as f2:
-            lines = f2.readlines()[1:]  # Skip the header
-            for line in lines:
-                f.write(f"{category},{line}")
-print(f"All shim stats saved in {output_path}/all_shim_stats.csv")
-
-print("\nAll done!")
+    for i_category, category in enumerate(CATEGORIES):
+        # Metrics for the whole masked region, then for the segmentation (SC) region if it is not the masked region
+        regions = [("masked_region", i_category)]
+        if category != "seg":
+            regions.append(("segmentation", 0))
+
+        for region, i_mask in regions:
+            for metric, metric_name in [("std", "Std"), ("mae", "MAE"), ("rmse", "RMSE")]:
+                unshimmed = metrics[metric][0, i_mask]
+                shimmed = metrics[metric][i_category + 1, i_mask]
+                rows.append([category, region, metric_name, unshimmed, shimmed, (unshimmed - shimmed) / unshimmed])
+
+    df = pd.DataFrame(rows, columns=["Category", "Region", "Metric", "Unshimmed", "Shimmed", "Improvement"])
+    fname_partition = write_results(store_dir, "shim_stats", subject_name, session_name, df)
+    print(f"[{subject_name}] All shim stats saved in {fname_partition}")
+
+    return df
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    sessions = [tuple(session) for session in args.session or []]
+    if args.manifest is not None:
+        sessions += read_manifest(args.manifest)
+    if not sessions:
+        parser.error('At least one session must be given with -session or -manifest.')
+    data_dir = os.path.abspath(args.data_dir)
+    store_dir = args.store if args.store is not None else os.path.join(data_dir, "results_store")
+
+    # Each session is processed by a single worker, which loads each of its fieldmaps once
+    num_workers = max(1, min(args.num_workers, len(sessions)))
+    print(f"Computing the shim stats of {len(sessions)} session(s) with {num_workers} worker(s)...")
+    num_done = 0
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(compute_session_stats, data_dir, store_dir, date, acdc_number): (date, acdc_number)
+                   for date, acdc_number in sessions}
+        for future in concurrent.futures.as_completed(futures):
+            date, acdc_number = futures[future]
+            try:
+                future.result()
+                num_done += 1
+            except Exception as e:
+                print(f"Error while processing the session {date}-acdc_{acdc_number}: {e}")
+                failed.append((date, acdc_number))
+
+    print(f"\nShim stats of {num_done} session(s) saved in {store_dir}")
+
+    if failed:
+        print(f"{len(failed)} session(s) failed: {', '.join(f'{date}-acdc_{number}' for date, number in failed)}")
+        sys.exit(1)
+
+    print("\nAll done!")
+
+
+if __name__ == '__main__':
+    main()
@@ -19,57 +19,74 @@ OUTPUT_PATH="${DICOMS_PATH%/*}/sub-$SUBJECT_NAME/"
 FMAP_DIR_PATH="${DICOMS_PATH%/*}/fmap-$SUBJECT_NAME/"
 SORTED_DICOMS_PATH="${DICOMS_PATH%/*}/sorted_dicoms_opt/"
 
-CATEGORIES=("baseline" "seg" "bin" "2lvl" "lin" "gaus")
-for CATEGORY in "${CATEGORIES[@]}"; do
-   
+# Each category is only processed again if its dicoms or the mask changed since its last run (see
+# ../experiment_scripts/stage_manifest.py). Without verification, all the categories are processed.
+MANIFEST_DIR="${OUTPUT_PATH}/derivatives/manifests"
+FNAME_BIN_MASK_FM="${OUTPUT_PATH}/derivatives/masks/sct_bin_mask_fm.nii.gz"
+FORCE=""
+if [ $VERIFICATION != 1 ]; then
+    FORCE="-force"
+fi
+
+# Sort and convert the dicoms of a category and prepare its fieldmap
+prepare_category_fieldmap() {
+    CATEGORY=$1
     CATEGORY_PATH="$SORTED_DICOMS_PATH/$CATEGORY"
-    if [ $VERIFICATION == 1 ] && [ -f "${FMAP_DIR_PATH}/sub-${SUBJECT_NAME}_fmap_${CATEGORY}.nii.gz" ]; then
-        echo -e "${CATEGORY} dicoms already sorted and converted to nifti. Skipping these steps...\n"
-    else
-        # Reorganize dicoms paths
-        echo -e "Reorganizing ${CATEGORY} dicoms paths..."
-        mkdir -p "$CATEGORY_PATH"
-        FMAP_PATHS=$(find "$DICOMS_PATH" -type d -iname "*gre_fmap_epi*" -iname "*_${CATEGORY}*")
-
-        for FMAP_PATH in $FMAP_PATHS; do
-            if [ -d "$FMAP_PATH" ]; then
-                cp -r "$FMAP_PATH" "$CATEGORY_PATH/"
-            fi
-        done
-
-        echo -e "All ${CATEGORY} dicoms sorted successfully.\n"
-
-        # Convert dicoms to nifti
-        NIFTI_PATH="${OUTPUT_PATH}/derivatives/nifti/${CATEGORY}"
-        echo -e "Converting ${CATEGORY} dicoms to nifti..."
-        st_dicom_to_nifti -i $CATEGORY_PATH --subject $SUBJECT_NAME -o $NIFTI_PATH
-        echo -e "All ${CATEGORY} dicoms converted successfully.\n"
-        
-        # Move and rename the fieldmap file
-        echo -e "Moving and renaming the fieldmap file...\n"
-        MAGNITUDE_PATH=$(find $NIFTI_PATH/sub-$SUBJECT_NAME/fmap -name "sub-${SUBJECT_NAME}_magnitude1.nii.gz")
-        PHASE1_PATH=$(find $NIFTI_PATH/sub-$SUBJECT_NAME/fmap -name "sub-${SUBJECT_NAME}_phase1.nii.gz")
-        PHASE2_PATH=$(find $NIFTI_PATH/sub-$SUBJECT_NAME/fmap -name "sub-${SUBJECT_NAME}_phase2.nii.gz")
-        echo -e "\nCreating fieldmap..."
-
-        st_prepare_fieldmap $PHASE1_PATH $PHASE2_PATH \
-        --mag $MAGNITUDE_PATH \
-        --unwrapper prelude \
-        --gaussian-filter true \
-        --mask "${OUTPUT_PATH}/derivatives/masks/sct_bin_mask_fm.nii.gz" \
-        --sigma 1 \
-        -o "${FMAP_DIR_PATH}/sub-${SUBJECT_NAME}_fmap_${CATEGORY}.nii.gz" \
-
-        # Remove unwanted directories if they exist
-        echo -e "\nRemoving unwanted directories..."
-        for DIR in derivatives sourcedata tmp_dcm2bids sub-$SUBJECT_NAME; do
-            if [ -d "$NIFTI_PATH/$DIR" ]; then
-                rm -rf "$NIFTI_PATH/$DIR"
-            fi
-        done
-
-    fi
 
+    # Reorganize dicoms paths
+    echo -e "Reorganizing ${CATEGORY} dicoms paths..."
+    mkdir -p "$CATEGORY_PATH"
+    FMAP_PATHS=$(find "$DICOMS_PATH" -type d -iname "*gre_fmap_epi*" -iname "*_${CATEGORY}*")
+
+    for FMAP_PATH in $FMAP_PATHS; do
+        if [ -d "$FMAP_PATH" ]; then
+            cp -r "$FMAP_PATH" "$CATEGORY_PATH/"
+        fi
+    done
+
+    echo -e "All ${CATEGORY} dicoms sorted successfully.\n"
+
+    # Convert dicoms to nifti
+    NIFTI_PATH="${OUTPUT_PATH}/derivatives/nifti/${CATEGORY}"
+    echo -e "Converting ${CATEGORY} dicoms to nifti..."
+    st_dicom_to_nifti -i $CATEGORY_PATH --subject $SUBJECT_NAME -o $NIFTI_PATH
+    echo -e "All ${CATEGORY} dicoms converted successfully.\n"
+
+    # Move and rename the fieldmap file
+    echo -e "Moving and renaming the fieldmap file...\n"
+    MAGNITUDE_PATH=$(find $NIFTI_PATH/sub-$SUBJECT_NAME/fmap -name "sub-${SUBJECT_NAME}_magnitude1.nii.gz")
+    PHASE1_PATH=$(find $NIFTI_PATH/sub-$SUBJECT_NAME/fmap -name "sub-${SUBJECT_NAME}_phase1.nii.gz")
+    PHASE2_PATH=$(find $NIFTI_PATH/sub-$SUBJECT_NAME/fmap -name "sub-${SUBJECT_NAME}_phase2.nii.gz")
+    echo -e "\nCreating fieldmap..."
+
+    st_prepare_fieldmap $PHASE1_PATH $PHASE2_PATH \
+    --mag $MAGNITUDE_PATH \
+    --unwrapper prelude \
+    --gaussian-filter true \
+    --mask "$FNAME_BIN_MASK_FM" \
+    --sigma 1 \
+    -o "${FMAP_DIR_PATH}/sub-${SUBJECT_NAME}_fmap_${CATEGORY}.nii.gz" || return 1
+
+    # Remove unwanted directories if they exist
+    echo -e "\nRemoving unwanted directories..."
+    for DIR in derivatives sourcedata tmp_dcm2bids sub-$SUBJECT_NAME; do
+        if [ -d "$NIFTI_PATH/$DIR" ]; then
+            rm -rf "$NIFTI_PATH/$DIR"
+        fi
+    done
+}
+# The stages run the function in a new bash process
+export -f prepare_category_fieldmap
+export DICOMS_PATH SUBJECT_NAME OUTPUT_PATH FMAP_DIR_PATH SORTED_DICOMS_PATH FNAME_BIN_MASK_FM
+
+CATEGORIES=("baseline" "seg" "bin" "2lvl" "lin" "gaus")
+for CATEGORY in "${CATEGORIES[@]}"; do
+    FMAP_PATHS=$(find "$DICOMS_PATH" -type d -iname "*gre_fmap_epi*" -iname "*_${CATEGORY}*")
+    python "${SCRIPT_DIR}/../experiment_scripts/stage_manifest.py" -manifest-dir "$MANIFEST_DIR" $FORCE \
+        -name "fmap_${CATEGORY}" -inputs $FMAP_PATHS "$FNAME_BIN_MASK_FM" \
+        -outputs "${FMAP_DIR_PATH}/sub-${SUBJECT_NAME}_fmap_${CATEGORY}.nii.gz" \
+        -- bash -c 'prepare_category_fieldmap "$1"' _ "$CATEGORY" || echo -e "Error while processing the ${CATEGORY} fieldmap."
+    echo ""
 done
 
 # Remove the NIFTI folder if it exists
@@ -0,0 +1,122 @@
+"""
+Compact representation of the voxels of a volume that are inside one or more masks.
+
+The statistics of the fieldmaps only use the few thousand voxels of the spinal cord, but loading the fieldmaps with
+get_fdata allocates full float64 volumes. A MaskedVolume keeps the flat indices of the voxels inside at least one of
+the masks, their slice, the weight of each mask in these voxels and the values of the volumes gathered in them, in
+float32. When gathered from a NIfTI file, only the bounding box of the masks is read. Memory and computations then scale
+with the size of the masked region instead of the field of view. The sums over the voxels are done in float64.
+
+Example usage:
+    from masked_volume import MaskedVolume
+    masked = MaskedVolume.from_masks([mask_data], affine=nii_mask.affine)
+    masked.add_volumes([nii_fmap_baseline, nii_fmap_shimmed])
+    masked.values  # (2, n_voxels) fieldmap values in the mask
+    masked.weights  # (1, n_voxels) mask values
+"""
+
+import numpy as np
+
+
+class MaskedVolume:
+    """
+    Voxels of a volume that are inside at least one mask, with the weights of the masks and the values of the volumes
+    """
+
+    def __init__(self, shape, indices, weights, affine=None):
+        """
+        :param shape: spatial shape of the full volume, e.g. (x, y, z)
+        :param indices: (n_voxels,) sorted flat indices of the voxels in the full volume (C order)
+        :param weights: (n_masks, n_voxels) weights of each mask in the voxels, 0 outside of a mask
+        :param affine: affine of the full volume, used to check the volumes that are gathered
+        """
+        self.shape = tuple(shape)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float32).reshape(-1, len(self.indices))
+        self.affine = None if affine is None else np.asarray(affine, dtype=np.float64)
+        self.values = np.empty((0, len(self.indices)), dtype=np.float32)
+        self.coords = np.unravel_index(self.indices, self.shape)
+
+    @classmethod
+    def from_masks(cls, masks, affine=None):
+        """
+        Gather the voxels that are inside at least one of the masks
+        :param masks: list of mask arrays with the same shape. The voxels where a mask is 0 or NaN are outside of it.
+        :param affine: affine of the masks
+        :return: masked: MaskedVolume with the weights of the masks
+        """
+        masks = [np.asarray(mask) for mask in masks]
+        shape = masks[0].shape
+        for mask in masks:
+            if mask.shape != shape:
+                raise ValueError(f"All the masks must have the same shape, got {mask.shape} and {shape}")
+
+        inside = np.zeros(shape, dtype=bool)
+        for mask in masks:
+            inside |= (mask != 0) & ~np.isnan(mask)
+        indices = np.flatnonzero(inside)
+        weights = np.stack([np.nan_to_num(mask.ravel()[indices]) for mask in masks])
+        return cls(shape, indices, weights, affine=affine)
+
+    @property
+    def num_voxels(self):
+        return len(self.indices)
+
+    @property
+    def slices(self):
+        """
+        :return: slices: (n_voxels,) index of the slice (last axis) of each voxel
+        """
+        return self.coords[-1]
+
+    def get_bounding_box(self):
+        """
+        :return: bounding_box: tuple of slices of the smallest box containing all the voxels
+        """
+        if self.num_voxels == 0:
+            return tuple(slice(0, 0) for _ in self.shape)
+        return tuple(slice(int(coord.min()), int(coord.max()) + 1) for coord in self.coords)
+
+    def gather(self, volume):
+        """
+        Get the values of a volume in the voxels
+        :param volume: array with the shape of the full volume, or nibabel image on the same grid. Only the bounding box
+                       of the voxels of an image is read.
+        :return: values: (n_voxels,) float32 values of the volume in the voxels
+        """
+        bounding_box = self.get_bounding_box()
+        if hasattr(volume, 'dataobj'):
+            if tuple(volume.shape[:len(self.shape)]) != self.shape:
+                raise ValueError(f"The image has a shape of {volume.shape}, expected {self.shape}")
+            if self.affine is not None and not np.allclose(volume.affine, self.affine, atol=1e-4):
+                raise ValueError("The image is not on the grid of the masks, resample it first")
+            box = np.asarray(volume.dataobj[bounding_box], dtype=np.float32)
+        else:
+            if np.shape(volume) != self.shape:
+                raise ValueError(f"The volume has a shape of {np.shape(volume)}, expected {self.shape}")
+            box = np.asarray(volume[bounding_box], dtype=np.float32)
+
+        coords_in_box = tuple(coord - box_slice.start for coord, box_slice in zip(self.coords, bounding_box))
+        return box[coords_in_box]
+
+    def add_volumes(self, volumes):
+        """
+        Gather volumes and append their values to self.values
+        :param volumes: list of arrays or nibabel images (see gather)
+        :return: values: (n_volumes, n_voxels) values of the added volumes
+        """
+        values = np.stack([self.gather(volume) for volume in volumes]) if volumes else \
+            np.empty((0, self.num_voxels), dtype=np.float32)
+        self.values = np.concatenate([self.values, values])
+        return values
+
+    def to_volume(self, values, fill_value=np.nan):
+        """
+        Put values of the voxels back in a full volume
+        :param values: (n_voxels,) values
+        :param fill_value: value of the voxels outside of the masks
+        :return: volume: array with the shape of the full volume
+        """
+        volume = np.full(self.shape, fill_value, dtype=np.result_type(values, type(fill_value)))
+        volume.ravel()[self.indices] = values
+        return volume
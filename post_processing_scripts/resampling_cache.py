@@ -0,0 +1,106 @@
+"""
+In-process cache for the resampling of masks and images to a target grid.
+
+The statistics and figure scripts resample the same masks to the same fieldmap or EPI grids many times. The result of
+a resampling is stored under the identity of the source image (file, size and modification time, or the data itself
+for an image that was not loaded from a file), the target grid (shape and affine) and the resampling method, so that
+each source is resampled once per target grid and per run. The fieldmaps of a subject share one geometry: a mask
+resampled to one of them is reused for all the others.
+
+The cached data is read-only. Copy it before modifying it in place.
+
+Example usage:
+    from resampling_cache import resample_mask
+    nii_resampled_mask = resample_mask(nii_mask, nii_fmap)
+"""
+
+import hashlib
+import os
+
+import nibabel as nib
+import numpy as np
+
+_cache = {}
+
+
+def get_image_id(nii):
+    """
+    Identify the content of an image
+    :param nii: nibabel image
+    :return: image_id: tuple identifying the image
+    """
+    fname = nii.get_filename()
+    if fname is not None and os.path.isfile(fname):
+        stat = os.stat(fname)
+        return os.path.abspath(fname), stat.st_size, stat.st_mtime_ns
+    # Image created in memory: hash its data and its geometry
+    data = np.ascontiguousarray(np.asanyarray(nii.dataobj))
+    sha = hashlib.sha256()
+    sha.update(str((data.dtype.str, data.shape)).encode('utf-8'))
+    sha.update(data.tobytes())
+    sha.update(np.asarray(nii.affine, dtype=np.float64).tobytes())
+    return sha.hexdigest(),
+
+
+def get_grid_id(nii):
+    """
+    Identify the grid of an image
+    :param nii: nibabel image
+    :return: grid_id: tuple with the spatial shape and the affine of the image
+    """
+    return tuple(nii.shape[:3]), np.asarray(nii.affine, dtype=np.float64).round(6).tobytes()
+
+
+def cached_resample(method, nii_source, nii_target, resample_func):
+    """
+    Resample an image with resample_func, or return the result of a previous identical resampling
+    :param method: name and parameters of the resampling, part of the cache key
+    :param nii_source: image to resample
+    :param nii_target: image defining the target grid
+    :param resample_func: function of (nii_source, nii_target) returning the resampled image
+    :return: nii_resampled: resampled image, a new image object sharing the read-only cached data
+    """
+    key = (method, get_image_id(nii_source), get_grid_id(nii_target))
+    if key not in _cache:
+        nii_resampled = resample_func(nii_source, nii_target)
+        data = np.asanyarray(nii_resampled.dataobj)
+        data.flags.writeable = False
+        _cache[key] = (data, nii_resampled.affine, nii_resampled.header)
+    data, affine, header = _cache[key]
+    return nib.Nifti1Image(data, affine, header)
+
+
+def resample_mask(nii_mask, nii_target):
+    """
+    Cached version of shimmingtoolbox's resample_mask
+    :param nii_mask: mask to resample
+    :param nii_target: image defining the target grid, e.g. a fieldmap
+    :return: nii_resampled_mask: mask resampled to the target grid
+    """
+    from shimmingtoolbox.masking.mask_utils import resample_mask as st_resample_mask
+    return cached_resample('st_resample_mask', nii_mask, nii_target, st_resample_mask)
+
+
+def resample_from_to(nii_source, nii_target, order=3, mode='constant', cval=0.0):
+    """
+    Cached version of nibabel's resample_from_to
+    :param nii_source: image to resample
+    :param nii_target: image defining the target grid
+    :param order: order of the spline interpolation
+    :param mode: how the points outside the source image are filled
+    :param cval: value of the points outside the source image when mode is 'constant'
+    :return: nii_resampled: image resampled to the target grid
+    """
+    from nibabel.processing import resample_from_to as nib_resample_from_to
+
+    def resample(nii, nii_ref):
+        return nib_resample_from_to(nii, nii_ref, order=order, mode=mode, cval=cval)
+
+    return cached_resample(('nib_resample_from_to', order, mode, cval), nii_source, nii_target, resample)
+
+
+def clear_cache():
+    """
+    Remove all the cached resamplings
+    """
+    _cache.clear()
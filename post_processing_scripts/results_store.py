@@ -0,0 +1,114 @@
+"""
+Columnar store of the results of all the sessions (shimming statistics, tSNR...).
+
+Each table of the store is a folder of Parquet files partitioned by subject and session:
+    <store_dir>/<table>/subject=<subject>/session=<session>/results.parquet
+Writing the results of a session replaces its partition atomically (the file is written next to its final path and
+then renamed), so that a session can be added or recomputed while other sessions are written or read. The figure
+scripts read the tables directly, with the column types they were written with, and can restrict the read to some
+subjects or sessions without opening the other partitions.
+
+pandas and pyarrow are required.
+
+The script exports a table to a CSV file to look at the results.
+
+Example usage:
+    python results_store.py -store <data_dir>/results_store -table shim_stats -o shim_stats.csv
+"""
+
+import argparse
+import glob
+import os
+import tempfile
+
+import pandas as pd
+
+PARTITION_FILE = 'results.parquet'
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Export a table of the results store to a CSV file.')
+    parser.add_argument('-store', required=True, type=str, help='Results store folder.')
+    parser.add_argument('-table', required=True, type=str, help='Table to export, e.g. shim_stats or tsnr.')
+    parser.add_argument('-subjects', nargs='+', type=str, help='Only export these subjects. Default: all')
+    parser.add_argument('-sessions', nargs='+', type=str, help='Only export these sessions. Default: all')
+    parser.add_argument('-o', required=True, type=str, help='Output CSV file.')
+
+    return parser
+
+
+def get_partition_path(store_dir, table, subject, session):
+    """
+    Get the path of the file holding the results of a session
+    :param store_dir: results store folder
+    :param table: name of the table, e.g. shim_stats
+    :param subject: name of the subject, e.g. acdc274
+    :param session: name of the session, e.g. 2025.05.12-acdc_274
+    :return: fname_partition: path to the Parquet file of the partition
+    """
+    return os.path.join(store_dir, table, f"subject={subject}", f"session={session}", PARTITION_FILE)
+
+
+def write_results(store_dir, table, subject, session, df):
+    """
+    Write the results of a session, replacing its previous results if any
+    :param store_dir: results store folder
+    :param table: name of the table, e.g. shim_stats
+    :param subject: name of the subject, e.g. acdc274
+    :param session: name of the session, e.g. 2025.05.12-acdc_274
+    :param df: DataFrame with the results of the session, without the subject and session columns
+    :return: fname_partition: path to the written Parquet file
+    """
+    fname_partition = get_partition_path(store_dir, table, subject, session)
+    os.makedirs(os.path.dirname(fname_partition), exist_ok=True)
+
+    # Write then rename so that a reader never sees a partially written partition
+    fd, fname_tmp = tempfile.mkstemp(prefix='tmp', suffix='.parquet', dir=os.path.dirname(fname_partition))
+    os.close(fd)
+    try:
+        df.to_parquet(fname_tmp, index=False)
+        os.replace(fname_tmp, fname_partition)
+    except BaseException:
+        os.remove(fname_tmp)
+        raise
+    return fname_partition
+
+
+def read_results(store_dir, table, subjects=None, sessions=None):
+    """
+    Read the results of a table
+    :param store_dir: results store folder
+    :param table: name of the table, e.g. shim_stats
+    :param subjects: list of subjects to read, None to read all of them
+    :param sessions: list of sessions to read, None to read all of them
+    :return: df: DataFrame with the results of the selected sessions and their subject and session columns
+    """
+    dfs = []
+    for fname_partition in sorted(glob.glob(get_partition_path(store_dir, table, '*', '*'))):
+        session_dir = os.path.dirname(fname_partition)
+        subject = os.path.basename(os.path.dirname(session_dir)).split('=', 1)[1]
+        session = os.path.basename(session_dir).split('=', 1)[1]
+        if (subjects is not None and subject not in subjects) or (sessions is not None and session not in sessions):
+            continue
+        df = pd.read_parquet(fname_partition)
+        df.insert(0, 'Session', session)
+        df.insert(0, 'Subject', subject)
+        dfs.append(df)
+
+    if not dfs:
+        raise FileNotFoundError(f"No results found in the table {table} of {store_dir}")
+    return pd.concat(dfs, ignore_index=True)
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    df = read_results(args.store, args.table, subjects=args.subjects, sessions=args.sessions)
+    df.to_csv(args.o, index=False)
+    print(f"{len(df)} rows of the table {args.table} saved in {args.o}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Lazy loading and resampling of the region of interest of a volume.
+
+The figures only show the few voxels around the spinal cord, but get_fdata and the resampling of whole fieldmaps to the
+EPI grid read, decompress and interpolate the full volumes. Here, a box (tuple of slices) is defined in the grid of the
+target image around the voxels of a mask, only the slabs of the images covering this box are read through the nibabel
+array proxies (img.slicer), and the source images are resampled into the box of the target grid only. For the
+interpolation orders 0 and 1, the resampled box is identical to the same box of the full resampling.
+
+Reading a slab of a .nii.gz file still decompresses the file up to the end of the slab. Installing indexed_gzip lets
+nibabel seek in the compressed files.
+
+Example usage:
+    from roi_loading import get_nonzero_box, transform_box, load_roi, resample_roi
+    box = transform_box(get_nonzero_box(nii_mask.get_fdata()), nii_mask, nii_epi, padding=11)
+    nii_epi_roi = load_roi(nii_epi, box)
+    nii_fmap_roi = resample_roi(nii_fmap, nii_epi, box, order=1)
+"""
+
+import itertools
+
+import nibabel as nib
+import numpy as np
+from nibabel.processing import resample_from_to
+
+
+def get_nonzero_box(data, padding=0):
+    """
+    Get the smallest box containing the nonzero voxels of a volume
+    :param data: 3D array, e.g. a mask
+    :param padding: number of voxels added on each side of the box, the box is clipped to the volume
+    :return: box: tuple of slices, a box of size 0 if all the voxels are 0
+    """
+    coords = np.nonzero(np.nan_to_num(data))
+    if len(coords[0]) == 0:
+        return tuple(slice(0, 0) for _ in data.shape)
+    return tuple(slice(max(int(coord.min()) - padding, 0), min(int(coord.max()) + 1 + padding, size))
+                 for coord, size in zip(coords, data.shape))
+
+
+def transform_box(box, nii_from, nii_to, padding=0):
+    """
+    Get the box of a grid covering a box of another grid
+    :param box: tuple of slices in the voxels of nii_from
+    :param nii_from: image defining the grid of the box
+    :param nii_to: image defining the grid of the output box
+    :param padding: number of voxels added on each side of the output box, the box is clipped to nii_to
+    :return: box_to: tuple of slices in the voxels of nii_to
+    """
+    shape_to = nii_to.shape[:3]
+    if any(s.stop <= s.start for s in box):
+        return tuple(slice(0, 0) for _ in shape_to)
+
+    # Corners of the voxels at the edges of the box, in the voxels of nii_to
+    corners = np.array(list(itertools.product(*[(s.start - 0.5, s.stop - 0.5) for s in box])))
+    transform = np.linalg.inv(nii_to.affine) @ nii_from.affine
+    corners_to = corners @ transform[:3, :3].T + transform[:3, 3]
+
+    starts = np.floor(corners_to.min(axis=0)).astype(int) - padding
+    stops = np.ceil(corners_to.max(axis=0)).astype(int) + 1 + padding
+    return tuple(slice(int(np.clip(start, 0, size)), int(np.clip(stop, 0, size)))
+                 for start, stop, size in zip(starts, stops, shape_to))
+
+
+def load_roi(nii, box):
+    """
+    Read the box of an image, without reading the rest of the volume
+    :param nii: nibabel image
+    :param box: tuple of slices in the voxels of the image
+    :return: nii_roi: image of the box, with the affine of its position in the image
+    """
+    return nii.slicer[box]
+
+
+def resample_roi(nii_source, nii_target, box, order=1, mode='grid-constant', cval=0.0):
+    """
+    Resample an image into a box of the grid of a target image. Only the region of the source image covering the box
+    is read.
+    :param nii_source: image to resample
+    :param nii_target: image defining the target grid
+    :param box: tuple of slices in the voxels of the target image
+    :param order: order of the spline interpolation, the result is the same as the full resampling for 0 and 1
+    :param mode: how the points outside the source image are filled
+    :param cval: value of the points outside the source image when mode is 'constant' or 'grid-constant'
+    :return: nii_resampled: source image resampled into the box of the target grid
+    """
+    roi_shape = tuple(s.stop - s.start for s in box)
+    roi_affine = nii_target.affine.copy()
+    roi_affine[:3, 3] = nii_target.affine[:3, :3] @ [s.start for s in box] + nii_target.affine[:3, 3]
+
+    # The interpolation uses the source voxels next to the target points: read them with a margin of the order
+    source_box = transform_box(box, nii_target, nii_source, padding=max(order, 1))
+    if any(s.stop <= s.start for s in source_box):
+        # The box is outside of the source image
+        return nib.Nifti1Image(np.full(roi_shape, cval), roi_affine)
+    nii_source_roi = load_roi(nii_source, source_box)
+    return resample_from_to(nii_source_roi, (roi_shape, roi_affine), order=order, mode=mode, cval=cval)
+
+
+def paste_roi(data_roi, box, shape, fill_value=0):
+    """
+    Put the data of a box back in a full volume
+    :param data_roi: array with the shape of the box
+    :param box: tuple of slices
+    :param shape: shape of the full volume
+    :param fill_value: value of the voxels outside of the box
+    :return: data: array with the shape of the full volume
+    """
+    data = np.full(shape, fill_value, dtype=np.result_type(data_roi, type(fill_value)))
+    data[box] = data_roi
+    return data
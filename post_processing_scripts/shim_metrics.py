@@ -0,0 +1,55 @@
+"""
+Fused computation of the shimming metrics of several fieldmaps within several masks.
+
+calculate_metric_within_mask from shimmingtoolbox computes one metric of one fieldmap within one mask and scans the
+whole volume each time. Here, the fieldmaps are stacked, the voxels inside at least one of the masks are gathered once
+in a MaskedVolume and every weighted metric (mean, std, MAE, MSE, RMSE) of every (fieldmap, mask) pair is computed from
+these voxels. The values are the same as calculate_metric_within_mask, up to the float32 storage of the voxels: the mask
+values are the weights and the voxels where the mask is 0 are ignored.
+
+Example usage:
+    from shim_metrics import compute_metrics_within_masks
+    metrics = compute_metrics_within_masks([baseline_data, shimmed_data], [mask_data, seg_mask_data])
+    shimmed_std_in_seg = metrics['std'][1, 1]
+"""
+
+import numpy as np
+
+from masked_volume import MaskedVolume
+
+METRICS = ['mean', 'std', 'mae', 'mse', 'rmse']
+
+
+def compute_metrics_in_masked_volume(masked):
+    """
+    Compute the weighted metrics of every volume of a MaskedVolume within every one of its masks
+    :param masked: MaskedVolume with n_masks weights and n_fieldmaps gathered volumes
+    :return: metrics: dict with a (n_fieldmaps, n_masks) array for each metric of METRICS
+    """
+    values = masked.values.astype(np.float64)
+    weights = masked.weights.astype(np.float64)
+
+    # Weighted sums over the voxels of every (fieldmap, mask) pair, as (n_fieldmaps, n_masks) matrices
+    sum_weights = weights.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = values @ weights.T / sum_weights
+        mae = np.abs(values) @ weights.T / sum_weights
+        mse = values ** 2 @ weights.T / sum_weights
+        # The deviation from the mean is computed for each pair to get the same precision as the two-pass std
+        deviations = values[:, np.newaxis, :] - mean[:, :, np.newaxis]
+        std = np.sqrt(np.einsum('fmv,mv->fm', deviations ** 2, weights) / sum_weights)
+
+    return {'mean': mean, 'std': std, 'mae': mae, 'mse': mse, 'rmse': np.sqrt(mse)}
+
+
+def compute_metrics_within_masks(fieldmaps, masks):
+    """
+    Compute the weighted metrics of every fieldmap within every mask
+    :param fieldmaps: list of n_fieldmaps arrays or nibabel images, e.g. the baseline and the shimmed fieldmaps
+    :param masks: list of n_masks weight arrays on the same grid as the fieldmaps
+    :return: metrics: dict with a (n_fieldmaps, n_masks) array for each metric of METRICS.
+                      metrics[metric][i, j] is calculate_metric_within_mask(fieldmaps[i], masks[j], metric)
+    """
+    masked = MaskedVolume.from_masks(masks)
+    masked.add_volumes(fieldmaps)
+    return compute_metrics_in_masked_volume(masked)
@@ -0,0 +1,256 @@
+"""
+This script benchmarks the softmask methods of shimmingtoolbox on the phantoms of fig_softmaks.py (binary sphere and
+2D Gaussian), for a range of matrix sizes, voxel sizes (anisotropy) and blur widths.
+
+The phantoms are saved as NIfTI files with the voxel size in their affine, and each method is called on them the same
+way as fig_softmaks.py, so the time includes the loading of the files by shimmingtoolbox. Each case is run once to warm
+up, then -repeats times. For each case, the script records the median wall time, the peak memory (RSS) of the process
+and the throughput in voxels per second.
+
+The results are saved per commit of this repository in <output>/softmask_benchmark_<commit>.csv, with the version of
+shimmingtoolbox. Running the benchmark again at the same commit replaces the results of the cases run again. The median
+times are compared with the results of a previous commit (-baseline, by default the last saved commit) and the cases
+slower by more than -tolerance are reported as regressions.
+
+Example usage:
+    python benchmark_softmasks.py -o softmask_benchmark
+    python benchmark_softmasks.py -sizes 64 128 -voxel-sizes 1,1,1 0.5,0.5,3 -widths 2 6 -methods 2levels linear
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from fig_softmaks import make_phantoms
+from shimmingtoolbox.masking.mask_utils import (
+    basic_softmask,
+    linear_softmask,
+    gaussian_filter_softmask,
+    gaussian_sct_softmask
+)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(SCRIPT_DIR, "..", "experiment_scripts"))
+from inference_profiling import get_peak_rss, reset_peak_rss
+
+# Softmask methods, called with the binary phantom, the Gaussian phantom and the blur width
+METHODS = {
+    '2levels': lambda fname_bin, fname_gss, width: basic_softmask(fname_bin, width, 0.5),
+    'linear': lambda fname_bin, fname_gss, width: linear_softmask(fname_bin, width),
+    'gaussian': lambda fname_bin, fname_gss, width: gaussian_filter_softmask(fname_bin, width),
+    'hybrid': lambda fname_bin, fname_gss, width: gaussian_sct_softmask(fname_bin, fname_gss),
+}
+# Methods without blur width, run once per matrix size and voxel size
+METHODS_WITHOUT_WIDTH = ['hybrid']
+CASE_COLUMNS = ['method', 'size', 'voxel_size', 'width']
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Benchmark the softmask methods for different matrix sizes, voxel '
+                                                 'sizes and blur widths.')
+    parser.add_argument('-o', default='softmask_benchmark', type=str,
+                        help='Output folder of the results of each commit. Default: softmask_benchmark')
+    parser.add_argument('-methods', nargs='+', default=list(METHODS), choices=list(METHODS),
+                        help='Softmask methods to benchmark. Default: all of them')
+    parser.add_argument('-sizes', nargs='+', default=[32, 64, 128], type=int,
+                        help='Matrix sizes of the cubic phantoms. Default: 32 64 128')
+    parser.add_argument('-voxel-sizes', nargs='+', default=['1,1,1', '1,1,3', '0.5,0.5,5'], type=str,
+                        help='Voxel sizes in mm, as comma-separated values. Default: 1,1,1 1,1,3 0.5,0.5,5')
+    parser.add_argument('-widths', nargs='+', default=[2, 6, 12], type=int,
+                        help='Blur widths given to the methods, in voxels as in fig_softmaks.py. Default: 2 6 12')
+    parser.add_argument('-repeats', default=3, type=int, help='Number of timed runs of each case. Default: 3')
+    parser.add_argument('-baseline', type=str,
+                        help='Commit whose results are compared with this run. Default: the last saved commit')
+    parser.add_argument('-tolerance', default=0.2, type=float,
+                        help='Relative increase of the median time reported as a regression. Default: 0.2')
+
+    return parser
+
+
+def get_commit():
+    """
+    Get the commit of this repository
+    :return: commit: short hash of HEAD, with a -dirty suffix if the tree has uncommitted changes, "unknown" outside of
+                     a git repository
+    """
+    try:
+        commit = subprocess.run(['git', '-C', SCRIPT_DIR, 'rev-parse', '--short', 'HEAD'], check=True,
+                                capture_output=True, text=True).stdout.strip()
+        status = subprocess.run(['git', '-C', SCRIPT_DIR, 'status', '--porcelain', '--untracked-files=no'],
+                                check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f"{commit}-dirty" if status else commit
+
+
+def get_shimmingtoolbox_version():
+    try:
+        from importlib.metadata import version
+        return version('shimmingtoolbox')
+    except Exception:
+        return 'unknown'
+
+
+def benchmark_case(method, fname_bin, fname_gss, width, repeats):
+    """
+    Time a softmask method on the phantoms
+    :param method: name of the method, key of METHODS
+    :param fname_bin: path to the binary phantom
+    :param fname_gss: path to the Gaussian phantom
+    :param width: blur width
+    :param repeats: number of timed runs
+    :return: times: wall time of each run in seconds
+    :return: peak_rss: peak RSS of the process during the runs in MB
+    :return: peak_rss_reset: False if the peak RSS could not be reset and covers the whole process
+    """
+    # Warm up run, so that the first timed run does not pay for the lazy imports and allocations
+    METHODS[method](fname_bin, fname_gss, width)
+
+    peak_rss_reset = reset_peak_rss()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        METHODS[method](fname_bin, fname_gss, width)
+        times.append(time.perf_counter() - start)
+    return times, get_peak_rss(), peak_rss_reset
+
+
+def get_case_keys(df):
+    # Columns identifying the cases, the NaN widths of the methods without width are replaced so that they match, and
+    # the widths are compared as floats since they are read back as floats when a method without width was run
+    return df[CASE_COLUMNS].fillna({'width': -1}).astype({'width': float})
+
+
+def compare_with_baseline(df, output_path, commit, baseline=None, tolerance=0.2):
+    """
+    Compare the median times with the results of a previous commit
+    :param df: results of this run
+    :param output_path: folder with the results of each commit
+    :param commit: commit of this run
+    :param baseline: commit to compare with, None for the last saved commit other than this one
+    :param tolerance: relative increase of the median time reported as a regression
+    :return: df_comparison: DataFrame of the cases of both runs with the time ratio, None without baseline
+    """
+    if baseline is None:
+        fnames = [fname for fname in glob.glob(os.path.join(output_path, 'softmask_benchmark_*.csv'))
+                  if os.path.basename(fname) != f'softmask_benchmark_{commit}.csv']
+        if not fnames:
+            print('No previous results to compare with.')
+            return None
+        fname_baseline = max(fnames, key=os.path.getmtime)
+    else:
+        fname_baseline = os.path.join(output_path, f'softmask_benchmark_{baseline}.csv')
+        if not os.path.isfile(fname_baseline):
+            saved = sorted(os.path.basename(fname)[len('softmask_benchmark_'):-len('.csv')]
+                           for fname in glob.glob(os.path.join(output_path, 'softmask_benchmark_*.csv')))
+            print(f"No results saved for the baseline {baseline} in {output_path}, not compared. Saved commits: "
+                  f"{', '.join(saved) if saved else 'none'}")
+            return None
+    df_baseline = pd.read_csv(fname_baseline)
+    baseline_commit = df_baseline['commit'].iloc[0]
+
+    df_comparison = pd.merge(get_case_keys(df).assign(time_s=df['time_s']),
+                             get_case_keys(df_baseline).assign(baseline_time_s=df_baseline['time_s']), on=CASE_COLUMNS)
+    df_comparison['ratio'] = df_comparison['time_s'] / df_comparison['baseline_time_s']
+    df_comparison['width'] = df_comparison['width'].replace(-1, np.nan)
+
+    regressions = df_comparison[df_comparison['ratio'] > 1 + tolerance]
+    print(f"\nComparison with {baseline_commit}: {len(df_comparison)} common case(s), median time ratio "
+          f"{df_comparison['ratio'].median():.2f}")
+    if regressions.empty:
+        print(f"No case slower by more than {tolerance:.0%}.")
+    else:
+        print(f"{len(regressions)} case(s) slower by more than {tolerance:.0%}:")
+        print(regressions.sort_values('ratio', ascending=False).to_string(index=False))
+    return df_comparison
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    voxel_sizes = []
+    for voxel_size in args.voxel_sizes:
+        values = [float(value) for value in voxel_size.split(',')]
+        if len(values) != 3:
+            parser.error(f'The voxel size {voxel_size} must have 3 values.')
+        voxel_sizes.append(values)
+    os.makedirs(args.o, exist_ok=True)
+    commit = get_commit()
+    st_version = get_shimmingtoolbox_version()
+    print(f"Benchmarking the softmasks at commit {commit} with shimmingtoolbox {st_version}...")
+
+    rows = []
+    tmpdir = tempfile.mkdtemp(prefix='softmask_benchmark_')
+    fname_bin = os.path.join(tmpdir, 'binmask.nii.gz')
+    fname_gss = os.path.join(tmpdir, 'gauss.nii.gz')
+    try:
+        for size in args.sizes:
+            # Same proportions as the phantoms of the poster (radius of 14 voxels in 64 voxels)
+            shape = (size, size, size)
+            binmask_array, gauss_array = make_phantoms(shape, radius=size * 14 / 64)
+            num_voxels = int(np.prod(shape))
+
+            for voxel_size in voxel_sizes:
+                affine = np.diag(voxel_size + [1])
+                nib.save(nib.Nifti1Image(binmask_array, affine=affine), fname_bin)
+                nib.save(nib.Nifti1Image(gauss_array, affine=affine), fname_gss)
+
+                for method in args.methods:
+                    widths = [np.nan] if method in METHODS_WITHOUT_WIDTH else args.widths
+                    for width in widths:
+                        times, peak_rss, peak_rss_reset = benchmark_case(method, fname_bin, fname_gss, width,
+                                                                         args.repeats)
+                        median_time = statistics.median(times)
+                        rows.append({
+                            'commit': commit,
+                            'shimmingtoolbox': st_version,
+                            'method': method,
+                            'size': size,
+                            'voxel_size': 'x'.join(f'{value:g}' for value in voxel_size),
+                            'width': width,
+                            'num_voxels': num_voxels,
+                            'time_s': median_time,
+                            'time_min_s': min(times),
+                            'time_max_s': max(times),
+                            'peak_rss_mb': peak_rss,
+                            'peak_rss_since_start': not peak_rss_reset,
+                            'voxels_per_s': num_voxels / median_time,
+                        })
+                        print(f"{method:>9} size={size} voxel={rows[-1]['voxel_size']} width={width:g}: "
+                              f"{median_time:.3f} s, {rows[-1]['voxels_per_s']:.3g} voxels/s, {peak_rss:.0f} MB")
+    finally:
+        for fname in [fname_bin, fname_gss]:
+            if os.path.exists(fname):
+                os.remove(fname)
+        os.rmdir(tmpdir)
+
+    # Save the results of this commit, replacing the previous results of the same cases at the same commit
+    df = pd.DataFrame(rows)
+    fname_results = os.path.join(args.o, f'softmask_benchmark_{commit}.csv')
+    if os.path.exists(fname_results):
+        df_previous = pd.read_csv(fname_results)
+        cases = set(get_case_keys(df).itertuples(index=False, name=None))
+        is_kept = np.array([case not in cases for case in get_case_keys(df_previous).itertuples(index=False, name=None)],
+                           dtype=bool)
+        df_saved = pd.concat([df_previous[is_kept], df], ignore_index=True)
+    else:
+        df_saved = df
+    df_saved.to_csv(fname_results, index=False)
+    print(f"\nResults saved in {fname_results}")
+
+    compare_with_baseline(df, args.o, commit, baseline=args.baseline, tolerance=args.tolerance)
+
+
+if __name__ == '__main__':
+    main()
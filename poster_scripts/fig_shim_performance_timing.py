@@ -1,6 +1,11 @@
+import argparse
+import os
+
 import matplotlib.pyplot as plt
 import numpy as np
 
+from shim_log_stats import load_shim_log_stats, make_data_dict
+
 def plot_shimming_performance_and_timing(data_dict, save_path=None):
     """
     Plot comparison of shimming performance (mean, std, rmse) and mask conversion time
@@ -124,15 +129,18 @@ def plot_shimming_performance_and_timing(data_dict, save_path=None):
         fig.savefig(f"{save_path}.png", dpi=300, bbox_inches='tight', facecolor=bg_color)
 
 if __name__ == "__main__":
-    data = {
-    'segmentation_binaire': {'mean': 98.68, 'std': 95.62, 'rmse': 95.79, 'time': 149.030},
-    'masque_binaire_cylindrique': {'mean': 98.09, 'std': 87.65, 'rmse': 88.20, 'time': 3.166},
-    'masque_discret_a_deux_niveaux': {'mean': 98.54, 'std': 86.56, 'rmse': 87.04, 'time': 8.234},
-    'masque_continu_lineaire': {'mean': 98.95, 'std': 86.64, 'rmse': 87.14, 'time': 2.841},
-    'masque_continu_gaussien': {'mean': 90.62, 'std': 84.02, 'rmse': 84.47, 'time': 8.995},
-    'masque_hybride_binaire_gaussien': {'mean': 94.70, 'std': 88.25, 'rmse': 88.64, 'time': 4.588},
-    }
-
-    output_path = "/Users/antoineguenette/Desktop/figures_affiche/figure_shimming_performance_timing"
-    
-    plot_shimming_performance_and_timing(data, save_path=output_path)
+    parser = argparse.ArgumentParser(description='Plot the shimming performance and the mask conversion time of each '
+                                                 'mask type, from the terminal outputs of the shimming sessions.')
+    parser.add_argument('-i', required=True, type=str, help='Folder containing the terminal output files (*.txt).')
+    parser.add_argument('-o', default="/Users/antoineguenette/Desktop/figures_affiche/figure_shimming_performance_timing",
+                        type=str, help='Output path of the figure, without extension (.svg and .png are saved).')
+    parser.add_argument('-num-workers', default=os.cpu_count(), type=int,
+                        help='Number of files processed in parallel. Default: number of CPUs')
+    args = parser.parse_args()
+
+    # Average statistics of each mask type over all the files
+    summary = load_shim_log_stats(args.i, num_workers=args.num_workers)
+    print(summary.to_string(index=False))
+    data = make_data_dict(summary)
+
+    plot_shimming_performance_and_timing(data, save_path=args.o)
@@ -12,25 +12,18 @@ from shimmingtoolbox.masking.mask_utils import (
     gaussian_sct_softmask
 )
 
-def plot_softmasks(path_output="."):
+def make_phantoms(shape, radius):
     """
-    Plot softmasks for a poster with French labels and color theme.
+    Create the phantoms of the softmasks: a binary sphere and a 2D Gaussian repeated across z, both centered in the
+    volume.
+    :param shape: shape of the volume
+    :param radius: radius of the sphere and standard deviation of the Gaussian, in voxels
+    :return: binmask_array: uint8 binary sphere
+    :return: gauss_array: float32 Gaussian, 1 at its center
     """
-
-    colors = {
-        'masque_binaire_cylindrique':      '#8B1E3F',  # accent bordeaux
-        'masque_discret_a_deux_niveaux':   '#B08D57',  # bronze 1
-        'masque_continu_lineaire':         '#A37A44',  # bronze 2
-        'masque_continu_gaussien':         '#926C3B',  # bronze 3
-        'masque_hybride_binaire_gaussien': '#7F5E32',  # bronze 4
-    }
-
-    shape = (64,64,64)
     center = np.array(shape) // 2
 
     # Create a binary mask (sphere)
-    radius = 14
-
     x = np.arange(shape[0])[:, None, None]
     y = np.arange(shape[1])[None, :, None]
     z = np.arange(shape[2])[None, None, :]
@@ -49,7 +42,26 @@ def plot_softmasks(path_output="."):
     gauss = np.repeat(gaussian_2d[:, :, None], shape[2], axis=2)
     gauss_array = gauss.astype(np.float32)
 
-    # Save temporary NIfTI files
+    return binmask_array, gauss_array
+
+def plot_softmasks(path_output="."):
+    """
+    Plot softmasks for a poster with French labels and color theme.
+    """
+
+    colors = {
+        'masque_binaire_cylindrique':      '#8B1E3F',  # accent bordeaux
+        'masque_discret_a_deux_niveaux':   '#B08D57',  # bronze 1
+        'masque_continu_lineaire':         '#A37A44',  # bronze 2
+        'masque_continu_gaussien':         '#926C3B',  # bronze 3
+        'masque_hybride_binaire_gaussien': '#7F5E32',  # bronze 4
+    }
+
+    shape = (64,64,64)
+    binmask_array, gauss_array = make_phantoms(shape, radius=14)
+
+    # Save temporary NIfTI files. The poster shows the softmasks of shimmingtoolbox, whose functions only take file
+    # names, and there is no in-memory implementation of these softmasks in this repository
     with tempfile.NamedTemporaryFile(suffix=".nii.gz", delete=False) as tmp_bin, \
          tempfile.NamedTemporaryFile(suffix=".nii.gz", delete=False) as tmp_gss:
 
@@ -0,0 +1,168 @@
+"""
+This script extracts the shimming statistics of each mask type from the terminal outputs (*.txt) of the shimming
+sessions, and averages them over all the files.
+
+For each mask type, it reads the percentage increase of the weighted mean, the percentage decrease of the standard
+deviation and of the RMSE reported after the line naming the mask (mask_<type> or <type>_mask), and the time reported
+by the "mask (<type>) created" line. Each file is read in a single pass with one regular expression, and the files are
+processed in parallel. A value missing from a file is ignored in the statistics of its mask type, instead of being
+counted as 0, and the values keep their sign: a negative decrease (a shimming that made a metric worse) is averaged as
+such.
+
+The summary has one row per mask type and metric, with the mean, the standard deviation and the number of files of the
+values. make_data_dict converts it to the input of plot_shimming_performance_and_timing
+(fig_shim_performance_timing.py).
+
+Example usage:
+    python shim_log_stats.py -i /path/to/terminal_outputs -o shimming_stats.csv
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+# Mask type in the terminal outputs and its name in the figures
+MASK_TYPES = {
+    'seg': 'segmentation_binaire',
+    'bin': 'masque_binaire_cylindrique',
+    'cst': 'masque_discret_a_deux_niveaux',
+    'lin': 'masque_continu_lineaire',
+    'gss': 'masque_continu_gaussien',
+    'sum': 'masque_hybride_binaire_gaussien',
+}
+METRICS = ['mean', 'std', 'rmse', 'time']
+
+# Statistics lines and the number of lines after the line naming the mask in which they are searched
+STAT_LINES = {
+    'percentage increase of the weighted mean': ('mean', 12),
+    'percentage decrease in standard deviation (std)': ('std', 13),
+    'percentage decrease in root mean squared error (rmse)': ('rmse', 14),
+}
+
+_mask_types = '|'.join(MASK_TYPES)
+LINE_REGEX = re.compile(
+    rf"(?P<header>mask_(?P<header_type>{_mask_types})|(?P<header_type_end>{_mask_types})_mask)"
+    rf"|(?P<stat>{'|'.join(re.escape(stat) for stat in STAT_LINES)})"
+    rf"|mask \((?P<time_type>{_mask_types})\) created",
+    re.IGNORECASE)
+# Signed, so that a shimming that made a metric worse (e.g. a decrease of -12.50%) is not counted as an improvement
+NUMBER_REGEX = re.compile(r"[-+]?[0-9]*\.?[0-9]+")
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Extract and average the shimming statistics of each mask type from '
+                                                 'terminal output files.')
+    parser.add_argument('-i', required=True, type=str, help='Folder containing the terminal output files (*.txt).')
+    parser.add_argument('-o', type=str, help='CSV file where the summary is saved.')
+    parser.add_argument('-num-workers', default=os.cpu_count(), type=int,
+                        help='Number of files processed in parallel. Default: number of CPUs')
+
+    return parser
+
+
+def parse_shim_log(fname):
+    """
+    Extract the shimming statistics of each mask type from a terminal output file
+    :param fname: path to the terminal output file
+    :return: stats: dict of {mask type: {metric: value}}, with only the values found in the file
+    """
+    stats = {mask_type: {} for mask_type in MASK_TYPES}
+    # Last line naming each mask type, the statistics lines are searched in the lines after it
+    header_lines = {}
+    with open(fname, 'r', errors='replace') as f:
+        for i_line, line in enumerate(f):
+            for match in LINE_REGEX.finditer(line):
+                if match.group('header'):
+                    mask_type = (match.group('header_type') or match.group('header_type_end')).lower()
+                    header_lines[mask_type] = i_line
+                    continue
+
+                # The value follows the text of the statistics or of the time on the line
+                number = NUMBER_REGEX.search(line, match.end())
+                if number is None:
+                    continue
+                if match.group('stat'):
+                    metric, num_lines = STAT_LINES[match.group('stat').lower()]
+                    for mask_type, header_line in header_lines.items():
+                        if i_line - header_line <= num_lines:
+                            stats[mask_type].setdefault(metric, float(number.group()))
+                else:
+                    stats[match.group('time_type').lower()].setdefault('time', float(number.group()))
+    return stats
+
+
+def make_stats_table(fnames, num_workers=1):
+    """
+    Extract the shimming statistics of several terminal output files
+    :param fnames: paths to the terminal output files
+    :param num_workers: number of files processed in parallel
+    :return: df: DataFrame with the File, Mask, Metric and Value columns, one row per value found
+    """
+    rows = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        chunksize = max(1, len(fnames) // (4 * max(1, num_workers)))
+        for fname, stats in zip(fnames, executor.map(parse_shim_log, fnames, chunksize=chunksize)):
+            for mask_type, mask_stats in stats.items():
+                for metric, value in mask_stats.items():
+                    rows.append([os.path.basename(fname), MASK_TYPES[mask_type], metric, value])
+    return pd.DataFrame(rows, columns=['File', 'Mask', 'Metric', 'Value'])
+
+
+def summarize_stats(df):
+    """
+    Average the statistics of each mask type and metric over the files
+    :param df: DataFrame from make_stats_table
+    :return: summary: DataFrame with the Mask, Metric, Mean, Std (over the files) and Count columns
+    """
+    summary = df.groupby(['Mask', 'Metric'])['Value'].agg(['mean', 'std', 'count'])
+    summary = summary.rename(columns={'mean': 'Mean', 'std': 'Std', 'count': 'Count'})
+    index = pd.MultiIndex.from_product([list(MASK_TYPES.values()), METRICS], names=['Mask', 'Metric'])
+    summary = summary.reindex(index)
+    summary['Count'] = summary['Count'].fillna(0).astype(int)
+    return summary.reset_index()
+
+
+def make_data_dict(summary):
+    """
+    Convert the summary to the input of plot_shimming_performance_and_timing
+    :param summary: DataFrame from summarize_stats
+    :return: data_dict: dict of {mask name: {metric: mean over the files}}, NaN for the values never found
+    """
+    means = summary.set_index(['Mask', 'Metric'])['Mean']
+    return {mask: {metric: float(means.get((mask, metric), np.nan)) for metric in METRICS}
+            for mask in MASK_TYPES.values()}
+
+
+def load_shim_log_stats(log_dir, num_workers=1):
+    """
+    Extract and average the shimming statistics of all the terminal output files of a folder
+    :param log_dir: folder containing the terminal output files (*.txt)
+    :param num_workers: number of files processed in parallel
+    :return: summary: DataFrame from summarize_stats
+    """
+    fnames = sorted(glob.glob(os.path.join(log_dir, "*.txt")))
+    if not fnames:
+        raise FileNotFoundError(f"No terminal output file (*.txt) found in {log_dir}")
+    print(f"Processing {len(fnames)} file(s)...")
+    return summarize_stats(make_stats_table(fnames, num_workers=num_workers))
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    summary = load_shim_log_stats(args.i, num_workers=args.num_workers)
+    print(summary.to_string(index=False))
+    if args.o is not None:
+        summary.to_csv(args.o, index=False)
+        print(f"Summary saved in {args.o}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+This script computes the tSNR map of a 4D EPI: the temporal mean divided by the standard deviation of the time series
+after removing a linear trend.
+
+It replaces the fslmaths -Tmean, fsl_glm (design with a constant and the volume number), fslmaths -Tstd and fslmaths
+-div chain: the residual standard deviation of the linear fit is computed in closed form from running sums over the
+volumes, so the detrended 4D series is never written nor held in memory. The volumes of an uncompressed NIfTI file are
+read by chunks from the memory mapped file. A gzipped file (.nii.gz) can not be read by chunks without decompressing it
+from its start for each chunk, so it is decompressed once and the chunks are taken from the array in memory. As with
+FSL, the standard deviation uses N - 1 degrees of freedom and the tSNR is 0 where the standard deviation is 0.
+
+Example usage:
+    python compute_tSNR.py -i EPI_60vol_mc.nii.gz -o tSNR.nii.gz -o-mean EPI_mean.nii.gz -o-std EPI_std.nii.gz
+"""
+
+import argparse
+
+import nibabel as nib
+import numpy as np
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Compute the tSNR map of a 4D EPI after removing a linear trend.')
+    parser.add_argument('-i', required=True, type=str, help='4D EPI, e.g. the motion corrected EPI.')
+    parser.add_argument('-o', required=True, type=str, help='Output tSNR map.')
+    parser.add_argument('-o-mean', type=str, help='Output temporal mean. Default: not saved')
+    parser.add_argument('-o-std', type=str, help='Output standard deviation of the detrended EPI. Default: not saved')
+    parser.add_argument('-chunk-size', default=10, type=int,
+                        help='Number of volumes processed at once. Default: 10')
+
+    return parser
+
+
+def compute_tsnr(nii_epi, chunk_size=10):
+    """
+    Compute the temporal mean, the standard deviation of the linearly detrended time series and the tSNR
+    :param nii_epi: 4D nibabel image
+    :param chunk_size: number of volumes processed at once
+    :return: mean: 3D temporal mean
+    :return: std: 3D standard deviation of the residuals of the fit of a constant and a linear trend
+    :return: tsnr: 3D tSNR, mean / std, 0 where std is 0
+    """
+    if len(nii_epi.shape) != 4 or nii_epi.shape[3] < 3:
+        raise ValueError(f"A 4D image with at least 3 volumes is required, got a shape of {nii_epi.shape}")
+    num_volumes = nii_epi.shape[3]
+    data = nii_epi.dataobj
+    fname_epi = nii_epi.get_filename()
+    if fname_epi is not None and fname_epi.endswith('.gz'):
+        # Each read of a gzipped file decompresses it from its start, the volumes are decompressed in a single pass
+        data = np.asanyarray(data)
+
+    # Centered volume numbers, the regressor of the linear trend (the constant is handled by the centering)
+    trend = np.arange(1, num_volumes + 1, dtype=np.float64)
+    trend -= trend.mean()
+
+    # The sums are computed on the difference with the first volume to avoid cancellations in the sum of squares
+    reference = np.asarray(data[..., 0], dtype=np.float64)
+    sum_values = np.zeros(reference.shape)
+    sum_squares = np.zeros(reference.shape)
+    sum_trend_products = np.zeros(reference.shape)
+    for start in range(0, num_volumes, chunk_size):
+        stop = min(start + chunk_size, num_volumes)
+        chunk = np.asarray(data[..., start:stop], dtype=np.float64) - reference[..., np.newaxis]
+        sum_values += chunk.sum(axis=-1)
+        sum_squares += np.einsum('xyzt,xyzt->xyz', chunk, chunk)
+        sum_trend_products += chunk @ trend[start:stop]
+
+    mean_difference = sum_values / num_volumes
+    # Residual sum of squares of the linear fit: centered sum of squares minus the part explained by the trend
+    rss = sum_squares - num_volumes * mean_difference ** 2 - sum_trend_products ** 2 / np.sum(trend ** 2)
+    std = np.sqrt(np.maximum(rss, 0) / (num_volumes - 1))
+
+    mean = reference + mean_difference
+    tsnr = np.divide(mean, std, out=np.zeros_like(mean), where=std > 0)
+    return mean, std, tsnr
+
+
+def save_map(data, nii_epi, fname_output):
+    """
+    Save a 3D map in the space of the EPI, as float32
+    :param data: 3D array
+    :param nii_epi: 4D nibabel image the map was computed from
+    :param fname_output: path of the output image
+    """
+    nii = nib.Nifti1Image(data.astype(np.float32), nii_epi.affine, nii_epi.header)
+    nii.header.set_data_dtype(np.float32)
+    nib.save(nii, fname_output)
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.chunk_size < 1:
+        parser.error('-chunk-size must be at least 1.')
+
+    nii_epi = nib.load(args.i)
+    print(f"Computing the tSNR of {args.i} ({nii_epi.shape[3]} volumes)...")
+    mean, std, tsnr = compute_tsnr(nii_epi, chunk_size=args.chunk_size)
+
+    save_map(tsnr, nii_epi, args.o)
+    print(f"tSNR map saved in {args.o}")
+    if args.o_mean is not None:
+        save_map(mean, nii_epi, args.o_mean)
+        print(f"Mean saved in {args.o_mean}")
+    if args.o_std is not None:
+        save_map(std, nii_epi, args.o_std)
+        print(f"Standard deviation saved in {args.o_std}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Extraction of the tSNR of all the shim conditions of a subject within the spinal cord and per vertebral level.
+
+It replaces the two sct_extract_metric calls per condition (mean and per level) that reloaded the registered tSNR, the
+segmentation and the labels every time. The voxels of the registered T1w segmentation (T1w_seg_reg) are gathered once
+per subject in a MaskedVolume, with one row of weights for the whole spinal cord and one for each vertebral level of
+the labeled segmentation (labels_seg_reg). The registered tSNR maps of all the conditions are then gathered in these
+voxels and the weighted average and standard deviation of every (condition, level) pair are computed at once.
+
+As with sct_extract_metric -method wa, the segmentation values are the weights and the standard deviation is the
+weighted standard deviation around the weighted average. A level contains all the slices (last axis) where its label
+appears in the labeled segmentation, so a slice at the junction of two levels is in both.
+
+Example usage:
+    from extract_tSNR import make_tsnr_table
+    df = make_tsnr_table("/path/to/tSNR-acdc274")
+"""
+
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(SCRIPT_PATH, "..", "post_processing_scripts"))
+from masked_volume import MaskedVolume
+from shim_metrics import compute_metrics_in_masked_volume
+
+CONDITIONS = ["Baseline", "DynShim_SCseg", "DynShim_bin", "DynShim_2levels", "DynShim_linear", "DynShim_gauss"]
+# Vertebral levels of the labels (sct_label_utils -create-viewer 1:15)
+LEVELS = list(range(1, 16))
+SPINAL_LEVELS = {1: "C1", 2: "C2", 3: "C3", 4: "C4", 5: "C5", 6: "C6", 7: "C7",
+                 8: "T1", 9: "T2", 10: "T3", 11: "T4", 12: "T5", 13: "T6"}
+ALL_SC = "All SC"
+
+
+def build_level_index(nii_seg, nii_labels, levels=LEVELS):
+    """
+    Gather the voxels of the spinal cord with the weights of the whole spinal cord and of each vertebral level
+    :param nii_seg: registered spinal cord segmentation (weights)
+    :param nii_labels: labeled segmentation on the same grid, the value of a voxel is its vertebral level
+    :param levels: vertebral levels to extract
+    :return: masked: MaskedVolume, its first row of weights is the whole spinal cord and the next ones the levels
+    :return: found_levels: levels of the rows after the first one, the levels that are not in the labels are removed
+    """
+    if nii_seg.shape != nii_labels.shape or not np.allclose(nii_seg.affine, nii_labels.affine, atol=1e-4):
+        raise ValueError("The segmentation and the labels must be on the same grid")
+    seg = np.asanyarray(nii_seg.dataobj).astype(np.float32)
+    labels = np.rint(np.asanyarray(nii_labels.dataobj)).astype(np.int64)
+
+    # (n_levels, n_slices) slices where each level appears
+    num_slices = labels.shape[-1]
+    level_slices = np.zeros((max(levels) + 1, num_slices), dtype=bool)
+    label_coords = np.nonzero(labels)
+    label_values = labels[label_coords]
+    in_range = (label_values > 0) & (label_values <= max(levels))
+    level_slices[label_values[in_range], label_coords[-1][in_range]] = True
+    found_levels = [level for level in levels if level_slices[level].any()]
+
+    masked = MaskedVolume.from_masks([seg], affine=nii_seg.affine)
+    seg_weights = masked.weights[0]
+    level_weights = seg_weights * level_slices[found_levels][:, masked.slices]
+    masked = MaskedVolume(masked.shape, masked.indices, np.vstack([seg_weights, level_weights]), affine=nii_seg.affine)
+    return masked, found_levels
+
+
+def extract_tsnr(masked, tsnr_maps):
+    """
+    Compute the weighted average and standard deviation of the tSNR maps within the spinal cord and each level
+    :param masked: MaskedVolume from build_level_index
+    :param tsnr_maps: list of n_maps registered tSNR maps (nibabel images or arrays) on the grid of the segmentation
+    :return: wa: (n_maps, n_rows) weighted averages, in the order of the rows of weights of masked
+    :return: std: (n_maps, n_rows) weighted standard deviations
+    """
+    masked.values = np.empty((0, masked.num_voxels), dtype=np.float32)
+    masked.add_volumes(tsnr_maps)
+    metrics = compute_metrics_in_masked_volume(masked)
+    return metrics['mean'], metrics['std']
+
+
+def make_tsnr_table(subject_path, conditions=CONDITIONS, levels=LEVELS):
+    """
+    Build the table of the tSNR of all the conditions of a subject, per vertebral level and within the spinal cord
+    :param subject_path: tSNR-<subject_name> folder, with the T1w folder and a folder per condition
+    :param conditions: names of the conditions, the first one is the baseline of the improvements
+    :param levels: vertebral levels to extract
+    :return: df: DataFrame with the columns Condition, VertLevel, SpinalLevel, WA, STD and WA_improvement (relative
+                 improvement of WA over the baseline, NaN for the baseline and when the baseline tSNR is missing or 0)
+    """
+    nii_seg = nib.load(os.path.join(subject_path, "T1w", "seg", "T1w_seg_reg.nii.gz"))
+    nii_labels = nib.load(os.path.join(subject_path, "T1w", "labels", "labels_seg_reg.nii.gz"))
+    masked, found_levels = build_level_index(nii_seg, nii_labels, levels)
+    print(f"{masked.num_voxels} voxels in the spinal cord, levels {', '.join(str(level) for level in found_levels)}")
+
+    found_conditions = []
+    tsnr_maps = []
+    for condition in conditions:
+        fname_tsnr = os.path.join(subject_path, condition, "tSNR", "tSNR_reg.nii.gz")
+        if os.path.exists(fname_tsnr):
+            found_conditions.append(condition)
+            tsnr_maps.append(nib.load(fname_tsnr))
+        else:
+            print(f"Warning: {fname_tsnr} not found")
+    wa, std = extract_tsnr(masked, tsnr_maps)
+
+    # Weighted averages of the baseline, NaN if it is missing or empty
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if conditions[0] in found_conditions:
+            wa_baseline = wa[found_conditions.index(conditions[0])]
+            wa_baseline = np.where(wa_baseline != 0, wa_baseline, np.nan)
+        else:
+            wa_baseline = np.full(wa.shape[1], np.nan)
+        improvement = (wa - wa_baseline) / wa_baseline
+
+    # Same order as the outputs of sct_extract_metric: the levels then the whole spinal cord
+    row_names = [(str(level), SPINAL_LEVELS.get(level, "NA")) for level in found_levels] + [(ALL_SC, ALL_SC)]
+    row_order = list(range(1, len(found_levels) + 1)) + [0]
+    rows = []
+    for i, condition in enumerate(found_conditions):
+        for (vert_level, spinal_level), j in zip(row_names, row_order):
+            if np.isnan(wa[i, j]):
+                continue
+            wa_improvement = np.nan if condition == conditions[0] else improvement[i, j]
+            rows.append([condition, vert_level, spinal_level, wa[i, j], std[i, j], wa_improvement])
+
+    return pd.DataFrame(rows, columns=["Condition", "VertLevel", "SpinalLevel", "WA", "STD", "WA_improvement"])
@@ -70,8 +70,15 @@ LABELS_PATH=$LABELS_FOLDER_PATH/labels.nii.gz
 LABELS_REG_PATH=$LABELS_FOLDER_PATH/labels_reg.nii.gz
 LABELS_SEG_REG_PATH=$LABELS_FOLDER_PATH/labels_seg_reg.nii.gz
 if [ ! -f $LABELS_PATH ]; then
+    # When run by run_all.py, wait until no other viewer is opened
+    if [ -n "$VIEWER_LOCK" ]; then
+        until mkdir "$VIEWER_LOCK" 2>/dev/null; do sleep 1; done
+    fi
     # Create labels
     sct_label_utils -i $t1w_PATH -create-viewer 1:15 -qc $t1w_folder_path/qc -o $LABELS_PATH
+    if [ -n "$VIEWER_LOCK" ]; then
+        rmdir "$VIEWER_LOCK"
+    fi
 fi
 
 # Register labels
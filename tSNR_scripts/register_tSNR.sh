@@ -10,8 +10,7 @@
 # Outputs:
 # - Registered EPI to reference
 # - Registered tSNR map to reference
-# - CSV file containing the mean tSNR
-# - CSV file containing the tSNR per level
+# The mean tSNR and the tSNR per level of all the conditions are extracted afterwards by save_all_tSNR.py
 
 # Inputs
 REF_FOLDER_PATH=$1
@@ -25,14 +24,10 @@ INPUT_EPI_PATH=$(find $INPUT_FOLDER_PATH/EPIs -name "*_mc_mean.nii.gz")
 EPI_REG_TO_REF=$INPUT_FOLDER_PATH/EPIs/EPI_reg_to_REF.nii.gz
 tSNR_PATH=$(find $INPUT_FOLDER_PATH -name "*tSNR.nii.gz")
 INPUT_SEG_PATH=$(find $INPUT_FOLDER_PATH -name "*sc_seg.nii.gz")
-t1w_SEG_REG_PATH=$t1w_FOLDER_PATH/seg/T1w_seg_reg.nii.gz
-LABELS_PATH=$t1w_FOLDER_PATH/labels/labels_seg_reg.nii.gz
 
 # OUTPUTS
 WARP_PATH=$INPUT_FOLDER_PATH/warp/warp_EPI_to_REF.nii.gz
 tSNR_REG_PATH=$INPUT_FOLDER_PATH/tSNR/tSNR_reg.nii.gz
-MEAN_tSNR_PATH=$INPUT_FOLDER_PATH/tSNR/mean_tSNR.csv
-tSNR_PER_LEVEL_PATH=$INPUT_FOLDER_PATH/tSNR/tSNR_perlevel.csv
 
 # Register EPI to reference
 sct_register_multimodal -i $INPUT_EPI_PATH -iseg $INPUT_SEG_PATH -d $REF_EPI_PATH -dseg $REF_SEG_PATH -m $REF_MASK_PATH \
@@ -41,9 +36,3 @@ sct_register_multimodal -i $INPUT_EPI_PATH -iseg $INPUT_SEG_PATH -d $REF_EPI_PAT
 
 # Apply transformation to tSNR
 sct_apply_transfo -i $tSNR_PATH -d $REF_EPI_PATH -w $WARP_PATH -x linear -o $tSNR_REG_PATH
-
-# Compute mean tSNR
-sct_extract_metric -i $tSNR_REG_PATH -f $t1w_SEG_REG_PATH -method wa -perslice 0 -o $MEAN_tSNR_PATH
-
-# Compute tSNR per level
-sct_extract_metric -i $tSNR_REG_PATH -f $t1w_SEG_REG_PATH -method wa -vertfile $LABELS_PATH -perlevel 1 -vert 1:15 -o $tSNR_PER_LEVEL_PATH
\ No newline at end of file
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+This script runs all the tSNR post-processing steps of a subject, like run_all.sh, but runs the independent steps in
+parallel. The steps form a dependency graph:
+- the DICOM conversion of each shim condition and of the T1w
+- the tSNR of each condition (tSNR_sc.sh), after its conversion
+- the preparation of the reference (prepare_ref.sh), after the conversion of the T1w and the tSNR of DynShim_SCseg
+- the registration of the tSNR of each condition (register_tSNR.sh), after its tSNR and the preparation of the reference
+- the tsnr table of the results store with all the conditions (save_all_tSNR.py), after all the registrations
+A step starts as soon as the steps it depends on are done, with at most -max-jobs steps at the same time. If a step
+fails, the steps that depend on it are skipped and the other ones continue.
+
+The output of each step is saved in tSNR-<subject_name>/logs/<step>.log. The steps that open a viewer (validation of the
+segmentation, creation of the labels) wait for each other so that only one viewer is opened at a time, and their output
+is also shown in the terminal, prefixed by the name of the step, so that the instructions of the viewers are seen.
+
+The dicoms folder is organized as described in run_all.sh.
+
+Example usage:
+    python run_all.py -dicoms /path/to/your/subject/dicoms -subject acdc274 -max-jobs 4
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Shim conditions and the pattern of their dicoms folder
+CONDITIONS = {
+    "Baseline": "*-ep2d_bold_baseline_PA_tsnr",
+    "DynShim_SCseg": "*-ep2d_bold_seg_PA_tsnr",
+    "DynShim_bin": "*-ep2d_bold_bin_cyclindrique_PA_tsnr",
+    "DynShim_2levels": "*-ep2d_bold_soft_2lvl_PA_tsnr",
+    "DynShim_linear": "*-ep2d_bold_soft_lin_PA_tsnr",
+    "DynShim_gauss": "*-ep2d_bold_soft_gaus_PA_tsnr",
+}
+T1W_PATTERN = "*-T1w"
+# The segmentation shim is the reference of the registrations
+REF_CONDITION = "DynShim_SCseg"
+UNWANTED_DIRS = ["derivatives", "sourcedata", "tmp_dcm2bids"]
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Run all the tSNR post-processing steps of a subject, running the '
+                                                 'independent steps in parallel.')
+    parser.add_argument('-dicoms', required=True, type=str, help='Path to the dicoms folder of the subject.')
+    parser.add_argument('-subject', required=True, type=str, help='Name of the subject, e.g. acdc274.')
+    parser.add_argument('-max-jobs', default=4, type=int,
+                        help='Maximum number of steps running at the same time. Default: 4')
+
+    return parser
+
+
+class Step:
+    """
+    Step of the pipeline: a function run once all the steps it depends on are done
+    """
+
+    def __init__(self, name, action, dependencies=()):
+        """
+        :param name: name of the step, e.g. tsnr_Baseline
+        :param action: function of the log file of the step
+        :param dependencies: names of the steps that must be done before this one
+        """
+        self.name = name
+        self.action = action
+        self.dependencies = list(dependencies)
+
+
+def run_command(command, log, env=None, echo=None):
+    """
+    Run a command and write its output to the log of the step
+    :param command: list of arguments
+    :param log: log file of the step
+    :param env: environment of the command, None to use the current one
+    :param echo: prefix of the output lines also written to the terminal, e.g. the name of the step, None to only
+                 write the output to the log
+    """
+    log.write(f"$ {' '.join(command)}\n")
+    log.flush()
+    if echo is None:
+        subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, env=env, check=True)
+        return
+
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, text=True,
+                          errors='replace', bufsize=1) as process:
+        for line in process.stdout:
+            log.write(line)
+            log.flush()
+            print(f"[{echo}] {line}", end="", flush=True)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def run_steps(steps, max_jobs, log_dir):
+    """
+    Run the steps in the order of their dependencies, with at most max_jobs steps at the same time
+    :param steps: list of Step, the dependencies of a step must be in the list
+    :param max_jobs: maximum number of steps running at the same time
+    :param log_dir: folder of the log files of the steps
+    :return: failed: names of the steps that failed or were skipped because a dependency failed
+    """
+    steps = {step.name: step for step in steps}
+    for step in steps.values():
+        missing = set(step.dependencies) - set(steps)
+        if missing:
+            raise ValueError(f"The step {step.name} depends on unknown steps: {', '.join(sorted(missing))}")
+    os.makedirs(log_dir, exist_ok=True)
+
+    def run_step(step):
+        with open(os.path.join(log_dir, f"{step.name}.log"), "w") as log:
+            step.action(log)
+
+    pending = dict(steps)
+    done = set()
+    failed = set()
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        while pending or running:
+            for name, step in list(pending.items()):
+                if any(dependency in failed for dependency in step.dependencies):
+                    print(f"Skipping {name}: a step it depends on failed")
+                    failed.add(name)
+                    del pending[name]
+                elif all(dependency in done for dependency in step.dependencies):
+                    print(f"Starting {name}...")
+                    running[executor.submit(run_step, step)] = (name, time.time())
+                    del pending[name]
+            if not running:
+                break
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name, start = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                    print(f"Finished {name} in {time.time() - start:.0f} seconds")
+                except Exception as e:
+                    failed.add(name)
+                    print(f"Error in {name}: {e}. See {os.path.join(log_dir, name + '.log')}")
+
+    return sorted(failed)
+
+
+def remove_unwanted_dirs(folder_path, subject_name):
+    """
+    Remove the folders left by the DICOM conversion
+    :param folder_path: output folder of the conversion
+    :param subject_name: name of the subject
+    """
+    for dir_name in UNWANTED_DIRS + [f"sub-{subject_name}"]:
+        dir_path = os.path.join(folder_path, dir_name)
+        if os.path.isdir(dir_path):
+            shutil.rmtree(dir_path)
+
+
+def organize_epi(shim_path, subject_name, opt_name):
+    """
+    Move and rename the converted EPI, then remove the unwanted folders
+    :param shim_path: output folder of the conversion of a condition
+    :param subject_name: name of the subject
+    :param opt_name: name of the condition, e.g. Baseline
+    :return: epi_path: path to the EPI in the EPIs folder
+    """
+    epi_path = os.path.join(shim_path, "EPIs", f"{opt_name}_EPI_60vol.nii.gz")
+    converted_path = os.path.join(shim_path, f"sub-{subject_name}", "func", f"sub-{subject_name}_bold.nii.gz")
+    if os.path.isfile(converted_path):
+        os.makedirs(os.path.dirname(epi_path), exist_ok=True)
+        shutil.move(converted_path, epi_path)
+    remove_unwanted_dirs(shim_path, subject_name)
+    if not os.path.isfile(epi_path):
+        raise FileNotFoundError(f"No EPI found for {opt_name} in {shim_path}")
+    return epi_path
+
+
+def organize_t1w(t1w_folder_path, subject_name):
+    """
+    Move and rename the converted MPRAGE, then remove the unwanted folders
+    :param t1w_folder_path: output folder of the conversion of the T1w
+    :param subject_name: name of the subject
+    :return: t1w_path: path to T1w.nii.gz
+    """
+    t1w_path = os.path.join(t1w_folder_path, "T1w.nii.gz")
+    converted_path = os.path.join(t1w_folder_path, f"sub-{subject_name}", "anat", f"sub-{subject_name}_T1w.nii.gz")
+    if os.path.isfile(converted_path):
+        shutil.move(converted_path, t1w_path)
+    remove_unwanted_dirs(t1w_folder_path, subject_name)
+    if not os.path.isfile(t1w_path):
+        raise FileNotFoundError(f"No T1w found in {t1w_folder_path}")
+    return t1w_path
+
+
+def get_steps(dicoms_path, subject_name, output_path, env):
+    """
+    Build the steps of the pipeline of a subject
+    :param dicoms_path: path to the dicoms folder
+    :param subject_name: name of the subject
+    :param output_path: tSNR-<subject_name> output folder
+    :param env: environment of the commands
+    :return: steps: list of Step
+    """
+    steps = []
+
+    def convert(dicom_dir, folder_path):
+        return lambda log: run_command(["st_dicom_to_nifti", "-i", dicom_dir, "--subject", subject_name,
+                                        "-o", folder_path], log, env)
+
+    # Conditions whose dicoms are in the dicoms folder
+    conditions = {}
+    for opt_name, pattern in CONDITIONS.items():
+        dicom_dirs = sorted(glob.glob(os.path.join(dicoms_path, pattern)))
+        if not dicom_dirs:
+            print(f"Warning: no dicoms found for {opt_name} ({pattern}), skipping it")
+            continue
+        conditions[opt_name] = os.path.join(output_path, opt_name)
+        steps.append(Step(f"convert_{opt_name}", convert(dicom_dirs[0], conditions[opt_name])))
+
+    if REF_CONDITION not in conditions:
+        raise FileNotFoundError(f"The reference condition {REF_CONDITION} is required for the registrations")
+    ref_folder_path = conditions[REF_CONDITION]
+
+    for opt_name, shim_path in conditions.items():
+        def compute_tsnr(log, shim_path=shim_path, opt_name=opt_name):
+            epi_path = organize_epi(shim_path, subject_name, opt_name)
+            # The validation of the segmentation opens fsleyes, its instructions are shown in the terminal
+            run_command([os.path.join(SCRIPT_PATH, "tSNR_sc.sh"), epi_path, opt_name], log, env,
+                        echo=f"tsnr_{opt_name}")
+        steps.append(Step(f"tsnr_{opt_name}", compute_tsnr, [f"convert_{opt_name}"]))
+
+    # Reference, only if the T1w was acquired
+    t1w_folder_path = os.path.join(output_path, "T1w")
+    register_dependencies = [f"tsnr_{REF_CONDITION}"]
+    t1w_dicom_dirs = sorted(glob.glob(os.path.join(dicoms_path, T1W_PATTERN)))
+    if t1w_dicom_dirs:
+        def prepare_ref(log):
+            t1w_path = organize_t1w(t1w_folder_path, subject_name)
+            # The creation of the labels opens the SCT viewer, its prompts are shown in the terminal
+            run_command([os.path.join(SCRIPT_PATH, "prepare_ref.sh"), ref_folder_path, t1w_path], log, env,
+                        echo="prepare_ref")
+        steps.append(Step("convert_T1w", convert(t1w_dicom_dirs[0], t1w_folder_path)))
+        steps.append(Step("prepare_ref", prepare_ref, ["convert_T1w", f"tsnr_{REF_CONDITION}"]))
+        register_dependencies.append("prepare_ref")
+    else:
+        print(f"Warning: no dicoms found for the T1w ({T1W_PATTERN}), the reference is not prepared")
+
+    for opt_name, shim_path in conditions.items():
+        steps.append(Step(f"register_{opt_name}",
+                          lambda log, shim_path=shim_path: run_command(
+                              [os.path.join(SCRIPT_PATH, "register_tSNR.sh"), ref_folder_path, t1w_folder_path,
+                               shim_path], log, env),
+                          register_dependencies + [f"tsnr_{opt_name}"]))
+
+    # Organize all outputs
+    steps.append(Step("save_all_tSNR",
+                      lambda log: run_command([sys.executable, os.path.join(SCRIPT_PATH, "save_all_tSNR.py"),
+                                               subject_name, output_path], log, env),
+                      [f"register_{opt_name}" for opt_name in conditions]))
+    return steps
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.max_jobs < 1:
+        parser.error('-max-jobs must be at least 1.')
+
+    dicoms_path = os.path.abspath(args.dicoms)
+    output_path = os.path.join(os.path.dirname(dicoms_path), f"tSNR-{args.subject}")
+    log_dir = os.path.join(output_path, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    # Only one viewer at a time (see tSNR_sc.sh and prepare_ref.sh). A lock left by an interrupted run is removed.
+    viewer_lock = os.path.join(log_dir, "viewer.lock")
+    if os.path.isdir(viewer_lock):
+        os.rmdir(viewer_lock)
+    env = dict(os.environ, VIEWER_LOCK=viewer_lock)
+
+    steps = get_steps(dicoms_path, args.subject, output_path, env)
+    print(f"Running {len(steps)} steps with at most {args.max_jobs} at the same time. Logs in {log_dir}")
+    start = time.time()
+    failed = run_steps(steps, args.max_jobs, log_dir)
+
+    if failed:
+        print(f"\n{len(failed)} step(s) failed or were skipped: {', '.join(failed)}")
+        sys.exit(1)
+    print(f"\nAll tSNR data saved successfully in {output_path} ({time.time() - start:.0f} seconds)")
+
+
+if __name__ == '__main__':
+    main()
@@ -157,7 +157,7 @@ do
     fi
 done
 
-# Organize all outputs in a single CSV file
-echo -e "\nOrganizing all outputs in a single CSV file..."
+# Organize all outputs in the tsnr table of the results store
+echo -e "\nOrganizing all outputs in the results store..."
 "$SCRIPT_PATH/save_all_tSNR.py" $SUBJECT_NAME $OUTPUT_PATH
-echo -e "\n All tSNR data saved successfully in $OUTPUT_PATH"
\ No newline at end of file
+echo -e "\n All tSNR data saved successfully in ${DICOMS_PATH%/*}/../results_store"
\ No newline at end of file
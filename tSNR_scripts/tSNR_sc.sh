@@ -11,14 +11,15 @@
 # - Mask of the spinal cord
 # - Mask centred around the spinal cord in EPI
 # - Motion corrected EPI
-# - Detrended EPI
-# - Standard deviation of the EPI
+# - Standard deviation of the detrended EPI
 # - tSNR map
 
 # Inputs
 EPI_60vol_PATH=$1
 OPT_NAME=$2
 
+SCRIPT_PATH=$(dirname $0)
+
 EPI_FOLDER_PATH=$(dirname $EPI_60vol_PATH)
 OPT_FOLDER_PATH=$(dirname $EPI_FOLDER_PATH)
 TEMP_PATH=$OPT_FOLDER_PATH/temp
@@ -55,11 +56,18 @@ SEG_PATH=$SEG_FOLDER_PATH/sc_seg.nii.gz
 sct_deepseg spinalcord -i $EPI_mean_PATH -o $SEG_PATH -qc $QC_FOLDER_PATH
 
 # Validate segmentation
+# When the conditions are processed in parallel (run_all.py), wait until no other viewer is opened
+if [ -n "$VIEWER_LOCK" ]; then
+    until mkdir "$VIEWER_LOCK" 2>/dev/null; do sleep 1; done
+fi
 echo -e "\nPlease validate the segmentation of the spinal cord. Use 'option+E' to edit the segmentation."
 echo -e "\nUse 'cmd+Q' when finished."
 fsleyes \
     $EPI_mean_PATH -cm greyscale -dr 0 200 \
     $SEG_PATH -cm blue
+if [ -n "$VIEWER_LOCK" ]; then
+    rmdir "$VIEWER_LOCK"
+fi
 
 # Get centerline of the spinal cord from the segmentation
 CENTERLINE_PATH=$SEG_FOLDER_PATH/sc_centerline.nii.gz
@@ -83,17 +91,7 @@ EPI_mc_mean_path=$EPI_FOLDER_PATH/${OPT_NAME}_EPI_mc_mean.nii.gz
 mv $EPI_mc_path $EPI_FOLDER_PATH/${OPT_NAME}_EPI_60vol_mc.nii.gz
 EPI_mc_path=$EPI_FOLDER_PATH/${OPT_NAME}_EPI_60vol_mc.nii.gz
 
-# Detrend data
-EPI_detrend_path=$TEMP_PATH/${OPT_NAME}_EPI_detrend.nii.gz
-detrend_file=$TEMP_PATH/detrend_1st_order.con
-Ntp=$(fslnvols $EPI_mc_path)
-awk -v Ntp="$Ntp" 'BEGIN { for (i = 1; i <= Ntp; i++) printf "1 \t %3d\n", i; }' > $detrend_file
-fsl_glm -i $EPI_mc_path -d $detrend_file -o $TEMP_PATH/betas.nii.gz --out_res=$EPI_detrend_path
-
-# Compute STD
+# Compute tSNR: mean of the motion corrected EPI divided by the STD of its linearly detrended time series
 EPI_std_path=$TEMP_PATH/EPI_std.nii.gz
-fslmaths "$EPI_detrend_path" -Tstd $EPI_std_path
-
-# Compute tSNR
 tSNR_PATH=$tSNR_OUTPUT_PATH/${OPT_NAME}_tSNR.nii.gz
-fslmaths $EPI_mc_mean_path -div $EPI_std_path $tSNR_PATH
\ No newline at end of file
+python "$SCRIPT_PATH/compute_tSNR.py" -i $EPI_mc_path -o $tSNR_PATH -o-std $EPI_std_path
\ No newline at end of file